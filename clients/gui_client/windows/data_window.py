@@ -45,6 +45,25 @@ class DataWindow(qtwindow.QTWindow):
                 (gtk.Label('Directory'), self._dir_entry, self._dir_button),
                 True, True)
 
+        self._filter_entries = {}
+        filter_items = []
+        for key, label, tooltip in (
+                ('match', _L('Name'), _L('Part of the filename')),
+                ('column', _L('Column'), _L('Name of a column')),
+                ('settings', _L('Settings'),
+                    _L('E.g. "ins.param=1.5, ins.param2=0:10"')),
+                ('after', _L('From'), _L('YYYY-mm-dd [HH:MM]')),
+                ('before', _L('To'), _L('YYYY-mm-dd [HH:MM]'))):
+            entry = gtk.Entry()
+            entry.set_tooltip_text(tooltip)
+            entry.connect('activate', self._filter_activate_cb)
+            self._filter_entries[key] = entry
+            filter_items += [gtk.Label(label), entry]
+        self._refresh_button = gtk.Button(_L('Refresh'))
+        self._refresh_button.connect('clicked', self._refresh_clicked_cb)
+        self._filter_hbox = gui.pack_hbox(
+                filter_items + [self._refresh_button], False, False)
+
         self._plot2d_button = gtk.Button(_L('Plot2D'))
         self._plot2d_button.connect('clicked', self._plot2d_clicked_cb)
         self._plot3d_button = gtk.Button(_L('Plot3D'))
@@ -117,6 +136,7 @@ class DataWindow(qtwindow.QTWindow):
 
         vbox = gtk.VBox()
         vbox.pack_start(self._dir_hbox, False, False)
+        vbox.pack_start(self._filter_hbox, False, False)
         vbox.pack_start(self._plot_frame, False, False)
         vbox.pack_start(self._views_hbox, True, True)
         self.add(vbox)
@@ -127,16 +147,48 @@ class DataWindow(qtwindow.QTWindow):
         self.hide()
         return True
 
+    def _get_filter(self):
+        '''Return the query arguments from the filter entries.'''
+        query = {}
+        for key in ('match', 'column', 'after', 'before'):
+            text = self._filter_entries[key].get_text().strip()
+            if text != '':
+                query[key] = text
+
+        settings = {}
+        for item in self._filter_entries['settings'].get_text().split(','):
+            if item.strip() == '':
+                continue
+            try:
+                key, val = [x.strip() for x in item.split('=', 1)]
+                if ':' in val:
+                    val = tuple([float(x) for x in val.split(':', 1)])
+                settings[key] = val
+            except ValueError:
+                logging.warning('invalid setting filter %r, use "ins.param=value" or "ins.param=min:max"', item)
+        if len(settings) > 0:
+            query['settings'] = settings
+
+        return query
+
     def _update_entries(self):
         self._entries_model.clear()
         self._entry_map.clear()
-        self._meta_tags.clear()
-        for i in self._browser.get_entries():
-            dir, fn = os.path.split(i.get_filename())
+        if self._browser is None:
+            return
+
+        try:
+            filenames = self._browser.get_filenames(**self._get_filter())
+        except ValueError, e:
+            logging.warning('invalid filter: %s', e)
+            return
+
+        for fullfn in filenames:
+            dir, fn = os.path.split(fullfn)
             self._entries_model.append([fn])
-            self._entry_map[fn] = i
-            self._meta_tags |= set(i.get_metadata().keys())
+            self._entry_map[fn] = fullfn
 
+        self._meta_tags = self._browser.get_meta_tags()
         tags = tuple(self._meta_tags)
         self._meta_dropdown.set_items(tags)
         if self._meta_tag in tags:
@@ -147,6 +199,14 @@ class DataWindow(qtwindow.QTWindow):
         self._browser = databrowser.Browser(dir)
         self._update_entries()
 
+    def _filter_activate_cb(self, sender):
+        self._update_entries()
+
+    def _refresh_clicked_cb(self, sender):
+        if self._browser is not None:
+            self._browser.update()
+        self._update_entries()
+
     def _dir_button_clicked_cb(self, sender):
         chooser = gtk.FileChooserDialog(
                 title=_L('Select directory'),
@@ -165,7 +225,10 @@ class DataWindow(qtwindow.QTWindow):
         self._cur_path = path
 
         fn = self._entries_model[path][0]
-        info = self._entry_map.get(fn, None)
+        fullfn = self._entry_map.get(fn, None)
+        if fullfn is None:
+            return
+        info = self._browser.get_entry(fullfn)
         if info is None:
             return
 
@@ -226,7 +289,7 @@ class DataWindow(qtwindow.QTWindow):
 
         self._plot2d_button.set_sensitive(False)
         for fn in files:
-            fullfn = self._entry_map[fn].get_filename()
+            fullfn = self._entry_map[fn]
             cmd = "qt.plot(qt.Data(%r), name=%r, style=%r, coorddim=%r, valdim=%r, ofs=%r, traceofs=%r, clear=%r, ret=False)" % (fullfn, name, style, coorddim, valdim, ofs, traceofs, clear);
             qt.interpreter.cmd(cmd, callback=lambda x: self._plot2d_button.set_sensitive(True))
 
@@ -248,7 +311,7 @@ class DataWindow(qtwindow.QTWindow):
 
         self._plot3d_button.set_sensitive(False)
         for fn in files:
-            fullfn = self._entry_map[fn].get_filename()
+            fullfn = self._entry_map[fn]
             cmd = "qt.plot3(qt.Data(%r), name=%r, style=%r, coorddim=%r, valdim=%r, ofs=%r, traceofs=%r, clear=%r, ret=False)" % (fullfn, name, style, coorddims, valdim, ofs, traceofs, clear);
             qt.interpreter.cmd(cmd, callback=lambda x: self._plot3d_button.set_sensitive(True))
 
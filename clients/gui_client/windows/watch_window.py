@@ -20,6 +20,7 @@ import gobject
 import time
 import logging
 import qtclient as qt
+from lib.network import object_sharer as objsh
 
 from gettext import gettext as _L
 
@@ -47,14 +48,21 @@ def do_print(r):
 class WatchWindow(qtwindow.QTWindow):
 
     ORDERID = 22
+    PROBE_OWNER = 'watch'
 
     def __init__(self):
         qtwindow.QTWindow.__init__(self, 'watch', 'Watch')
         self.connect("delete-event", self._delete_event_cb)
         qt.flow.connect('measurement-start', self._mstart_cb)
         qt.flow.connect('measurement-end', self._mend_cb)
+        qt.instruments.connect('instrument-added', self._instrument_added_cb)
+
+        # The server removes the probes of this client when it disconnects
+        self._probe_owner = '%s:%s' % (self.PROBE_OWNER,
+                objsh.root.get_id())
 
         self._watch = {}
+        self._ins_hids = {}
         self._paused = False
 
         self._frame = gtk.Frame()
@@ -145,6 +153,7 @@ class WatchWindow(qtwindow.QTWindow):
         logging.info('Watch win: setting paused to %s', paused)
         self._pause_button.set_active(paused)
         self._paused = paused
+        qt.instruments.set_probes_paused(self._probe_owner, paused)
 
     def get_paused(self):
         return self._paused
@@ -173,38 +182,40 @@ class WatchWindow(qtwindow.QTWindow):
         active = self._ma_check.get_active()
         self._ma_const.set_sensitive(active)
 
-    def _receive_reply(self, ins_param, result):
-        if ins_param not in self._watch:
+    def _ins_changed_cb(self, sender, changes, insname):
+        for param, val in changes.iteritems():
+            ins_param = insname + "." + param
+            if ins_param in self._watch:
+                self._update_cb(None, ins_param, val)
+
+    def _instrument_added_cb(self, sender, insname):
+        '''
+        Add the probes again when a watched instrument is reloaded;
+        removing the old instrument removed them.
+        '''
+        for info in self._watch.values():
+            if info['insname'] == insname and info['delay'] != 0:
+                qt.instruments.add_probe(insname, info['parameter'],
+                        info['delay'], self._probe_owner)
+
+    def _connect_ins(self, ins):
+        '''Connect to the changed signal, once for each instrument.'''
+        insname = ins.get_name()
+        if insname in self._ins_hids:
+            ins, hid, count = self._ins_hids[insname]
+            self._ins_hids[insname] = (ins, hid, count + 1)
             return
-
-        # Update delay if we're querying too fast
-        info = self._watch[ins_param]
-        delta = time.time() - info['req_t']
-        info['avgtime'] = info['avgtime'] * 0.9 + delta * 0.1
-        if info['avgtime'] > info['delay'] / 1000.0:
-            self._set_delay(ins_param, info['delay'] * 2)
-        info['reply_received'] = True
-        self._update_cb(None, ins_param, result)
-
-    def _query_ins(self, ins_param):
-        info = self._watch[ins_param]
-        if not info['reply_received'] or self._paused:
-            logging.info('Not querying...')
-            return True
-
-        info['reply_received']= False
-        info['req_t']= time.time()
-        ins = info['instrument']
-        param = info['parameter']
-        ins.get(param, callback=lambda x: self._receive_reply(ins_param, x))
-
-        return True
-
-    def _ins_changed_cb(self, sender, changes, param, ins_param):
-        if ins_param not in self._watch or param not in changes:
+        hid = ins.connect('changed', lambda sender, changes: \
+                self._ins_changed_cb(sender, changes, insname))
+        self._ins_hids[insname] = (ins, hid, 1)
+
+    def _disconnect_ins(self, insname):
+        ins, hid, count = self._ins_hids[insname]
+        if count > 1:
+            self._ins_hids[insname] = (ins, hid, count - 1)
             return
-        info = self._watch[ins_param]
-        self._update_cb(None, ins_param, changes[param])
+        ins.disconnect(hid)
+        del self._ins_hids[insname]
 
     def _add_clicked_cb(self, widget):
         ins = self._ins_combo.get_instrument()
@@ -212,17 +223,17 @@ class WatchWindow(qtwindow.QTWindow):
         if ins is None or param is None:
             return
         delay = int(self._interval.get_value())
-        ins_param = ins.get_name() + "." + param
+        insname = ins.get_name()
+        ins_param = insname + "." + param
         if ins_param in self._watch:
             return
 
         iter = self._tree_model.append((ins_param, '%d ms' % delay, ''))
         info = {
             'instrument': ins,
+            'insname': insname,
             'parameter': param,
             'delay': delay,
-            'avgtime': delay / 1000.0,
-            'reply_received': True,
             'iter': iter,
             'options': ins.get_shared_parameter_options(param),
             'graph': self._graph_check.get_active(),
@@ -232,13 +243,9 @@ class WatchWindow(qtwindow.QTWindow):
         }
 
         self._watch[ins_param] = info
+        self._connect_ins(ins)
         if delay != 0:
-            hid = gobject.timeout_add(int(delay), self._query_ins, ins_param)
-        else:
-            hid = ins.connect('changed', lambda sender, changes: \
-                    self._ins_changed_cb(sender, changes, param, ins_param))
-
-        self._watch[ins_param]['hid'] = hid
+            qt.instruments.add_probe(insname, param, delay, self._probe_owner)
 
     def _get_ncols(self, info, val):
         nvals = 1
@@ -319,8 +326,8 @@ class WatchWindow(qtwindow.QTWindow):
 
     def _set_delay(self, ins_param, delay):
         info = self._watch[ins_param]
-        gobject.source_remove(info['hid'])
-        info['hid'] = gobject.timeout_add(int(delay), self._query_ins, ins_param)
+        qt.instruments.add_probe(info['instrument'].get_name(),
+                info['parameter'], delay, self._probe_owner)
         info['delay'] = delay
         strval = '%d ms' % (delay,)
         self._tree_model.set(info['iter'], 1, strval)
@@ -333,10 +340,11 @@ class WatchWindow(qtwindow.QTWindow):
             model.remove(iter)
 
             info = self._watch[ins_param]
+            insname = info['instrument'].get_name()
             if info['delay'] != 0:
-                gobject.source_remove(info['hid'])
-            else:
-                info['ins'].disconnect(info['hid'])
+                qt.instruments.remove_probe(insname, info['parameter'],
+                        self._probe_owner)
+            self._disconnect_ins(insname)
             del self._watch[ins_param]
 
     def _apply_clicked_cb(self, widget):
@@ -0,0 +1,64 @@
+# Benchmark for appending points to an in-memory Data object.
+#
+# The time needed to add a point should not depend on the number of points
+# already stored. For every decade of rows the average cost per point is
+# printed, both for adding single points and for adding blocks of points
+# (e.g. a VNA trace per call).
+#
+# Run from within QTLab: execfile('examples/benchmark_data_append.py')
+
+import time
+import numpy as np
+import qt
+
+NMAX = int(1e7)         # total number of rows
+BLOCKSIZE = 2001        # rows per call in the block benchmark
+
+def report(label, n, dt, npoints):
+    print '%-8s %12d rows: %8.3f us / point' % (label, n, dt / npoints * 1e6)
+
+def bench_single(nmax):
+    d = qt.Data(name='append_benchmark_single', inmem=True, infile=False)
+    d.add_coordinate('x')
+    d.add_value('y')
+
+    n = 0
+    decade = 10
+    nlast = 0
+    start = time.time()
+    while n < nmax:
+        d.add_data_point(n, 0.5)
+        n += 1
+        if n == decade:
+            stop = time.time()
+            report('single', n, stop - start, n - nlast)
+            decade *= 10
+            nlast = n
+            start = time.time()
+
+def bench_block(nmax, blocksize):
+    d = qt.Data(name='append_benchmark_block', inmem=True, infile=False)
+    d.add_coordinate('x')
+    d.add_coordinate('f')
+    d.add_value('y')
+
+    block = np.zeros((blocksize, 3))
+    block[:,1] = np.linspace(4e9, 8e9, blocksize)
+
+    n = 0
+    decade = 10 * blocksize
+    nlast = 0
+    start = time.time()
+    while n < nmax:
+        block[:,0] = n
+        d.add_data_point(block)
+        n += blocksize
+        if n >= decade or n >= nmax:
+            stop = time.time()
+            report('block', n, stop - start, n - nlast)
+            decade *= 10
+            nlast = n
+            start = time.time()
+
+bench_single(NMAX)
+bench_block(NMAX, BLOCKSIZE)
@@ -0,0 +1,164 @@
+# Benchmark for loading .dat files.
+#
+# Synthetic 1D, 2D and 3D data files (with comments in the header, between
+# blocks and at the end of data lines) are parsed both with the fast
+# DatParser used by Data._load_file() and with a copy of the previous
+# line-by-line parser. The results are compared, with and without a
+# row_mask, and the time per row is printed.
+#
+# Run from within QTLab: execfile('examples/benchmark_data_load.py')
+
+import os
+import time
+import tempfile
+import numpy as np
+import qt
+from lib.file_support.datfile import DatParser
+
+NPOINTS = int(1e6)      # approximate number of rows per file
+
+def write_file(path, shape):
+    '''
+    Write a file with len(shape) coordinates and 2 values. The last
+    coordinate is the inner loop, blocks are separated by blank lines.
+    '''
+    ncoords = len(shape)
+    f = open(path, 'w')
+    f.write('# Filename: %s\n# Timestamp: now\n\n' % os.path.basename(path))
+    f.write('# A header comment\n')
+    for i in range(ncoords + 2):
+        f.write('# Column %d:\n' % (i + 1))
+        if i < ncoords:
+            f.write('#\tname: c%d\n#\tsize: %d\n#\ttype: coordinate\n' % \
+                    (i, shape[i]))
+        else:
+            f.write('#\tname: v%d\n#\ttype: value\n' % (i - ncoords))
+    f.write('\n')
+
+    inner = shape[-1]
+    grids = np.indices(shape).reshape((ncoords, -1)).T
+    vals = np.random.randn(len(grids), 2)
+    rows = np.hstack((grids, vals))
+    fmt = '\t'.join(['%d'] * ncoords + ['%.12e'] * 2) + '\n'
+    for start in range(0, len(rows), inner):
+        block = rows[start:start + inner]
+        blockno = start / inner
+        if blockno % 7 == 3:
+            f.write('# comment before block %d\n' % blockno)
+        text = (fmt * len(block)) % tuple(block.ravel().tolist())
+        if blockno % 11 == 5:
+            text = text.replace('\n', ' # inline\n', 1)
+        f.write(text)
+        f.write('\n')
+        if ncoords > 2 and (blockno + 1) % shape[-2] == 0:
+            f.write('\n')
+    f.close()
+
+def legacy_parse(path, row_mask=None):
+    '''The line by line parser that was used by Data._load_file().'''
+    comments = []
+    block_sizes = []
+    max_blocksize = 0
+    data = None
+    nfields = 0
+    blocksize = 0
+    row_no = -1
+    if row_mask is not None:
+        last_row_no_to_parse = row_mask.nonzero()[0][-1]
+
+    for line in open(path):
+        line = line.rstrip(' \n\t\r')
+        if len(line) == 0 and data is not None:
+            block_sizes.append(blocksize)
+            if blocksize > max_blocksize:
+                max_blocksize = blocksize
+            blocksize = 0
+
+        commentpos = line.find('#')
+        if commentpos != -1:
+            comments.append((line, row_no + 1 + (-1 if commentpos > 0 else 0)))
+            line = line[:commentpos]
+
+        fields = line.split()
+        if len(fields) > nfields:
+            nfields = len(fields)
+
+        fields = [float(f) for f in fields]
+        if len(fields) > 0:
+            row_no += 1
+            if row_mask is not None:
+                if row_no > last_row_no_to_parse: break
+                if not row_mask[row_no]:
+                    continue
+
+            if data is None:
+                data = np.empty((os.path.getsize(path) / len(line) + 1,
+                    len(fields))) + np.nan
+            if row_no >= len(data):
+                data_larger = np.empty((int(np.ceil(1.5 * len(data))),
+                    len(fields))) + np.nan
+                data_larger[:len(data),:] = data[:,:]
+                data = data_larger
+            data[row_no,:] = np.array(fields)
+            blocksize += 1
+
+    if row_mask is not None:
+        row_no = min(row_no, last_row_no_to_parse)
+    return data[:1 + row_no], block_sizes, max_blocksize, blocksize, \
+            comments, nfields
+
+def fast_parse(path, row_mask=None):
+    comments = []
+    p = DatParser(lambda line, n: comments.append((line, n)),
+            row_mask=row_mask, size_hint=os.path.getsize(path))
+    p.parse_file(open(path))
+    return p.get_data(), p.block_sizes, p.max_blocksize, p.blocksize, \
+            comments, p.nfields
+
+def compare(label, path, row_mask=None):
+    start = time.time()
+    ref = legacy_parse(path, row_mask)
+    t_legacy = time.time() - start
+    start = time.time()
+    new = fast_parse(path, row_mask)
+    t_fast = time.time() - start
+
+    np.testing.assert_array_equal(ref[0], new[0])
+    for i in range(1, len(ref)):
+        assert ref[i] == new[i], 'Mismatch in result %d' % i
+
+    nrows = len(new[0])
+    print '%-12s %9d rows: legacy %7.3f us/row, fast %7.3f us/row (%.1fx)' % \
+            (label, nrows, t_legacy / nrows * 1e6, t_fast / nrows * 1e6,
+            t_legacy / t_fast)
+
+def load_data(label, path):
+    start = time.time()
+    d = qt.Data(path)
+    d.get_data()
+    dt = time.time() - start
+    print '%-12s %9d rows: qt.Data %7.3f us/row, %d blocks' % \
+            (label, d.get_npoints(), dt / d.get_npoints() * 1e6,
+            d.get_nblocks())
+
+tmpdir = tempfile.mkdtemp()
+n1 = NPOINTS
+n2 = int(np.sqrt(NPOINTS))
+n3 = int(round(NPOINTS ** (1 / 3.)))
+shapes = [('1D', (n1,)), ('2D', (n2, n2)), ('3D', (n3, n3, n3))]
+
+for label, shape in shapes:
+    path = os.path.join(tmpdir, 'bench_%s.dat' % label)
+    write_file(path, shape)
+
+    compare(label, path)
+
+    nrows = np.prod(shape)
+    mask = np.random.rand(nrows) > 0.3
+    mask[int(0.8 * nrows):] = False
+    compare(label + ' masked', path, mask)
+
+    load_data(label, path)
+    os.remove(path)
+
+os.rmdir(tmpdir)
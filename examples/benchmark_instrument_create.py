@@ -0,0 +1,65 @@
+# Benchmark for creating instruments at startup.
+#
+# Creates NINS instruments the way init/80_create_instruments.py does,
+# first with the driver registry (plugin directories listed once, driver
+# modules imported once) and then emulating the previous behaviour, which
+# listed the plugin directories for every type_exists() / get_types() call
+# and reloaded the driver module for every create().
+#
+# The dummy_signal_generator driver does not talk to hardware, so the times
+# are the overhead of QTLab itself.
+#
+# Run from within QTLab: execfile('examples/benchmark_instrument_create.py')
+
+import os
+import sys
+import time
+import qt
+import instruments
+
+NINS = 25
+DRIVER = 'dummy_signal_generator'
+
+def remove_all(names):
+    for name in names:
+        if name in qt.instruments.get_instrument_names():
+            qt.instruments.remove(name)
+
+def create_all(label):
+    names = ['bench%d' % i for i in range(NINS)]
+    start = time.time()
+    for name in names:
+        qt.instruments.get_types()
+        qt.instruments.create(name, DRIVER)
+    dt = time.time() - start
+    print '%-10s %d instruments: %8.1f ms total, %6.2f ms / instrument' % \
+            (label, NINS, dt * 1e3, dt / NINS * 1e3)
+    remove_all(names)
+    return dt
+
+def legacy_create(name, instype, **kwargs):
+    '''Emulate the old create(): list the plugin directories and reload.'''
+    qt.instruments.refresh_types()
+    if not qt.instruments.type_exists(instype):
+        return None
+    module = instruments._get_driver_module(instype)
+    reload(module)
+    return registry_create(name, instype, **kwargs)
+
+def legacy_get_types():
+    qt.instruments.refresh_types()
+    return registry_get_types()
+
+t_new = create_all('registry')
+
+registry_create = qt.instruments.create
+registry_get_types = qt.instruments.get_types
+qt.instruments.create = legacy_create
+qt.instruments.get_types = legacy_get_types
+try:
+    t_old = create_all('legacy')
+finally:
+    qt.instruments.create = registry_create
+    qt.instruments.get_types = registry_get_types
+
+print 'speedup: %.1fx' % (t_old / t_new)
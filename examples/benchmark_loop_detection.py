@@ -0,0 +1,137 @@
+# Benchmark and consistency check for the loop structure detection.
+#
+# lib/loopdetect.py replaces the row by row loops that were used by
+# Data._detect_dimensions_size() and DataView.divide_into_sweeps(). Both
+# are compared with copies of the previous implementations on many random
+# inputs (complete and incomplete grids, repeated and NaN coordinates,
+# sweeps back and forth), after which the time needed for large data sets
+# is printed.
+#
+# Run from within QTLab: execfile('examples/benchmark_loop_detection.py')
+
+import time
+import numpy as np
+from lib import loopdetect
+
+NRANDOM = 2000          # number of random inputs to compare
+NPOINTS = int(1e7)      # rows in the timing benchmark
+
+def legacy_detect(data, ncoords):
+    '''The loop detection previously used in Data._detect_dimensions_size().'''
+    loopdims = []
+    newshape = []
+    starts = []
+    ends = []
+    mulsize = 1
+    for iter in range(ncoords):
+        loopdim = None
+        for colnum in range(ncoords):
+            if mulsize >= len(data):
+                continue
+
+            if data[0, colnum] != data[mulsize, colnum]:
+                loopdim = colnum
+                loopdims.append(loopdim)
+                loopstart = data[0, loopdim]
+                break
+
+        if loopdim is None:
+            break
+
+        i = 1
+        while i * mulsize < len(data):
+            if data[i * mulsize, loopdim] == loopstart:
+                break
+            i += 1
+
+        starts.append(loopstart)
+        ends.append(data[mulsize * (i - 1), loopdim])
+        newshape.append(i)
+        mulsize *= i
+
+    return loopdims, newshape, starts, ends, len(data) == mulsize
+
+def legacy_sweeps(sdim, use_sweep_direction):
+    '''The sweep division previously used in DataView.divide_into_sweeps().'''
+    dx = np.sign(sdim[1:] - sdim[:-1])
+    if use_sweep_direction:
+        for i in range(1,len(dx)):
+            if i+1 < len(dx) and dx[i] == 0: dx[i]=dx[i+1]
+        change_in_sign = (2 + np.array(np.where(dx[1:] * dx[:-1] < 0),dtype=np.int).reshape((-1))).tolist()
+        for i in range(len(change_in_sign)-1, 0, -1):
+            if change_in_sign[i]-change_in_sign[i-1] == 1: del change_in_sign[i]
+        if len(change_in_sign) == 0: return np.array([[0, len(sdim)]])
+        start_indices = np.concatenate(([0], change_in_sign))
+        stop_indices  = np.concatenate((change_in_sign, [len(sdim)]))
+    else:
+        change_in_sdim = 1 + np.array(np.where(dx != 0)).reshape((-1))
+        if len(change_in_sdim) == 0: return np.array([[0, len(sdim)]])
+        start_indices = np.concatenate(([0], change_in_sdim))
+        stop_indices  = np.concatenate((change_in_sdim, [len(sdim)]))
+    return np.concatenate((start_indices, stop_indices)).reshape((2,-1)).T
+
+def random_grid():
+    '''Return random measurement data and the number of coordinates.'''
+    ncoords = np.random.randint(1, 5)
+    shape = np.random.randint(1, 6, size=ncoords)
+    grids = np.indices(shape).reshape((ncoords, -1)).T[:,::-1].astype(float)
+    # Permute the columns, so the inner loop is not always the last column
+    grids = grids[:,np.random.permutation(ncoords)]
+    if np.random.rand() < 0.3:
+        grids = grids[:np.random.randint(0, len(grids) + 1)]
+    if np.random.rand() < 0.2 and len(grids) > 0:
+        grids[np.random.randint(len(grids)), np.random.randint(ncoords)] = \
+                np.random.choice([np.nan, 0., 1.])
+    values = np.random.randn(len(grids), 1)
+    return np.hstack((grids, values)), ncoords
+
+def random_sweep():
+    steps = np.random.choice([-1., 0., 1.], size=np.random.randint(0, 60),
+            p=[0.3, 0.2, 0.5])
+    if np.random.rand() < 0.5:
+        steps = np.repeat(steps, np.random.randint(1, 5))
+    return np.concatenate(([0.], np.cumsum(steps)))
+
+def same(a, b):
+    return len(a) == len(b) and all([x == y or (x != x and y != y)
+            for x, y in zip(a, b)])
+
+for n in range(NRANDOM):
+    data, ncoords = random_grid()
+    if len(data) < 2:
+        continue
+    ref = legacy_detect(data, ncoords)
+    loops = loopdetect.detect_loops(data, ncoords)
+    assert ref[0] == loops.loopdims and ref[1] == loops.loopshape, (data, ref)
+    assert same(ref[2], loops.starts) and same(ref[3], loops.ends), (data, ref)
+    assert ref[4] == loops.complete, (data, ref)
+
+    sdim = random_sweep()
+    for direction in (True, False):
+        np.testing.assert_array_equal(legacy_sweeps(sdim, direction),
+                loopdetect.find_sweeps(sdim, direction))
+print 'Compared %d random inputs' % NRANDOM
+
+def timeit(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+# A single long sweep, the loop only ends at the last row, and an
+# incomplete 3D grid.
+n = int(round(NPOINTS ** (1 / 3.)))
+grid = np.indices((n, n, n)).reshape((3, -1)).T[:,::-1].astype(float)
+for label, data in (('1D', np.arange(NPOINTS, dtype=float).reshape((-1, 1))),
+        ('3D', grid[:len(grid) - n / 2])):
+    ncoords = data.shape[1]
+    t_legacy = timeit(legacy_detect, data, ncoords)
+    t_new = timeit(loopdetect.detect_loops, data, ncoords)
+    print 'detect_loops %s %9d rows: legacy %8.3f ms, vectorized %8.3f ms' % \
+            (label, len(data), t_legacy * 1e3, t_new * 1e3)
+
+sdim = np.tile(np.concatenate((np.arange(1000.), np.arange(1000.)[::-1])),
+        NPOINTS / 20000)
+t_legacy = timeit(legacy_sweeps, sdim, True)
+t_new = timeit(loopdetect.find_sweeps, sdim, True)
+print 'find_sweeps     %9d rows: legacy %8.3f ms, vectorized %8.3f ms' % \
+        (len(sdim), t_legacy * 1e3, t_new * 1e3)
@@ -0,0 +1,84 @@
+# Benchmark for transferring numpy arrays with the object sharer.
+#
+# Starts a sharing server in a separate process that returns arrays of
+# 1 KB to 100 MB, and measures the time to fetch them over loopback, first
+# with protocol version 2 (highest pickle protocol, arrays sent as raw
+# buffers) and then with version 1 (protocol 0 pickles) as used by older
+# QTLab versions. Version 1 is only measured up to MAX_SIZE_V1 because it
+# is very slow for large arrays.
+#
+# This script does not run inside QTLab; run it from the source directory:
+#   python ../examples/benchmark_object_sharer.py
+
+import os
+import sys
+import time
+import socket
+import subprocess
+
+sys.path.insert(0, os.getcwd())
+import numpy as np
+from lib.network import object_sharer as objsh
+
+PORT = 12099
+SIZES = [1e3, 1e4, 1e5, 1e6, 1e7, 1e8]
+MAX_SIZE_V1 = 1e7
+NREPEAT = 3
+
+class ArraySource(objsh.SharedObject):
+
+    def __init__(self):
+        objsh.SharedObject.__init__(self, 'array_source')
+        self._arrays = {}
+
+    def get_array(self, nbytes):
+        if nbytes not in self._arrays:
+            self._arrays[nbytes] = np.random.rand(int(nbytes) / 8)
+        return self._arrays[nbytes]
+
+def run_server():
+    import gobject
+    from lib.network import share_gtk
+    ArraySource()
+    share_gtk.start_server('127.0.0.1', PORT)
+    gobject.MainLoop().run()
+
+def connect(version):
+    objsh.PROTOCOL_VERSION = version
+    for i in range(50):
+        try:
+            sock = socket.create_connection(('127.0.0.1', PORT))
+            break
+        except socket.error:
+            time.sleep(0.1)
+    sock.setblocking(0)
+    objsh.helper.add_client(sock, None)
+    info = objsh.helper.call(sock, 'root', 'get_object_info', 'array_source')
+    return sock, objsh.ObjectProxy(sock, info)
+
+def measure(version):
+    sock, source = connect(version)
+    print 'Protocol %s' % (objsh.helper.get_protocol(sock), )
+    for nbytes in SIZES:
+        if version < 2 and nbytes > MAX_SIZE_V1:
+            break
+        source.get_array(nbytes, timeout=600)
+        start = time.time()
+        for i in range(NREPEAT):
+            source.get_array(nbytes, timeout=600)
+        dt = (time.time() - start) / NREPEAT
+        print '%10d bytes: %9.2f ms, %8.1f MB/s' % \
+                (nbytes, dt * 1e3, nbytes / dt / 1e6)
+    sock.close()
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'server':
+        run_server()
+        sys.exit(0)
+
+    server = subprocess.Popen([sys.executable, sys.argv[0], 'server'])
+    try:
+        measure(2)
+        measure(1)
+    finally:
+        server.terminate()
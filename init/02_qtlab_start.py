@@ -37,8 +37,16 @@ from lib.network import object_sharer as objsh
 iname = _cfg.get('instance_name', '')
 objsh.root.set_instance_name(iname)
 print 'Setting instance name to %s' % iname
-from lib.network import share_gtk
-share_gtk.start_server('localhost', port=_cfg.get('port', objsh.PORT))
+if _cfg.get('share_transport', 'gtk') == 'select':
+    # Serve clients from a separate thread, calls are handled in the main loop
+    import gobject
+    from lib.network import share_select
+    gobject.threads_init()
+    share_select.start_server('localhost', port=_cfg.get('port', objsh.PORT),
+            dispatch=gobject.idle_add)
+else:
+    from lib.network import share_gtk
+    share_gtk.start_server('localhost', port=_cfg.get('port', objsh.PORT))
 if _cfg['allowed_ips'] is not None:
     for _ipaddr in _cfg['allowed_ips']:
         objsh.SharedObject.server.add_allowed_ip(_ipaddr)
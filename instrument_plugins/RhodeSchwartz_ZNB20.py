@@ -68,63 +68,82 @@ class RhodeSchwartz_ZNB20(Instrument):
                                                                     timeout=self._default_timeout)
         self._freq_unit = 1
         self._freq_unit_symbol = 'Hz'
+
+        # Read parameters that declare a query with a single ask() in get().
+        # ';:' starts every query at the root, the reply is split on ';'.
+        self.set_batch_ask(self._visainstrument.ask, separator=';:',
+                reply_separator=';')
         
 
         # Add parameters to wrapper
 
         self.add_parameter('start_frequency', type=types.FloatType, format='%.6e',
                            flags=Instrument.FLAG_GETSET|Instrument.FLAG_GET_AFTER_SET,
-                           units=self._freq_unit_symbol, minval=100e3/self._freq_unit, maxval=20e9/self._freq_unit)
+                           units=self._freq_unit_symbol, minval=100e3/self._freq_unit, maxval=20e9/self._freq_unit,
+                           query='SENS1:FREQ:STAR?', parse=self._parse_frequency)
         self.add_parameter('stop_frequency', type=types.FloatType, format='%.6e',
                            flags=Instrument.FLAG_GETSET|Instrument.FLAG_GET_AFTER_SET,
-                           units=self._freq_unit_symbol, minval=100e3/self._freq_unit, maxval=20e9/self._freq_unit)
+                           units=self._freq_unit_symbol, minval=100e3/self._freq_unit, maxval=20e9/self._freq_unit,
+                           query='SENS1:FREQ:STOP?', parse=self._parse_frequency)
         self.add_parameter('start_power', type=types.FloatType, format='%.6e',
                            flags=Instrument.FLAG_GETSET|Instrument.FLAG_GET_AFTER_SET,
-                           units=self._freq_unit_symbol, minval=-60, maxval=13)
+                           units=self._freq_unit_symbol, minval=-60, maxval=13,
+                           query='SOURce:POWer:STARt?')
         self.add_parameter('stop_power', type=types.FloatType, format='%.6e',
                            flags=Instrument.FLAG_GETSET|Instrument.FLAG_GET_AFTER_SET,
-                           units=self._freq_unit_symbol, minval=-60, maxval=13)
+                           units=self._freq_unit_symbol, minval=-60, maxval=13,
+                           query='SOURce:POWer:STOP?')
 
         self.add_parameter('center_frequency', type=types.FloatType, format='%.06e',
                           flags=Instrument.FLAG_GETSET|Instrument.FLAG_GET_AFTER_SET,
-                           units=self._freq_unit_symbol, minval=110e3/self._freq_unit, maxval=20e9/self._freq_unit)
+                           units=self._freq_unit_symbol, minval=110e3/self._freq_unit, maxval=20e9/self._freq_unit,
+                           query='SENS1:FREQ:CENT?', parse=self._parse_frequency)
 
         self.add_parameter('span', type=types.FloatType, format='%.06e',
                           flags=Instrument.FLAG_GETSET|Instrument.FLAG_GET_AFTER_SET,
-                          units=self._freq_unit_symbol, minval=1/self._freq_unit, maxval=19e9/self._freq_unit)
+                          units=self._freq_unit_symbol, minval=1/self._freq_unit, maxval=19e9/self._freq_unit,
+                           query='SENS1:FREQ:SPAN?', parse=self._parse_frequency)
 
         self.add_parameter('numpoints', type=types.IntType, format='%g',
                            flags=Instrument.FLAG_GETSET|Instrument.FLAG_GET_AFTER_SET,
-                           units='', minval=1, maxval=100001)
+                           units='', minval=1, maxval=100001,
+                           query='SENS1:SWE:POIN?')
         self.add_parameter('average_mode', type=types.StringType,
                            flags=Instrument.FLAG_GETSET|Instrument.FLAG_GET_AFTER_SET,
                            format_map={'AUTO': 'automatic',
                                        'FLAT': 'cumulative average of magnitude and phase',
                                        'RED': 'cumulative average of quadratures',
-                                       'MOV': 'simple average of quadratures'})
+                                       'MOV': 'simple average of quadratures'},
+                           query='AVER:MODE?', parse=self._parse_average_mode)
         self.add_parameter('averages', type=types.IntType,
                            flags=Instrument.FLAG_GETSET|Instrument.FLAG_GET_AFTER_SET,
-                           minval=1, maxval=1000)
+                           minval=1, maxval=1000,
+                           query='AVER:COUN?')
         self.add_parameter('if_bandwidth', type=types.FloatType, format='%.0e',
                            minval=1., maxval=1e6,
                            flags=Instrument.FLAG_GETSET|Instrument.FLAG_GET_AFTER_SET,
-                           units=self._freq_unit_symbol)
+                           units=self._freq_unit_symbol,
+                           query='SENSE1:BAND?', parse=self._parse_if_bandwidth)
         self.add_parameter('if_selectivity', type=types.StringType,
                            flags=Instrument.FLAG_GETSET|Instrument.FLAG_GET_AFTER_SET,
                            format_map={'NORM': 'normal',
                                        'MED': 'medium',
-                                       'HIGH': 'high'})
+                                       'HIGH': 'high'},
+                           query='BAND:SEL?', parse=self._parse_upper)
         #changed sweeptime parameter to GETSET
         self.add_parameter('sweeptime', type=types.FloatType, format='%g',
                            flags=Instrument.FLAG_GETSET|Instrument.FLAG_GET_AFTER_SET,
-                           units='s')
+                           units='s',
+                           query='SENS1:SWE:TIME?')
         self.add_parameter('sweeptime_auto', type=types.BooleanType,
-                           flags=Instrument.FLAG_GETSET|Instrument.FLAG_GET_AFTER_SET)
+                           flags=Instrument.FLAG_GETSET|Instrument.FLAG_GET_AFTER_SET,
+                           query='SWE:TIME:AUTO?', parse=self._parse_on_off)
 
         #min power is set to -60 dBm for the power extended option
         self.add_parameter('source_power', type=types.FloatType,
                            flags=Instrument.FLAG_GETSET|Instrument.FLAG_GET_AFTER_SET,
-                           units='dBm',minval=-60., maxval=15.)
+                           units='dBm',minval=-60., maxval=15.,
+                           query='SOUR1:POW?')
 
         self.add_parameter('trigger_source', type=types.StringType,
                           flags=Instrument.FLAG_GETSET|Instrument.FLAG_GET_AFTER_SET,
@@ -134,17 +153,20 @@ class RhodeSchwartz_ZNB20(Instrument):
                             "line" : "line",
                             "tim" : "periodic timer",                            "rtcl" : "real time clock",
                             "man" : "manual"
-                          })
+                          },
+                           query='TRIGGER1:SEQUENCE:SOURCE?', parse=self._parse_trigger_source)
 
         self.add_parameter('sweep_mode', type=types.StringType,
                           flags=Instrument.FLAG_GETSET|Instrument.FLAG_GET_AFTER_SET,
                           format_map = {
                            "single" : "single",
                            "cont" : "continuous"
-                          })
+                          },
+                           query='INIT:CONT?', parse=self._parse_sweep_mode)
 
         self.add_parameter('external_reference', type=types.BooleanType,
-                          flags=Instrument.FLAG_GETSET|Instrument.FLAG_GET_AFTER_SET)
+                          flags=Instrument.FLAG_GETSET|Instrument.FLAG_GET_AFTER_SET,
+                           query='SENS:ROSC:SOUR?', parse=self._parse_external_reference)
 
         self.add_parameter('external_reference_frequency', type=types.IntType,
                           flags=Instrument.FLAG_GETSET|Instrument.FLAG_GET_AFTER_SET,
@@ -158,7 +180,8 @@ class RhodeSchwartz_ZNB20(Instrument):
                             "cw" : "cw",
                             "point":"point",
                             "seg": "segment"
-                          })
+                          },
+                           query='SWE:TYPE?', parse=self._parse_upper)
 
         self.add_function('reset')
         self.add_function('send_trigger')
@@ -340,22 +363,51 @@ class RhodeSchwartz_ZNB20(Instrument):
         
 
     def get_all(self):
-        self.get_sweep_mode()
-        self.get_trigger_source()
-        self.get_start_frequency()
-        self.get_stop_frequency()
-        self.get_numpoints()
-        self.get_average_mode()
-        self.get_averages()
-        self.get_if_bandwidth()
-        self.get_if_selectivity()
-        self.get_external_reference()
-        self.get_external_reference_frequency()
-        self.get_source_power()
-        self.get_sweeptime()
-        self.get_sweeptime_auto()
-        self.get_center_frequency()
-        self.get_span()
+        self.get(['sweep_mode', 'trigger_source', 'start_frequency',
+            'stop_frequency', 'numpoints', 'average_mode', 'averages',
+            'if_bandwidth', 'if_selectivity', 'external_reference',
+            'external_reference_frequency', 'source_power', 'sweeptime',
+            'sweeptime_auto', 'center_frequency', 'span'])
+
+    # Conversion of query replies, shared by the do_get_ functions and the
+    # combined queries in get()
+
+    def _parse_frequency(self, r):
+        return float(r)/self._freq_unit
+
+    def _parse_upper(self, r):
+        return r.strip().upper()
+
+    def _parse_on_off(self, r):
+        r = r.lower().strip()
+        return r.startswith('1') or r.startswith('on')
+
+    def _parse_if_bandwidth(self, r):
+        if r.strip().lower().startswith('max'): r = 1e6
+        return float(r)/self._freq_unit
+
+    def _parse_average_mode(self, m):
+        m = m.strip().upper()
+        if m.startswith('AUTO'): m = 'AUTO'
+        elif m.startswith('FLAT'): m = 'FLAT'
+        elif m.startswith('RED'): m = 'RED'
+        elif m.startswith('MOV'): m = 'MOV'
+        else: raise Exception('unknown averaging mode: %s' % m)
+        return m
+
+    def _parse_sweep_mode(self, r):
+        return 'cont' if r.strip().lower() in ['1'] else 'single'
+
+    def _parse_external_reference(self, r):
+        return r.strip().lower().startswith('ext')
+
+    def _parse_trigger_source(self, r):
+        r = r.lower().strip()
+        if r.startswith('lin') or r.startswith('rtc'):
+          r = r[:4]
+        else:
+          r = r[:3]
+        return r
         
     def get_data(self, s_parameter, channel_number=1):
         '''
@@ -464,7 +516,7 @@ class RhodeSchwartz_ZNB20(Instrument):
         Start of sweep (Hz)
         '''
         logging.debug('Reading start frequency')
-        return float(self._visainstrument.ask('SENS%s:FREQ:STAR?'%channel_number))/self._freq_unit
+        return self._parse_frequency(self._visainstrument.ask('SENS%s:FREQ:STAR?'%channel_number))
 
     def do_get_start_power(self):
         return float(self._visainstrument.ask('SOURce:POWer:STARt?'))
@@ -486,7 +538,7 @@ class RhodeSchwartz_ZNB20(Instrument):
         End of sweep (Hz)
         '''
         logging.debug('Reading stop frequency')
-        return float(self._visainstrument.ask('SENS%s:FREQ:STOP?'%channel_number))/self._freq_unit
+        return self._parse_frequency(self._visainstrument.ask('SENS%s:FREQ:STOP?'%channel_number))
 
     def do_get_stop_power(self):
         return float(self._visainstrument.ask('SOURce:POWer:STOP?'))
@@ -508,7 +560,7 @@ class RhodeSchwartz_ZNB20(Instrument):
         End of sweep (Hz)
         '''
         logging.debug('Reading the center frequency')
-        return float(self._visainstrument.ask('SENS%s:FREQ:CENT?'%channel_number))/self._freq_unit
+        return self._parse_frequency(self._visainstrument.ask('SENS%s:FREQ:CENT?'%channel_number))
 
     def do_set_center_frequency(self, s, channel_number = 1): #in Hz
         logging.debug('Setting center freq to %s' % s)
@@ -526,7 +578,7 @@ class RhodeSchwartz_ZNB20(Instrument):
         End of sweep (Hz)
         '''
         logging.debug('Reading the span')
-        return float(self._visainstrument.ask('SENS%s:FREQ:SPAN?'%channel_number))/self._freq_unit
+        return self._parse_frequency(self._visainstrument.ask('SENS%s:FREQ:SPAN?'%channel_number))
 
     def do_set_span(self, s, channel_number = 1):
         logging.debug('Setting span to %s' % s)
@@ -551,14 +603,11 @@ class RhodeSchwartz_ZNB20(Instrument):
 
     def do_get_if_bandwidth(self,channel_number = 1):
         logging.debug('Reading resolution bandwidth')
-        r = self._visainstrument.ask('SENSE%s:BAND?'%channel_number)
-        if r.strip().lower().startswith('max'): r = 1e6
-        return float(r)/self._freq_unit
+        return self._parse_if_bandwidth(self._visainstrument.ask('SENSE%s:BAND?'%channel_number))
 
     def do_get_if_selectivity(self):
         logging.debug('Reading IF filter selectivity')
-        r = self._visainstrument.ask('BAND:SEL?')
-        return r.strip().upper()
+        return self._parse_upper(self._visainstrument.ask('BAND:SEL?'))
     
     def ch_catalog(self):
         logging.debug('return numbers and names of all channels')
@@ -636,8 +685,7 @@ class RhodeSchwartz_ZNB20(Instrument):
 
     def do_get_sweeptime_auto(self):
         logging.debug('reading sweeptime')
-        r = self._visainstrument.ask('SWE:TIME:AUTO?').lower().strip()
-        return r.startswith('1') or r.startswith('on')
+        return self._parse_on_off(self._visainstrument.ask('SWE:TIME:AUTO?'))
 
     def do_set_sweeptime_auto(self, val): #in seconds
         logging.debug('Setting sweeptime auto to %s' % val)
@@ -649,13 +697,7 @@ class RhodeSchwartz_ZNB20(Instrument):
 
     def do_get_average_mode(self):
         logging.debug(__name__ + ' : get averaging mode')
-        m = self._visainstrument.ask('AVER:MODE?').strip().upper()
-        if m.startswith('AUTO'): m = 'AUTO'
-        elif m.startswith('FLAT'): m = 'FLAT'
-        elif m.startswith('RED'): m = 'RED'
-        elif m.startswith('MOV'): m = 'MOV'
-        else: raise Exception('unknown averaging mode: %s' % m)
-        return m
+        return self._parse_average_mode(self._visainstrument.ask('AVER:MODE?'))
 
     def do_set_average_mode(self, m):
         logging.debug(__name__ + ' : set averaging mode to %s' % m)
@@ -698,7 +740,7 @@ class RhodeSchwartz_ZNB20(Instrument):
     
     def do_get_sweep_mode(self):
         logging.debug('Getting sweep mode.')
-        return 'cont' if self._visainstrument.ask('INIT:CONT?').strip().lower() in ['1'] else 'single'
+        return self._parse_sweep_mode(self._visainstrument.ask('INIT:CONT?'))
 
     def do_set_sweep_mode(self, val):
         logging.debug('Setting sweep mode: %s' % val)
@@ -708,7 +750,7 @@ class RhodeSchwartz_ZNB20(Instrument):
 
     def do_get_external_reference(self):
         logging.debug('Getting ext ref mode.')
-        return self._visainstrument.ask('SENS:ROSC:SOUR?').lower().startswith('ext')
+        return self._parse_external_reference(self._visainstrument.ask('SENS:ROSC:SOUR?'))
 
     def do_set_external_reference(self, val):
         logging.debug('Setting ext ref: %s' % val)
@@ -729,12 +771,7 @@ class RhodeSchwartz_ZNB20(Instrument):
 
     def do_get_trigger_source(self, channel_number = 1):
         logging.debug('Getting trigger source.')
-        r = self._visainstrument.ask('TRIGGER%s:SEQUENCE:SOURCE?'%channel_number).lower().strip()
-        if r.startswith('lin') or r.startswith('rtc'):
-          r = r[:4]
-        else:
-          r = r[:3]
-        return r
+        return self._parse_trigger_source(self._visainstrument.ask('TRIGGER%s:SEQUENCE:SOURCE?'%channel_number))
 
     def do_set_trigger_source(self, val, channel_number = 1):
         logging.debug('Setting trigger source: %s' % val)
@@ -742,7 +779,7 @@ class RhodeSchwartz_ZNB20(Instrument):
 
     def do_get_sweep_type(self):
         logging.debug('Getting sweep type')
-        return self._visainstrument.ask('SWE:TYPE?').upper().strip()
+        return self._parse_upper(self._visainstrument.ask('SWE:TYPE?'))
 
     def do_set_sweep_type(self, sw_type):
         logging.debug('Setting sweep type: %s' % sw_type)
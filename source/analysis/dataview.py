@@ -30,7 +30,8 @@ from collections import OrderedDict
 
 from gettext import gettext as _L
 
-from lib import namedlist, temp
+from lib import namedlist, temp, loopdetect
+from lib.file_support import snapshot
 from lib.misc import dict_to_ordered_tuples, get_arg_type
 from lib.config import get_config
 config = get_config()
@@ -397,9 +398,9 @@ class DataView():
         Note that the indices are relative to the currently _unmasked_ rows only.
         '''
         sdim = self[sweep_dimension]
-        dx = np.sign(sdim[1:] - sdim[:-1])
 
         if use_sweep_direction == None:
+          dx = np.sign(sdim[1:] - sdim[:-1])
           use_sweep_direction = ( np.abs(dx).astype(np.int).sum() > len(dx)/4. )
 
         if use_sweep_direction:
@@ -407,32 +408,7 @@ class DataView():
         else:
           logging.info("Assuming '%s' stays constant within a sweep." % sweep_dimension)
 
-        if use_sweep_direction:
-          for i in range(1,len(dx)):
-              if i+1 < len(dx) and dx[i] == 0: dx[i]=dx[i+1] # this is necessary to detect changes in direction, when the end point is repeated
-          change_in_sign = (2 + np.array(np.where(dx[1:] * dx[:-1] < 0),dtype=np.int).reshape((-1))).tolist()
-
-          # the direction changing twice in a row means that sweeps are being done repeatedly
-          # in the same direction.
-          for i in range(len(change_in_sign)-1, 0, -1):
-            if change_in_sign[i]-change_in_sign[i-1] == 1: del change_in_sign[i]
-
-          if len(change_in_sign) == 0: return np.array([[0, len(sdim)]])
-
-          start_indices = np.concatenate(([0], change_in_sign))
-          stop_indices  = np.concatenate((change_in_sign, [len(sdim)]))
-
-          sweeps = np.concatenate((start_indices, stop_indices)).reshape((2,-1)).T
-        else:
-          change_in_sdim = 1 + np.array(np.where(dx != 0)).reshape((-1))
-          if len(change_in_sdim) == 0: return np.array([[0, len(sdim)]])
-
-          start_indices = np.concatenate(([0], change_in_sdim))
-          stop_indices  = np.concatenate((change_in_sdim, [len(sdim)]))
-        
-          sweeps = np.concatenate((start_indices, stop_indices)).reshape((2,-1)).T
-
-        return sweeps
+        return loopdetect.find_sweeps(sdim, use_sweep_direction)
 
     def mask_sweeps(self, sweep_dimension, sl, unmask_instead=False):
         '''
@@ -631,6 +607,14 @@ class DataView():
         logging.exception("Could not determine .set path from '%s'." % str(data))
         raise
 
+      # use the structured snapshot if available, it does not need parsing
+      snap = snapshot.load(set_path)
+      if snap != None:
+        metadata, settings = snap
+        parsed_settings = dict(settings)
+        parsed_settings['header'] = {'comments' : 'Filename: %s\nTimestamp: %s\n\n' % (metadata['filename'], metadata['timestamp'])}
+        return parsed_settings
+
       try:
         with open(set_path, 'r') as f:
           settings_string = f.read()
@@ -25,14 +25,22 @@ import types
 import re
 import logging
 import copy
+import itertools
 import shutil
-import pickle
 import sys
 import traceback
 
 from gettext import gettext as _L
 
-from lib import namedlist, temp
+from lib import namedlist, temp, loopdetect
+from lib.growarray import GrowableArray
+from lib.file_support.datfile import DatParser
+from lib.file_support.datcache import DataCache
+from lib.file_support import binfile
+from lib.file_support import spyview
+from lib.file_support import snapshot
+from lib.file_support.asyncwriter import AsyncWriter
+from lib.file_support.flushpolicy import FlushPolicy
 from lib.misc import dict_to_ordered_tuples, get_arg_type
 from lib.config import get_config
 config = get_config()
@@ -88,8 +96,12 @@ class DateTimeGenerator:
         tstr = time.strftime('%H%M%S', data_obj._localtime)
         filename = '%s_%s.dat' % (tstr, data_obj._name)
 
+        data_file_format = config.get('data_file_format', 'dat')
+        assert data_file_format in ['dat', 'bin'], 'Unknown data file format %s' % data_file_format
         data_compression_format = config.get('data_compression_format', None)
-        if data_compression_format != None:
+        if data_file_format == 'bin':
+            filename += binfile.EXTENSION
+        elif data_compression_format != None:
             assert data_compression_format in ['gz'], 'Unknown compression format %s' % data_compression_format
             filename += '.' + data_compression_format
 
@@ -226,6 +238,9 @@ class Data(SharedGObject):
             numpy.int16, numpy.int32, numpy.int64,
     )
 
+    # Number of rows formatted at once when writing blocks of data
+    _WRITE_CHUNK_ROWS = 10000
+
     def __init__(self, *args, **kwargs):
         '''
         Create data object. There are three different uses:
@@ -251,17 +266,40 @@ class Data(SharedGObject):
             tempfile (bool), default False. If True create a temporary file
                 for the data.
             binary (bool), default True. Whether tempfile should be binary.
-            cache_path, default None. If specified, create a binary temp file
-                             in the specified directory after loading the data.
-                             Or if it already exists, load the data
-                             directly from it.
-            overwrite_cache, default False. Overwrite an existing cache file, if it exists.
+            cache_path, default 'data_cache_path' from config, or None.
+                             If specified, store the parsed data in the
+                             specified cache directory after loading the
+                             file. If the file was loaded before and did
+                             not change since, load the data directly from
+                             the cache.
+            overwrite_cache, default False. Overwrite an existing cache entry, if it exists.
+            cache_max_size, maximum size of the cache directory in bytes,
+                            least recently used entries are removed.
+                            Default 'data_cache_max_size' from config,
+                            or 2 GB. Use 0 for no limit.
+            cache_mmap, default True. Memory-map data loaded from the cache.
             row_mask, optional list of booleans that specifies which rows
                       from an existing data file are loaded. If None, all
                       rows are loaded. All rows beyond len(row_mask) are
                       ignored.
               True  --> the data point (row) is loaded
               False --> the data point (row) is ignored
+            flush_rows (int), flush the data file after this many rows have
+                been written. Default is 'data_flush_rows' from config,
+                or 0 (disabled).
+            flush_interval (float), flush the data file if this many seconds
+                passed since the last flush. Default is 'data_flush_interval'
+                from config, or 1.0. Use 0 to flush after every write.
+            async_write (bool), format and write data in a background
+                thread, so that add_data_point() does not wait for the
+                disk. Errors are raised by the next call that writes.
+                Default is 'data_async_write' from config, or False.
+            async_queue_size (int), maximum number of queued writes before
+                add_data_point() waits. Default 'data_async_queue_size'
+                from config, or 1000.
+            spyview_meta (bool), write a .meta.txt file for spyview next to
+                the data file. Default is 'data_spyview_meta' from config,
+                or False. See add_data_point() for the meta option.
         '''
 
         # Init SharedGObject a bit lower
@@ -269,26 +307,53 @@ class Data(SharedGObject):
         name = kwargs.get('name', '')
         infile = kwargs.get('infile', True)
         inmem = kwargs.get('inmem', False)
-        self._cache_path = kwargs.get('cache_path', None)
+        self._cache_path = kwargs.get('cache_path',
+                config.get('data_cache_path', None))
         self._overwrite_cache = kwargs.get('overwrite_cache', False)
+        self._cache_max_size = kwargs.get('cache_max_size',
+                config.get('data_cache_max_size', 2**31))
+        self._cache_mmap = kwargs.get('cache_mmap', True)
         self._load_row_mask = kwargs.get('row_mask')
         self._inmem = inmem
         self._tempfile = kwargs.get('tempfile', False)
         self._temp_binary = kwargs.get('binary', True)
         self._options = kwargs
         self._file = None
+        self._data_buffer = None
+        self._load_parser = None
+        self._parsed_dimensions = None
+        self._follow_hid = None
+        self._write_precision = None
+        self._row_formats = {}
+        self._flush_policy = FlushPolicy(self.flush,
+                kwargs.get('flush_rows', config.get('data_flush_rows', 0)),
+                kwargs.get('flush_interval',
+                    config.get('data_flush_interval', 1.0)))
+        self._async_write = kwargs.get('async_write',
+                config.get('data_async_write', False))
+        self._async_queue_size = kwargs.get('async_queue_size',
+                config.get('data_async_queue_size', 1000))
+        self._writer = None
+        self._spyview_meta = kwargs.get('spyview_meta',
+                config.get('data_spyview_meta', False))
+        self._spyview = None
+        self._spyview_nblocks = 0
+        self._first_point = None
+        self._block_first_point = None
+        self._last_point = None
         self._log_file_handler = None
         self._stop_req_hid = None
 
         # Dimension info
         self._dimensions = []
         self._block_sizes = []
+        # Block sizes as written to / read from the file, None if unknown
+        self._raw_block_sizes = []
         self._loopdims = None
         self._loopshape = None
         self._complete = False
         self._reshaped_data = None
         self._meta_npoints = 0
-        self._meta_first_point = None
 
         # Number of coordinate dimensions
         self._ncoordinates = 0
@@ -583,6 +648,8 @@ class Data(SharedGObject):
                 precision (int): precision of stored data, default is
                     'default_precision' from config, or 12 if not defined.
                 format (string): format of stored data, not used by default
+                start, end (float): first and last value, used together
+                    with size for the spyview meta file
         '''
 
         kwargs['name'] = name
@@ -591,6 +658,7 @@ class Data(SharedGObject):
             kwargs['size'] = 0
         self._ncoordinates += 1
         self._dimensions.append(kwargs)
+        self._row_formats = {}
 
     def add_value(self, name, **kwargs):
         '''
@@ -611,12 +679,16 @@ class Data(SharedGObject):
         kwargs['type'] = 'value'
         self._nvalues += 1
         self._dimensions.append(kwargs)
+        self._row_formats = {}
 
     def add_comment(self, comment):
         '''Add comment to the Data object.'''
         self._comment.append([self.get_npoints(), comment])
-        if self._file is not None:
-            self._file.write('# %s\n' % comment.replace('\n', "\n%s" % (self._META_NEWLINE_IN_COMMENT)))
+        if self._is_binary_file():
+            self._write_binary_index(self._file.add_comment,
+                    self.get_npoints(), comment)
+        elif self._file is not None:
+            self._write_text(self._format_comment(comment))
 
     def get_comment(self, include_row_numbers=False):
         '''Return the comment for the Data object.'''
@@ -637,6 +709,10 @@ class Data(SharedGObject):
 
         This function should be called after adding the comment and the
         coordinate and value metadata, because it writes the file header.
+
+        If the filename ends with '.bin' a binary data file is created,
+        see lib/file_support/binfile.py. The default filename is chosen
+        according to the 'data_file_format' config setting ('dat' or 'bin').
         '''
 
         if name is None and filepath is None:
@@ -645,17 +721,39 @@ class Data(SharedGObject):
         if filepath is None:
             filepath = self._filename_generator.new_filename(self)
 
+        self._stop_writer()
+
         self._dir, self._filename = os.path.split(filepath)
         if not os.path.isdir(self._dir):
             os.makedirs(self._dir)
 
         try:
-            self._file = _open_dat_file(self.get_filepath(), 'w+')
+            if binfile.is_binary_file(self._filename):
+                self._file = binfile.BinFileWriter(self.get_filepath(),
+                        len(self._dimensions))
+            else:
+                self._file = _open_dat_file(self.get_filepath(), 'w+')
         except:
             logging.exception('Unable to open file')
             return False
 
+        self._row_formats = {}
         self._write_header()
+        self.flush()
+
+        if self._async_write:
+            rows, interval = self._flush_policy.get()
+            self._writer = AsyncWriter(self._flush_file,
+                    maxsize=self._async_queue_size,
+                    flush_rows=rows,
+                    flush_interval=interval,
+                    name='Data writer %s' % self._name)
+            self._writer.start()
+
+        self._spyview = None
+        if self._spyview_meta:
+            self._create_spyview_meta()
+        self.flush()
 
         if settings_file and in_qtlab:
             self._write_settings_file()
@@ -702,8 +800,15 @@ class Data(SharedGObject):
             self._log_file_handler = None
 
         if self._file is not None:
-            self._file.close()
-            self._file = None
+            try:
+                self.flush()
+                self._stop_writer()
+            finally:
+                self._file.close()
+                self._file = None
+
+        if self._spyview is not None:
+            self._update_spyview_meta(None, self._spyview_nblocks)
 
         if self._stop_req_hid is not None and in_qtlab:
             qt.flow.disconnect(self._stop_req_hid)
@@ -726,21 +831,46 @@ class Data(SharedGObject):
         logging.debug('Added log_file_handler. path="%s", formatter="%s"' % (fn, str(formatter)))
 
     def _write_settings_file(self):
-        fn = self.get_settings_filepath()
-        f = open(fn, 'w+')
-        f.write('Filename: %s\n' % self._filename)
-        f.write('Timestamp: %s\n\n' % self._timestamp)
+        '''
+        Capture the instrument settings and write the .set and .set.json
+        files in the background, see lib/file_support/snapshot.py.
+        '''
+
+        settings = snapshot.capture(qt.instruments.get_instruments())
+        snapshot.get_writer().write(self.get_settings_filepath(),
+                self._filename, self._timestamp, settings)
+
+    def _is_binary_file(self):
+        '''Return whether the open data file is a binary file.'''
+        return isinstance(self._file, binfile.BinFileWriter)
 
-        inslist = dict_to_ordered_tuples(qt.instruments.get_instruments())
-        for (iname, ins) in inslist:
-            f.write('Instrument: %s\n' % iname)
-            parlist = dict_to_ordered_tuples(ins.get_parameters())
-            for (param, popts) in parlist:
-                f.write('\t%s: %s\n' % (param, ins.get(param, query=False)))
+    def _get_binary_header(self):
+        return {
+            'filename': self._filename,
+            'timestamp': self._timestamp,
+            'dimensions': self._dimensions,
+        }
 
-        f.close()
+    def _write_binary_index(self, func, *args):
+        '''
+        Call func(*args) to add to the index of a binary data file, in
+        order with the rows written.
+        '''
+        if self._writer is not None:
+            self._writer.put(func, args, 0)
+        else:
+            func(*args)
 
     def _write_header(self):
+        if self._is_binary_file():
+            try:
+                self._file.write_header(self._get_binary_header())
+            except ValueError, e:
+                logging.error('Unable to write header: %s', e)
+            self._write_binary_index(self._file.write_index,
+                    list(self._comment), list(self._block_sizes))
+            return
+
         self._file.write('# Filename: %s\n' % self._filename)
         self._file.write('# Timestamp: %s\n\n' % self._timestamp)
         for rowno,line in self._comment:
@@ -755,21 +885,59 @@ class Data(SharedGObject):
 
         self._file.write('\n')
 
-    def _format_data_value(self, val, colnum):
-        if type(val) in self._INT_TYPES:
-            return '%d' % val
+    def _get_block_columns(self):
+        ncoords = self.get_ncoordinates()
+        blockcols = [False] * (ncoords + self.get_nvalues())
+        if len(self._data) > 1 and ncoords > 0:
+            data = numpy.asarray(self._data)
+            same = data[0,:ncoords] == data[1,:ncoords]
+            blockcols[:len(same)] = same.tolist()
+
+        return blockcols
+
+    def _format_comment(self, comment):
+        return '# %s\n' % comment.replace('\n', "\n%s" % (self._META_NEWLINE_IN_COMMENT))
+
+    def _get_column_format(self, colnum):
+        '''Return the format used for non-integer values in column colnum.'''
+
+        if self._write_precision is not None:
+            return '%%.%de' % self._write_precision
 
         if colnum < len(self._dimensions):
             opts = self._dimensions[colnum]
             if 'format' in opts:
-                return opts['format'] % val
+                return opts['format']
             elif 'precision' in opts:
-                format = '%%.%de' % opts['precision']
-                return format % val
+                return '%%.%de' % opts['precision']
 
         precision = config.get('default_precision', 12)
-        format = '%%.%de' % precision
-        return format % val
+        return '%%.%de' % precision
+
+    def _format_data_value(self, val, colnum):
+        if type(val) in self._INT_TYPES:
+            return '%d' % val
+        return self._get_column_format(colnum) % val
+
+    def _get_row_format(self, int_cols):
+        '''
+        Return the format string for a complete line of data, including
+        the newline. int_cols is a tuple of booleans indicating which
+        columns contain integers. Formats are cached until the dimensions
+        change.
+        '''
+
+        fmt = self._row_formats.get(int_cols)
+        if fmt is None:
+            fmts = []
+            for colnum, is_int in enumerate(int_cols):
+                if is_int:
+                    fmts.append('%d')
+                else:
+                    fmts.append(self._get_column_format(colnum))
+            fmt = '\t'.join(fmts) + '\n'
+            self._row_formats[int_cols] = fmt
+        return fmt
 
     def _write_data_line(self, args):
         '''
@@ -777,62 +945,231 @@ class Data(SharedGObject):
         Args can be a single value or a 1d numpy.array / list / tuple.
         '''
 
-        if hasattr(args, '__len__'):
-            if len(args) > 0:
-                line = self._format_data_value(args[0], 0)
-                for colnum in range(1, len(args)):
-                    line += '\t%s' % \
-                            self._format_data_value(args[colnum], colnum)
-            else:
-                line = ''
-        else:
-            line = self._format_data_value(args, 0)
-
-        line += '\n'
+        if not hasattr(args, '__len__'):
+            args = (args,)
 
         if self._file is None:
             logging.info('File not opened yet, doing now')
             self.create_file()
 
-        self._file.write(line)
-        self._file.flush()
+        self._write_formatted(self._format_data_line, tuple(args))
 
-    def _get_block_columns(self):
-        blockcols = []
-        for i in range(self.get_ncoordinates()):
-            if len(self._data) > 1 and self._data[0][i] == self._data[1][i]:
-                blockcols.append(True)
-            else:
-                blockcols.append(False)
-        for i in range(self.get_nvalues()):
-            blockcols.append(False)
+    def _format_data_line(self, args):
+        int_cols = tuple([type(val) in self._INT_TYPES for val in args])
+        yield self._get_row_format(int_cols) % args, 1
 
-        return blockcols
+    def _write_data_rows(self, rows):
+        '''
+        Write several lines of data at once.
+        Rows can be a 2d numpy.array or a list of rows, a 1d array is
+        written as a single column. Rows are formatted in chunks using
+        a single format operation per chunk.
+        '''
+
+        if self._writer is not None:
+            rows = numpy.array(rows)
+        self._write_formatted(self._format_data_rows, rows)
+
+    def _format_data_rows(self, rows):
+        rows = numpy.asarray(rows)
+        if rows.ndim < 2:
+            rows = rows.reshape((len(rows), -1))
+
+        int_cols = (rows.dtype.kind in 'iu', ) * rows.shape[1]
+        fmt = self._get_row_format(int_cols)
+        for start in range(0, len(rows), self._WRITE_CHUNK_ROWS):
+            chunk = rows[start:start + self._WRITE_CHUNK_ROWS]
+            yield (fmt * len(chunk)) % tuple(chunk.ravel().tolist()), len(chunk)
+
+    def _write_data_columns(self, columns):
+        '''
+        Write several lines of data, specified as a list of 1d columns of
+        equal length. Columns may have different types, integer columns
+        are written as such.
+        '''
+
+        if self._writer is not None:
+            columns = [numpy.array(col) for col in columns]
+        self._write_formatted(self._format_data_columns, columns)
+
+    def _format_data_columns(self, columns):
+        columns = [numpy.asarray(col) for col in columns]
+        int_cols = tuple([col.dtype.kind in 'iu' for col in columns])
+        fmt = self._get_row_format(int_cols)
+        nrows = len(columns[0])
+        for start in range(0, nrows, self._WRITE_CHUNK_ROWS):
+            stop = min(start + self._WRITE_CHUNK_ROWS, nrows)
+            rows = zip(*[col[start:stop].tolist() for col in columns])
+            text = (fmt * (stop - start)) % \
+                    tuple(itertools.chain.from_iterable(rows))
+            yield text, stop - start
+
+    def _write_binary_rows(self, rows):
+        '''Write a 2d array of rows to a binary data file.'''
+        rows = numpy.array(rows, dtype=binfile.DTYPE)
+        self._write_text(rows.tostring(), len(rows))
+
+    def _write_formatted(self, func, *args):
+        '''
+        Write the text generated by func(*args), which yields (text, number
+        of rows) tuples. With a background writer the formatting is done
+        in the writer thread as well.
+        '''
+
+        if self._writer is not None:
+            self._writer.put(self._write_chunks, (self._file, func, args))
+        else:
+            for text, nrows in func(*args):
+                self._write_text(text, nrows)
+
+    def _write_chunks(self, f, func, args):
+        '''Write the text generated by func(*args) to f, return the number of rows.'''
+        nrows = 0
+        for text, n in func(*args):
+            f.write(text)
+            nrows += n
+        return nrows
+
+    def _write_text(self, text, nrows=0):
+        '''
+        Write text to the data file and flush it according to the flush
+        policy. nrows is the number of data lines contained in text.
+        '''
+
+        if self._writer is not None:
+            self._writer.put(self._file.write, (text,), nrows)
+            return
+
+        self._file.write(text)
+        self._flush_policy.add_rows(nrows)
+
+    def flush(self):
+        '''
+        Flush data written so far to disk. With a background writer the
+        flush is queued after the pending writes, use drain() to wait.
+        '''
+
+        self._flush_policy.flushed()
+        if self._writer is not None:
+            self._writer.flush()
+        else:
+            self._flush_file()
+
+    def _flush_file(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def drain(self):
+        '''Wait until the background writer wrote all queued data.'''
+        if self._writer is not None:
+            self._writer.drain()
+
+    def _stop_writer(self):
+        '''Write all queued data and stop the background writer.'''
+        if self._writer is not None:
+            writer = self._writer
+            self._writer = None
+            writer.close()
+
+    def get_write_stats(self):
+        '''
+        Return statistics of the background writer (see
+        AsyncWriter.get_stats()), e.g. the queue depth and the time per
+        write, or None if data is written directly.
+        '''
+        if self._writer is None:
+            return None
+        return self._writer.get_stats()
+
+    def set_flush_policy(self, rows=None, interval=None):
+        '''
+        Set when the data file is flushed. The file is always flushed at
+        the start of a new block and when it is closed.
+
+        Input:
+            rows (int): flush after this many rows, 0 to disable
+            interval (float): flush if this many seconds passed since the
+                last flush, 0 to flush after every write
+        '''
+
+        self._flush_policy.set(rows, interval)
+        if self._writer is not None:
+            self._writer.set_flush_policy(*self._flush_policy.get())
+
+    def get_flush_policy(self):
+        '''Return the flush policy as a (rows, interval) tuple.'''
+        return self._flush_policy.get()
 
     def _write_data(self):
         if not self._inmem:
             logging.warning('Unable to _write_data() without having it in memory')
             return False
 
-        blockcols = self._get_block_columns()
+        data = numpy.asarray(self._data)
+        if data.ndim < 2:
+            data = data.reshape((len(data), -1))
+        npoints = len(data)
+        breaks = self._get_block_breaks(data)
+
+        if self._is_binary_file():
+            block_sizes = []
+            last = 0
+            for rowno in sorted(breaks.keys()):
+                block_sizes.append(rowno - last)
+                block_sizes.extend([0] * (breaks[rowno] - 1))
+                last = rowno
+            self._write_binary_index(self._file.write_index,
+                    list(self._comment), block_sizes)
+            self._write_binary_rows(data)
+            self.flush()
+            return True
 
-        non_header_comments = filter(lambda rowno,commentstr: rowno!=0, self._comments)
-        non_header_comments_rowno = np.array([rowno for rowno,commentstr in non_header_comments])
-        non_header_comments_commentstr = [commentstr for rowno,commentstr in non_header_comments]
+        # Comments preceding each row, header comments are already written
+        comments = {}
+        for rowno, commentstr in self._comment:
+            if rowno != 0:
+                comments.setdefault(min(rowno, npoints), []).append(commentstr)
+
+        splits = set(breaks.keys()) | set(comments.keys()) | set([npoints])
+        start = 0
+        for rowno in sorted(splits):
+            if rowno > start:
+                self._write_data_rows(data[start:rowno])
+                start = rowno
+            if rowno in breaks:
+                self._write_text('\n' * breaks[rowno])
+            for commentstr in comments.get(rowno, []):
+                self._write_text(self._format_comment(commentstr))
+
+        self.flush()
+        return True
+
+    def _get_block_breaks(self, data):
+        '''
+        Return a dict with the number of empty lines to write before rows
+        of data. The block sizes of the file the data was loaded from are
+        used if possible. Otherwise there is one empty line for every
+        coordinate column that is constant within a block and changes at
+        that row.
+        '''
 
-        lastvals = None
-        for rowno, vals in enumerate(self._data):
-            if type(vals) is numpy.ndarray and lastvals is not None:
-                for i in range(len(vals)):
-                    if blockcols[i] and vals[i] != lastvals[i]:
-                        self._file.write('\n')
+        breaks = {}
+        npoints = len(data)
 
-            # write comments preceding the data point, if any.
-            for commentind in np.where(non_header_comments_rowno == rowno):
-                self._file.write('# %s\n' % line)
+        raw = self._raw_block_sizes
+        if raw is not None and len(raw) > 0 and sum(raw) <= npoints:
+            for rowno in numpy.cumsum(raw).tolist():
+                breaks[rowno] = breaks.get(rowno, 0) + 1
+            return breaks
 
-            self._write_data_line(vals)
-            lastvals = vals
+        ncoords = min(self.get_ncoordinates(), data.shape[1])
+        if npoints > 1 and ncoords > 0:
+            blockcols = numpy.flatnonzero(data[0,:ncoords] == data[1,:ncoords])
+            if len(blockcols) > 0:
+                nchanged = (data[1:,blockcols] != data[:-1,blockcols]).sum(axis=1)
+                for rowno in numpy.flatnonzero(nchanged):
+                    breaks[rowno + 1] = int(nchanged[rowno])
+        return breaks
 
     def _write_binary(self):
         if not self._inmem:
@@ -850,16 +1187,29 @@ class Data(SharedGObject):
 
 ### High-level file writing
 
-    def write_file(self, name=None, filepath=None):
+    def write_file(self, name=None, filepath=None, precision=None, **kwargs):
         '''
         Create and write a new data file.
+
+        Input:
+            name, filepath: see create_file()
+            precision (int): if specified, write all columns with this
+                precision instead of the precision of the dimensions.
+                Use 16 to store float64 values without loss.
+            kwargs: passed on to create_file()
         '''
 
-        if not self.create_file(name=name, filepath=filepath):
-            return
+        self._write_precision = precision
+        self._row_formats = {}
+        try:
+            if not self.create_file(name=name, filepath=filepath, **kwargs):
+                return
 
-        self._write_data()
-        self.close_file()
+            self._write_data()
+            self.close_file()
+        finally:
+            self._write_precision = None
+            self._row_formats = {}
 
     def create_tempfile(self, path=None):
         '''
@@ -943,6 +1293,7 @@ class Data(SharedGObject):
         '''
 
         # Check what type of data is being added
+        columns = None
         shapes = [numpy.shape(i) for i in args]
         dims = numpy.array([len(i) for i in shapes])
 
@@ -974,6 +1325,7 @@ class Data(SharedGObject):
             if sum(dims!=1) == 0:
                 ncols = len(args)
                 npoints = shapes[0][0]
+                columns = args
                 # Transpose args to a single 2-d list
                 args = zip(*args)
             elif sum(dims!=0) == 0:
@@ -1004,23 +1356,32 @@ class Data(SharedGObject):
         #   - a 1d tuple of numbers, for adding a single data point
         #   - a 2d tuple/list/array, for adding >1 data points
         if self._inmem:
-            if len(self._data) == 0:
-                self._data = numpy.atleast_2d(args)
-            else:
-                args_n_dims = len(numpy.array(args).shape)
-                if args_n_dims == 1:
-                  self._data = numpy.append(self._data, [args], axis=0)
-                elif args_n_dims == 2:
-                  self._data = numpy.append(self._data, args, axis=0)
-                else:
-                  assert False, 'args should not have more than 2 dimensions here...'
+            self._append_rows(numpy.reshape(args, (npoints, ncols)))
 
         if self._infile:
-            if npoints == 1:
+            if self._file is None:
+                logging.info('File not opened yet, doing now')
+                self.create_file()
+            if self._is_binary_file():
+                self._write_binary_rows(numpy.reshape(args, (npoints, ncols)))
+            elif npoints == 1:
                 self._write_data_line(args)
             elif npoints > 1:
-                for i in range(npoints):
-                    self._write_data_line(args[i])
+                if columns is not None:
+                    self._write_data_columns(columns)
+                else:
+                    self._write_data_rows(args)
+
+        if 'meta' in kwargs and kwargs['meta']:
+            self._spyview_meta = True
+        if self._spyview_meta:
+            # Keep track of the points needed for the spyview meta file
+            rows = numpy.reshape(args, (npoints, ncols))
+            if self._first_point is None:
+                self._first_point = rows[0]
+            if self._npoints_last_block == 0:
+                self._block_first_point = rows[0]
+            self._last_point = rows[-1]
 
         self._npoints += npoints
         self._npoints_last_block += npoints
@@ -1030,68 +1391,150 @@ class Data(SharedGObject):
         if 'newblock' in kwargs and kwargs['newblock']:
             self.new_block()
         if 'meta' in kwargs and kwargs['meta']:
+            # Every call is one block (e.g. a trace) of the spyview file
             self._meta_npoints += 1
-            if self._meta_first_point is None:
-                self._meta_first_point = args[0][0]
-            coordinates = self.get_coordinates()
-            if len(coordinates)==2:
-                inner_string = '%s %s' % (coordinates[1]['name'], coordinates[1]['units'])
-                outer_string = '%s %s' % (coordinates[0]['name'], coordinates[0]['units'])
-            elif len(coordinates)==1:
-                inner_string = '%s %s' % (coordinates[0]['name'], coordinates[0]['units'])
-                outer_string = None                
-            self.generate_meta_file(npoints, args[0][1], args[-1][1], inner_string, self._meta_npoints, self._meta_first_point, args[-1][0], outer_string)
+            self._update_spyview_meta(npoints, self._meta_npoints)
+            self._block_first_point = None
         else:
             self.emit('new-data-point')
 
+    def _append_rows(self, rows):
+        '''
+        Append rows to the in-memory data. The rows are stored in a
+        GrowableArray, self._data is kept as a view on the filled part.
+        '''
+
+        # Re-seed the buffer if self._data was replaced, e.g. by set_data()
+        if self._data_buffer is None or \
+                not self._data_buffer.is_view(self._data):
+            self._data_buffer = GrowableArray(self._data)
+
+        self._data_buffer.append(rows)
+        self._data = self._data_buffer.get_view()
+        self._reshaped_data = None
+
     def generate_meta_file(self, npoints, first, last, inner_string, out_npoints, out_first, out_last, outer_string):
         '''Generate Meta file for spyview.'''
-        metafile = open('%s.meta.txt' % self.get_filepath()[:-4], 'w')
-        metafile.write('#inner loop\n%s\n%s\n%s\n%s\n'%
-                (npoints, first, last, inner_string))
+        loops = [(npoints, first, last, inner_string)]
         if outer_string is not None:
-            metafile.write('#outer loop\n%s\n%s\n%s\n%s\n'%
-                    (out_npoints, out_last, out_first, outer_string))
-        else:
-            metafile.write('#outer loop unused\n1\n0\n1\nNothing\n')
-        metafile.write('#outermost loop (unused)\n1\n0\n1\nNothing\n')
+            loops.append((out_npoints, out_last, out_first, outer_string))
+        spyview.write_meta(self.get_spyview_meta_filepath(), loops,
+                self._get_spyview_values())
 
-        metafile.write('#for each of the values\n')
-        values = self.get_values()
-        i=0
-        while i<len(values):
-            metafile.write('%d\n%s\n'% (i+3, values[i]['name']))
-            i+=1
-        metafile.close()
+    def metagen2D(self, in_meta, out_meta):
+        '''
+        Generate Meta file for spyview, in_meta and out_meta are
+        (first, last, npoints, label) tuples.
+        '''
+        loops = [(in_meta[2], in_meta[0], in_meta[1], in_meta[3]),
+                (out_meta[2], out_meta[0], out_meta[1], out_meta[3])]
+        spyview.write_meta(self.get_spyview_meta_filepath(), loops,
+                self._get_spyview_values())
 
+    def get_spyview_meta_filepath(self):
+        return self.get_filepath(without_extension=True) + '.meta.txt'
 
-    def metagen2D(self, in_meta, out_meta):
-        metafile = open('%s.meta.txt' %self.get_filepath()[:-4], 'w')
-        metafile.write('#inner loop\n%s\n%s\n%s\n%s\n'%
-            (in_meta[2], in_meta[0], in_meta[1], in_meta[3]))
-        metafile.write('#outer loop\n%s\n%s\n%s\n%s\n'%
-            (out_meta[2], out_meta[0], out_meta[1], out_meta[3]))
-        metafile.write('#outermost loop (unused)\n1\n0\n1\nNothing\n')
-        metafile.write('#for each of the values\n')
-        values = self.get_values()
-        i=0
-        while i<len(values):
-            metafile.write('%d\n%s\n'% (i+3, values[i]['name']))
-            i+=1
-        metafile.close()
+    def _get_spyview_values(self):
+        '''Return (column number, name) tuples of the value dimensions.'''
+        return [(i + 1, dim['name']) for i, dim in enumerate(self._dimensions)
+                if dim.get('type') == 'value']
+
+    def _create_spyview_meta(self, blocksize=None):
+        '''
+        Create the spyview meta file. The last coordinate is the inner
+        loop and the first coordinate the outermost one, which is in
+        progress during the measurement. The other loops are taken from
+        the size, start and end of the coordinates; the inner loop can
+        also be taken from the first block, of size blocksize.
+        Returns False if the loops are not known yet.
+        '''
 
+        ncoords = self.get_ncoordinates()
+        if ncoords < 1 or ncoords > 3:
+            logging.warning('Spyview meta file requires 1 to 3 coordinates, not %d', ncoords)
+            self._spyview_meta = False
+            return False
 
+        loops = []
+        for colnum in reversed(range(ncoords)):
+            dim = self._dimensions[colnum]
+            label = ('%s %s' % (dim['name'], dim.get('units', ''))).strip()
+            loops.append([dim.get('size', 0), dim.get('start', None),
+                    dim.get('end', None), label])
+
+        # The outermost loop is updated after every block
+        start = loops[-1][1]
+        if start is None:
+            start = 0
+        loops[-1][:3] = [0, start, start]
+
+        for i, loop in enumerate(loops[:-1]):
+            if loop[0] > 0 and None not in loop[1:3]:
+                continue
+            colnum = ncoords - 1 - i
+            if i == 0 and blocksize is not None and \
+                    self._block_first_point is not None:
+                loop[:3] = [blocksize, self._block_first_point[colnum],
+                        self._last_point[colnum]]
+            elif i == 0:
+                return False
+            else:
+                logging.warning('Spyview meta file requires size, start and end of coordinate %s', loop[3])
+                self._spyview_meta = False
+                return False
 
+        self._spyview = spyview.MetaFile(self.get_spyview_meta_filepath(),
+                loops, self._get_spyview_values())
+        self._spyview.write()
+        return True
+
+    def _update_spyview_meta(self, blocksize, nblocks):
+        '''
+        Update the size and end of the outermost loop in the spyview meta
+        file, after a block of blocksize points was completed.
+        '''
+
+        if self._spyview is None and not self._create_spyview_meta(blocksize):
+            return
+        self._spyview_nblocks = nblocks
+
+        loops = self._spyview.get_loops()
+        if len(loops) == 1:
+            size = self._npoints
+        else:
+            size = nblocks
+            for loop in loops[1:-1]:
+                size /= loop[0]
+
+        if self._first_point is None:
+            return
+        start = self._first_point[0]
+        end = self._last_point[0]
+        if len(loops) > 1:
+            # Outer loops are written last value first
+            start, end = end, start
+        self._spyview.set_loop(len(loops) - 1, size, start, end)
 
     def new_block(self):
         '''Start a new data block.'''
 
-        if self._infile:
-            self._file.write('\n')
-
         self._block_sizes.append(self._npoints_last_block)
+        if self._raw_block_sizes is not None:
+            self._raw_block_sizes.append(self._npoints_last_block)
         self._npoints_last_block = 0
 
+        if self._infile:
+            if self._is_binary_file():
+                self._write_binary_index(self._file.add_block,
+                        self._block_sizes[-1])
+            else:
+                self._write_text('\n')
+            self.flush()
+
+            if self._spyview_meta and self._file is not None:
+                self._update_spyview_meta(self._block_sizes[-1],
+                        len(self._block_sizes))
+
         self.emit('new-data-block')
 
     def _add_missing_dimensions(self, nfields):
@@ -1129,6 +1572,7 @@ class Data(SharedGObject):
         self._infile = False
         self._npoints = len(self._data)
         self._block_sizes = []
+        self._raw_block_sizes = None
 
         # Add dimension information
         if len(data.shape) == 1:
@@ -1171,6 +1615,7 @@ class Data(SharedGObject):
         If the data is associated with a temporary file, it will be updated.
         '''
         self._data = data
+        self._raw_block_sizes = None
         if self._tempfile:
             self.rewrite_tempfile()
 
@@ -1188,123 +1633,165 @@ class Data(SharedGObject):
             self._nvalues = 1
             self._ncoordinates -= 1
 
-    def _load_file(self):
+    def _get_data_cache(self):
+        '''Return the DataCache to use when loading, or None.'''
+        if self._cache_path is None:
+            return None
+        return DataCache(self._cache_path,
+                max_size=self._cache_max_size, mmap=self._cache_mmap)
+
+    def _load_file(self, hold_partial=False):
         """
-        Load data from file and store internally.
+        Load data from file and store internally. If hold_partial is True,
+        an incomplete last line is not parsed.
         """
 
-        cache = None
+        if binfile.is_binary_file(self.get_filepath()):
+            return self._load_binary_file()
 
-        if self._cache_path != None:
-            cache_fname = os.path.join(self._cache_path, os.path.splitext(self._filename)[0]) + '_tmp.npz'
-            if not self._overwrite_cache:
-                try:
-                    cache = numpy.load(cache_fname)
-                    logging.info('Loaded data from cache file %s.' % cache_fname)
-                    if self._load_row_mask != None:
-                      logging.warn('The row_mask will be ignored since data is loaded from a cache file.')
-                except:
-                    logging.exception('Failed to load data from cache file %s', cache_fname)
+        cache = self._get_data_cache()
+        if cache is not None:
+            try:
+                cache_key = cache.get_key(self.get_filepath())
+            except Exception, e:
+                logging.warning('Unable to use data cache: %s', e)
+                cache = None
+
+        if cache is not None and not self._overwrite_cache:
+            cached = cache.load(self.get_filepath(), cache_key)
+            if cached is not None:
+                logging.info('Loaded data for %s from cache %s.',
+                        self.get_filepath(), cache.get_path())
+                self._load_from_cache(*cached)
+                return True
 
-        # read the header normally from the text file even if data was loaded from a cache
         try:
-          with _open_dat_file(self.get_filepath(), 'r') as f:
+          with _open_dat_file(self.get_filepath(), 'rb') as f:
 
             self._dimensions = []
             self._values = []
             self._comment = []
-            data = None
-            nfields = 0
 
             self._block_sizes = []
             self._npoints = 0
             self._npoints_last_block = 0
             self._npoints_max_block = 0
 
-            blocksize = 0
-
-            row_no = -1
-
-            if self._load_row_mask != None:
-                last_row_no_to_parse = self._load_row_mask.nonzero()[0][-1]
-
-            for line in f:
-
-                line = line.rstrip(' \n\t\r')
-
-                # Count blocks
-                if len(line) == 0 and data != None:
-                    self._block_sizes.append(blocksize)
-                    if blocksize > self._npoints_max_block:
-                        self._npoints_max_block = blocksize
-                    blocksize = 0
-
-                # Strip comment
-                commentpos = line.find('#')
-                if commentpos != -1:
-                    self._parse_meta_data(line, line_number = row_no+1 + (-1 if commentpos > 0 else 0))
-                    line = line[:commentpos]
-
-                fields = line.split()
-                if len(fields) > nfields:
-                    nfields = len(fields)
-
-                fields = [float(f) for f in fields]
-                if len(fields) > 0:
-
-                    row_no += 1
-                    if self._load_row_mask != None:
-                      if row_no > last_row_no_to_parse: break # stop parsing
-
-                      if not self._load_row_mask[row_no]:
-                        continue # skip this row
-
-                    if cache != None:
-                        # we are done parsing the header and the first data row
-                        # load rest from the cache and stop parsing the text file
-                        self._data = cache['data']
-                        self._comment = pickle.loads(cache['comment_pickled'])
-                        blocksize = cache['blocksize'][0]
-                        nfields = self._data.shape[1]
-                        break
-
-                    if data == None: # allocate a buffer for the data
-                        # estimate the (max) number of data rows from the file size
-                        n_lines_estimate = 1 + os.path.getsize(self.get_filepath()) / len(line)
-                        if not self.get_filepath().endswith('.dat'): n_lines_estimate *= 3 # compressed .dat file
-                        if self._load_row_mask != None: # We may not need that much space
-                            n_lines_estimate = numpy.min(( n_lines_estimate,
-                                                           self._load_row_mask.astype(numpy.bool).sum() ))
-                        data = numpy.empty((n_lines_estimate, len(fields))) + numpy.nan
-
-                    if row_no >= len(data):
-                        if self.get_filepath().endswith('.dat') or len(data) > 4*n_lines_estimate:
-                            logging.warn('Failed to estimate the number of data points correctly. '
-                                         'Allocating more space...')
-                        data_larger = numpy.empty(( int(numpy.ceil( 1.5*len(data) )), len(fields) )) + numpy.nan
-                        data_larger[:len(data),:] = data[:,:]
-                        data = data_larger
-
-                    data[row_no,:] = numpy.array(fields)
-                    blocksize += 1
+            # estimate the file size to reserve space for the data
+            size_hint = os.path.getsize(self.get_filepath())
+            if not self.get_filepath().endswith('.dat'): size_hint *= 3 # compressed .dat file
+
+            parser = DatParser(self._parse_meta_data,
+                    row_mask=self._load_row_mask,
+                    size_hint=size_hint)
+            parser.parse_file(f, hold_partial=hold_partial)
 
         except:
           logging.exception('Unable to open/parse file %s' % self.get_filepath())
           return False
 
-        self._add_missing_dimensions(nfields)
+        self._add_missing_dimensions(parser.nfields)
         self._count_coord_val_dims()
+        header_dimensions = copy.deepcopy(self._dimensions)
 
-        if cache == None:
-          if data == None:
-              data=numpy.array([[]])
-              logging.warn('Zero data points loaded from %s!', self.get_filename())
-          logging.info('Finished reading %d data points. (Debug: buffer size was %d points.)',
-                       1+row_no, len(data))
-          self._data = data[:1+row_no,:]
+        if not parser.started:
+            self._data = numpy.array([[]])
+            logging.warn('Zero data points loaded from %s!', self.get_filename())
+        else:
+            self._data_buffer = parser.get_buffer()
+            self._data = self._data_buffer.get_view()
+        logging.info('Finished reading %d data points.', 1+parser.row_no)
+
+        self._finish_loading(list(parser.block_sizes), parser.max_blocksize,
+                parser.blocksize)
+
+        # Keep the parser and the dimensions before size detection to
+        # continue reading in refresh()
+        self._load_parser = parser
+        self._parsed_dimensions = header_dimensions
+
+        # Only complete files are cached, the row_mask is applied when
+        # loading from the cache. A file with a held back last line was
+        # not parsed completely.
+        if cache is not None and self._load_row_mask is None and \
+                not parser.held_partial:
+            info = {
+                'header_dimensions': header_dimensions,
+                'dimensions': self._dimensions,
+                'comment': self._comment,
+                'raw_block_sizes': parser.block_sizes,
+                'block_sizes': self._block_sizes,
+                'npoints_last_block': self._npoints_last_block,
+                'npoints_max_block': self._npoints_max_block,
+                'ncoordinates': self._ncoordinates,
+                'nvalues': self._nvalues,
+                'loopdims': self._loopdims,
+                'loopshape': self._loopshape,
+                'complete': self._complete,
+            }
+            cache.store(self.get_filepath(), self._data, info, cache_key)
 
+        return True
+
+    def _load_binary_file(self):
+        '''
+        Load a binary data file. The data is memory-mapped, so only the
+        rows that are used are read.
+        '''
+
+        try:
+            data, info = binfile.load(self.get_filepath(), mmap=self._cache_mmap)
+        except:
+            logging.exception('Unable to open/parse file %s' % self.get_filepath())
+            return False
+
+        self._values = []
+        self._data_buffer = None
+        self._load_parser = None
+        self._parsed_dimensions = copy.deepcopy(info['dimensions'])
+
+        raw_block_sizes = info['block_sizes']
+        if self._load_row_mask is not None:
+            self._load_masked(data, info['dimensions'], info['comments'],
+                    raw_block_sizes)
+            return True
+
+        # The header can be ahead of the rows of a file that is being
+        # written, ignore blocks that end after the last row.
+        raw_block_sizes = [bs for bs in numpy.cumsum(raw_block_sizes)
+                if bs <= len(data)]
+        raw_block_sizes = numpy.diff([0] + raw_block_sizes).tolist()
+
+        self._dimensions = info['dimensions']
+        self._comment = [c for c in info['comments'] if c[0] <= len(data)]
+        self._count_coord_val_dims()
+
+        if len(data) == 0:
+            self._data = numpy.array([[]])
+            logging.warn('Zero data points loaded from %s!', self.get_filename())
+        else:
+            self._data = data
+        logging.info('Finished reading %d data points.', len(data))
+
+        self._finish_loading(raw_block_sizes, max(raw_block_sizes + [0]),
+                len(data) - sum(raw_block_sizes))
+        return True
+
+    def _finish_loading(self, block_sizes, max_blocksize, blocksize):
+        '''
+        Set the block information after self._data was loaded and detect
+        the dimension sizes.
+        '''
+
+        self._block_sizes = block_sizes
+        if self._load_row_mask is None:
+            self._raw_block_sizes = list(block_sizes)
+        else:
+            self._raw_block_sizes = None
+        self._npoints_max_block = max_blocksize
         self._npoints = len(self._data)
         self._inmem = True
+        self._reshaped_data = None
 
         logging.debug('Read %u data points.' % (len(self._data)))
 
@@ -1315,15 +1802,189 @@ class Data(SharedGObject):
         except Exception, e:
             logging.warning('Error while detecting dimension size')
 
-        if cache == None and self._cache_path != None:
+    def _load_from_cache(self, data, info):
+        '''Set the state from an entry of the data cache.'''
+
+        self._values = []
+        self._data_buffer = None
+        self._load_parser = None
+        self._parsed_dimensions = None
+
+        if self._load_row_mask is None:
+            self._data = data
+            self._dimensions = info['dimensions']
+            self._comment = info['comment']
+            self._ncoordinates = info['ncoordinates']
+            self._nvalues = info['nvalues']
+            self._block_sizes = info['block_sizes']
+            self._raw_block_sizes = list(info['raw_block_sizes'])
+            self._npoints_last_block = info['npoints_last_block']
+            self._npoints_max_block = info['npoints_max_block']
+            self._loopdims = info['loopdims']
+            self._loopshape = info['loopshape']
+            self._complete = info['complete']
+            self._npoints = len(self._data)
+            self._inmem = True
+            self._reshaped_data = None
+            return
+
+        self._load_masked(data, info['header_dimensions'], info['comment'],
+                info['raw_block_sizes'])
+
+    def _load_masked(self, data, dimensions, comments, raw_block_sizes):
+        '''
+        Set the state from all rows of a data file, applying the row mask
+        like the parser would: masked rows are NaN, rows after the last
+        selected one are dropped and blocks only count selected rows.
+        '''
+
+        mask = numpy.asarray(self._load_row_mask, dtype=bool)
+        kept = mask.nonzero()[0]
+        if len(kept) > 0:
+            nrows = min(kept[-1] + 1, len(data))
+        else:
+            nrows = 0
+        mask = mask[:nrows]
+
+        # Number of selected rows before each row (and after the last one)
+        nkept_before = numpy.concatenate(([0], numpy.cumsum(mask)))
+        ends = numpy.cumsum(raw_block_sizes, dtype=int)
+        ends = nkept_before[ends[ends <= nrows]]
+        ends = ends[ends > 0]
+        block_sizes = numpy.diff(numpy.concatenate(([0], ends))).tolist()
+        if len(ends) > 0:
+            blocksize = int(nkept_before[-1] - ends[-1])
+        else:
+            blocksize = int(nkept_before[-1])
+
+        self._dimensions = copy.deepcopy(dimensions)
+        self._comment = [c for c in comments if c[0] <= nrows]
+        self._count_coord_val_dims()
+
+        if nkept_before[-1] == 0:
+            self._data = numpy.array([[]])
+            logging.warn('Zero data points loaded from %s!', self.get_filename())
+        else:
+            self._data = numpy.array(data[:nrows])
+            self._data[~mask] = numpy.nan
+
+        self._finish_loading(block_sizes, max(block_sizes + [0]), blocksize)
+
+    def refresh(self):
+        '''
+        Read data that was added to the data file after it was loaded,
+        e.g. by a measurement that is still running. If possible only the
+        new lines are parsed, otherwise the file is loaded again.
+        Emits 'new-data-block' for every completed block and
+        'new-data-point' if there are new rows.
+
+        Output:
+            number of new rows
+        '''
+
+        if not self._inmem:
+            npoints = 0
+        else:
+            npoints = self._npoints
+        nblocks = self.get_nblocks_complete()
+
+        parser = self._load_parser
+        fp = self.get_filepath()
+        if parser is not None and self._can_continue_parsing(parser):
+            if parser.finished or os.path.getsize(fp) == parser.offset:
+                return 0
+            nblocks = len(parser.block_sizes)
+            if not self._continue_parsing(parser):
+                return 0
+            nnew = self._npoints - npoints
+            nnewblocks = len(parser.block_sizes) - nblocks
+        else:
+            logging.debug('Reloading %s', fp)
+            if not self._load_file(hold_partial=True):
+                return 0
+            nnew = self._npoints - npoints
+            nnewblocks = self.get_nblocks_complete() - nblocks
+
+        for i in range(nnewblocks):
+            self.emit('new-data-block')
+        if nnew > 0:
+            self.emit('new-data-point')
+
+        return nnew
+
+    def _can_continue_parsing(self, parser):
+        '''
+        Return whether refresh() can continue with the parser used to
+        load the data, i.e. the data was not modified and the file only
+        grew.
+        '''
+
+        fp = self.get_filepath()
+        if not self._inmem or parser.partial or fp.endswith('.gz'):
+            return False
+        if os.path.getsize(fp) < parser.offset:
+            return False
+
+        buf = parser.get_buffer()
+        if buf is None:
+            return len(self._data) <= 1 and numpy.size(self._data) == 0
+        return buf is self._data_buffer and buf.is_view(self._data) and \
+                len(buf) == parser.row_no + 1
+
+    def _continue_parsing(self, parser):
+        '''Parse lines added to the data file since the last time.'''
+
+        # Metadata is parsed into the dimensions as they were before the
+        # sizes were detected.
+        self._dimensions = self._parsed_dimensions
+        try:
+            f = open(self.get_filepath(), 'rb')
             try:
-                numpy.savez(cache_fname,
-                         data=self._data,
-                         blocksize=numpy.array([blocksize]),
-                         comment_pickled=numpy.array(pickle.dumps(self._comment)))
-            except Exception as e:
-                logging.warn('Failed to save cache file %s: %s' % (cache_fname,e))
+                f.seek(parser.offset)
+                parser.parse_file(f, hold_partial=True)
+            finally:
+                f.close()
+        except:
+            logging.exception('Unable to parse new data in %s' % self.get_filepath())
+            return False
+        finally:
+            self._add_missing_dimensions(parser.nfields)
+            self._count_coord_val_dims()
+            self._parsed_dimensions = copy.deepcopy(self._dimensions)
+
+        if not parser.started:
+            return False
+
+        self._data_buffer = parser.get_buffer()
+        self._data = self._data_buffer.get_view()
+        self._finish_loading(list(parser.block_sizes), parser.max_blocksize,
+                parser.blocksize)
+        return True
+
+    def follow(self, interval=1.0):
+        '''
+        Call refresh() every interval seconds, to follow a data file that
+        is being written. Use stop_follow() to stop.
+        '''
+
+        self.stop_follow()
+        self._follow_hid = gobject.timeout_add(int(interval * 1000),
+                self._follow_cb)
+
+    def stop_follow(self):
+        '''Stop following the data file.'''
+        if self._follow_hid is not None:
+            gobject.source_remove(self._follow_hid)
+            self._follow_hid = None
+
+    def is_following(self):
+        return self._follow_hid is not None
 
+    def _follow_cb(self):
+        try:
+            self.refresh()
+        except:
+            logging.exception('Error while refreshing %s', self.get_filepath())
         return True
 
     def _type_added(self, name):
@@ -1424,6 +2085,11 @@ class Data(SharedGObject):
         return self._reshaped_data
 
     def _detect_dimensions_size(self):
+        '''
+        Detect the loops in the coordinate columns and set the size, start
+        and end of the looped dimensions, see lib/loopdetect.py.
+        '''
+
         data = self._data
         ncoords = self.get_ncoordinates()
         if len(data) < 2:
@@ -1431,56 +2097,23 @@ class Data(SharedGObject):
                 self._dimensions[colnum]['size'] = len(data)
             return
 
-        loopdims = []
-        newshape = []
-        mulsize = 1
-        firstloopdim = None
-        for iter in range(ncoords):
-            loopdim = None
-            for colnum in range(ncoords):
-                if mulsize >= len(data):
-                    continue
-
-                if data[0, colnum] != data[mulsize, colnum]:
-                    loopdim = colnum
-                    loopdims.append(loopdim)
-                    loopstart = data[0, loopdim]
-                    break
-
-            if loopdim is None:
-                break
-
-            if firstloopdim is None:
-                firstloopdim = loopdim
-
-            i = 1
-            while i * mulsize < len(data):
-                if data[i * mulsize, loopdim] == loopstart:
-                    break
-                i += 1
-
+        loops = loopdetect.detect_loops(data, ncoords)
+        for i, loopdim in enumerate(loops.loopdims):
             opt = self._dimensions[loopdim]
-            opt['start'] = loopstart
-            opt['size'] = i
-            opt['end'] = data[mulsize * (i - 1), loopdim]
-            newshape.append(i)
+            opt['start'] = loops.starts[i]
+            opt['size'] = loops.loopshape[i]
+            opt['end'] = loops.ends[i]
 
-            mulsize *= i
-
-        complete = len(self._data) == mulsize
-        self._loopdims = loopdims
-        self._loopshape = newshape
-        self._complete = complete
+        self._loopdims = loops.loopdims
+        self._loopshape = loops.loopshape
+        self._complete = loops.complete
 
         # Determine number of blocks
-        bs = self._dimensions[firstloopdim]['size']
-        if bs > 0:
-            if len(data) % bs == 0:
-                self._block_sizes = [bs] * (len(data) / bs)
-            else:
-                self._block_sizes = [bs] * (int(len(data) / bs) + 1)
+        block_sizes = loops.get_block_sizes()
+        if block_sizes is not None:
+            self._block_sizes = block_sizes
 
-        return complete
+        return loops.complete
 
     def set_filepath(self, fp, inmem=True):
         '''
@@ -1524,3 +2157,76 @@ class Data(SharedGObject):
     @staticmethod
     def get(name):
         return Data._data_list.get(name)
+
+def convert_dat_to_bin(filepath, binpath=None):
+    '''
+    Convert a .dat (or .dat.gz) file to a binary data file. The values
+    are stored without loss of precision.
+
+    Input:
+        filepath (string): file to convert
+        binpath (string): file to create, default is filepath with the
+            .gz extension replaced by .bin
+
+    Output:
+        path of the binary data file
+    '''
+
+    if binpath is None:
+        binpath = filepath
+        if binpath.endswith('.gz'):
+            binpath = binpath[:-len('.gz')]
+        binpath += binfile.EXTENSION
+    return _convert_file(filepath, binpath)
+
+def convert_bin_to_dat(filepath, datpath=None):
+    '''
+    Convert a binary data file to a .dat file. Values are written with 16
+    digits precision, so converting back gives the same data.
+
+    Input:
+        filepath (string): file to convert
+        datpath (string): file to create, default is filepath without the
+            .bin extension
+
+    Output:
+        path of the .dat file
+    '''
+
+    if datpath is None:
+        if not filepath.endswith(binfile.EXTENSION):
+            raise ValueError('%s is not a binary data file' % filepath)
+        datpath = filepath[:-len(binfile.EXTENSION)]
+    return _convert_file(filepath, datpath)
+
+def _convert_file(filepath, newpath):
+    if os.path.abspath(filepath) == os.path.abspath(newpath):
+        raise ValueError('Unable to convert %s to itself' % filepath)
+
+    d = Data(filepath, cache_path=None)
+    if not d._inmem:
+        raise ValueError('Unable to load %s' % filepath)
+
+    # The filename and timestamp lines of a .dat header are loaded as
+    # comments; they are written again by write_file(). Comment lines in
+    # .dat files are loaded with the space after the '#'.
+    comments = []
+    for rowno, line in d._comment:
+        if rowno == 0 and line.startswith(' Filename: '):
+            continue
+        elif rowno == 0 and line.startswith(' Timestamp: '):
+            d._timestamp = line[len(' Timestamp: '):]
+            continue
+        if not binfile.is_binary_file(filepath) and line.startswith(' '):
+            line = line[1:]
+        comments.append((rowno, line))
+    d._comment = comments
+
+    # Write the dimensions as they were in the file, not the sizes
+    # detected when loading.
+    if d._parsed_dimensions is not None:
+        d._dimensions = d._parsed_dimensions
+
+    d.write_file(filepath=newpath, precision=16, settings_file=False,
+            log_file=False, script_file=False)
+    return newpath
@@ -25,6 +25,21 @@ Contains:
   object, adapted for usage with qtlab
 - name generators in the style of qtlab Data objects
 - functions to create standard data sets
+
+Data groups can also be filled point by point or block by block, like
+qtlab Data objects. Points are added with DataGroup.add_data_point() and
+DataGroup.add_block() to the dimensions that were added without data;
+when the first points are added these are created as chunked datasets
+that can be resized along the first axis. Until then they can still be
+set as a whole, e.g. grp['x'] = arr. New points are kept in memory and
+written to the file according to the flush policy of the HDF5Data
+object.
+
+To follow a file while it is being written from another process, the
+writer calls HDF5Data.start_swmr() after creating all data groups and
+dimensions, and the reader opens the file with HDF5Data(filepath=...,
+mode='r', swmr=True) and calls refresh() to see new points (requires
+HDF5 1.10 and h5py 2.5 or newer).
 """
 
 import gobject
@@ -43,6 +58,11 @@ if in_qtlab:
     import qt
 
 import data
+from lib.growarray import GrowableArray
+from lib.file_support.flushpolicy import FlushPolicy
+
+# Name of the dataset that holds the block sizes of a data group
+BLOCK_SIZES = '_block_sizes'
 
 class DateTimeGenerator(data.DateTimeGenerator):
 
@@ -66,11 +86,12 @@ class DataGroup(SharedGObject):
         self.h5d = hdf5_data._file
         self.base = base
         self.groupname = base + name
+        self._hdf5_data = hdf5_data
         self._filepath = hdf5_data.get_filepath()
         self._folder = hdf5_data.get_folder()
 
         if self.name in self.h5d[base].keys():
-            self.group = self.h5d[base]
+            self.group = self.h5d[self.groupname]
         else:
             self.group = self.h5d.create_group(self.groupname)
 
@@ -78,21 +99,49 @@ class DataGroup(SharedGObject):
         for k in kw:
             self.group.attrs[k] = kw[k]
 
+        # Appendable datasets, in the order of the columns of
+        # add_data_point()
+        streams = []
+        for dimname, dim in self.group.items():
+            if dimname != BLOCK_SIZES and 'column' in dim.attrs:
+                streams.append((dim.attrs['column'], dim))
+        streams.sort()
+        self._streams = [dim for col, dim in streams]
+
+        # Dimensions added without data that become streams when points
+        # are added
+        self._placeholders = []
+
+        if BLOCK_SIZES in self.group.keys():
+            self._block_dset = self.group[BLOCK_SIZES]
+        else:
+            self._block_dset = None
+
+        # Rows and block sizes that have not been written to the file yet
+        self._pending = GrowableArray(ncols=len(self._streams))
+        self._pending_blocks = []
+        self._nwritten = self._get_nwritten()
+        self._npoints_last_block = self._nwritten
+        if self._block_dset is not None:
+            self._npoints_last_block -= int(np.sum(self._block_dset[...]))
+
+        hdf5_data._add_data_group(self)
+
     def __getitem__(self, name):
+        self._write_pending()
         return self.group[name].value
 
     def __setitem__(self, name, val):
         if name in self.group.keys():
 
-            # store old attributes
-            attrs = dict(self.group[name].attrs)
-
-            # delete and re-create; overwrite doesn't work with hdf5
-            del self.group[name]
-            dim = self.group.create_dataset(name, data=val)
-            for k, v in attrs.iteritems():
-                dim.attrs[k] = v
+            if 'column' in self.group[name].attrs:
+                logging.error("Dimension '%s' contains points added with add_data_point() and cannot be replaced" \
+                        % name)
+                return False
+            if name in self._placeholders:
+                self._placeholders.remove(name)
 
+            self._replace_dataset(name, val)
             return True
 
         # not sure whether this behavior makes sense, wild guess ATM
@@ -107,6 +156,24 @@ class DataGroup(SharedGObject):
     def get_folder(self):
         return self._folder
 
+    def _replace_dataset(self, name, data=None):
+        '''
+        Delete dataset name and create it again with data, or as a stream
+        if data is None, keeping its attributes; overwriting doesn't work
+        with hdf5.
+        '''
+
+        attrs = dict(self.group[name].attrs)
+        del self.group[name]
+        if data is None:
+            dim = self._create_stream(name)
+        else:
+            dim = self.group.create_dataset(name, data=data)
+        for k, v in attrs.iteritems():
+            if k != 'column':
+                dim.attrs[k] = v
+        return dim
+
     def add_dimension(self, name, dim_type, data, **meta):
         '''
         Add a dimension to the data group.
@@ -121,9 +188,10 @@ class DataGroup(SharedGObject):
             return False
 
         if data is None:
-            data = np.array([np.NaN])
-
-        dim = self.group.create_dataset(name, data=data)
+            dim = self.group.create_dataset(name, data=np.array([np.NaN]))
+            self._placeholders.append(name)
+        else:
+            dim = self.group.create_dataset(name, data=data)
         dim.attrs['dim_type'] = dim_type
 
         for k in meta:
@@ -131,6 +199,42 @@ class DataGroup(SharedGObject):
 
         return True
 
+    def _start_streams(self):
+        '''
+        Turn the dimensions added without data into datasets that can be
+        extended with add_data_point().
+        '''
+        for name in self._placeholders:
+            self._replace_dataset(name)
+        self._placeholders = []
+
+    def _create_stream(self, name):
+        '''
+        Create a dataset that can be extended with add_data_point(). Points
+        added before the dataset was created are filled with NaN.
+        '''
+
+        self._write_pending()
+
+        opts = self._hdf5_data.get_stream_options()
+        dim = self.group.create_dataset(name, shape=(self._nwritten,),
+                maxshape=(None,), dtype=np.float64,
+                chunks=(opts['chunk_rows'],), fillvalue=np.NaN,
+                compression=opts['compression'],
+                compression_opts=opts['compression_opts'],
+                shuffle=opts['shuffle'])
+        dim.attrs['column'] = len(self._streams)
+        self._streams.append(dim)
+
+        self._pending = GrowableArray(ncols=len(self._streams))
+
+        if self._block_dset is None:
+            self._block_dset = self.group.create_dataset(BLOCK_SIZES,
+                    shape=(0,), maxshape=(None,), dtype=np.int64,
+                    chunks=(256,))
+
+        return dim
+
     def add(self, name, data=None, **meta):
         '''
         Add an unspecified dimension, optionally with known data.
@@ -141,6 +245,7 @@ class DataGroup(SharedGObject):
     def add_coordinate(self, name, data=None, **meta):
         '''
         Add a coordinate dimension, optionally with known data.
+        Without data, points can be added with add_data_point().
         Extra keywords are added as meta data.
         '''
         return self.add_dimension(name, 'coordinate', data, **meta)
@@ -148,10 +253,142 @@ class DataGroup(SharedGObject):
     def add_value(self, name, data=None, **meta):
         '''
         Add a value dimension, optionally with known data.
+        Without data, points can be added with add_data_point().
         Extra keywords are added as meta data.
         '''
         return self.add_dimension(name, 'value', data, **meta)
 
+    def add_data_point(self, *args):
+        '''
+        Add data point(s) to the dimensions that were added without data,
+        in the order they were added. The points are written to the file
+        according to the flush policy of the HDF5Data object.
+
+        provide 1 data point
+            - N numbers: g.add_data_point(1, 2, 3)
+
+        OR
+
+        provide >1 data points.
+            - a single MxN 2d array: g.add_data_point(arraydata)
+            - N 1d arrays of length M: g.add_data_point(a1, a2, a3)
+
+        Output:
+            number of points added
+        '''
+
+        self._start_streams()
+        ncols = len(self._streams)
+        if ncols == 0:
+            logging.warning('add_data_point(): no dimensions without data in group %s' % self.name)
+            return 0
+
+        if len(args) == 1 and np.ndim(args[0]) == 2:
+            rows = np.asarray(args[0], dtype=np.float64)
+        else:
+            shapes = [np.shape(a) for a in args]
+            if len(set(shapes)) > 1:
+                logging.warning('add_data_point(): not all provided data arguments have same shape')
+                return 0
+            if len(shapes) > 0 and len(shapes[0]) > 1:
+                logging.warning('add_data_point(): adding >2d data not supported')
+                return 0
+            rows = np.array(args, dtype=np.float64)
+            if rows.ndim == 1:
+                rows = rows.reshape((1, -1))
+            else:
+                rows = rows.T
+
+        if rows.shape[1] != ncols:
+            logging.warning('add_data_point(): expected %d columns, got %d' % \
+                    (ncols, rows.shape[1]))
+            return 0
+
+        self._pending.append(rows)
+        self._npoints_last_block += len(rows)
+        self._hdf5_data._rows_added(len(rows))
+        return len(rows)
+
+    def new_block(self):
+        '''Start a new block and flush the file.'''
+
+        self._start_streams()
+        if self._block_dset is None:
+            logging.warning('new_block(): no dimensions without data in group %s' % self.name)
+            return
+
+        self._pending_blocks.append(self._npoints_last_block)
+        self._npoints_last_block = 0
+        self._hdf5_data.flush()
+
+    def add_block(self, *args):
+        '''
+        Add the points of a complete block, see add_data_point(), and
+        start a new block.
+
+        Output:
+            number of points added
+        '''
+
+        n = self.add_data_point(*args)
+        self.new_block()
+        return n
+
+    def get_npoints(self):
+        '''Return the number of points added with add_data_point().'''
+        return self._nwritten + len(self._pending)
+
+    def get_block_sizes(self):
+        '''Return the sizes of the completed blocks.'''
+        self._write_pending()
+        if self._block_dset is None:
+            return []
+        return self._block_dset[...].tolist()
+
+    def _get_nwritten(self):
+        '''Return the number of complete rows in the file.'''
+        if len(self._streams) == 0:
+            return 0
+        return min([dim.shape[0] for dim in self._streams])
+
+    def _write_pending(self):
+        '''Write the pending rows and block sizes to the file.'''
+
+        nrows = len(self._pending)
+        if nrows > 0:
+            rows = self._pending.get_view()
+            start = self._nwritten
+            for i, dim in enumerate(self._streams):
+                dim.resize((start + nrows,))
+                dim[start:start + nrows] = rows[:,i]
+            self._nwritten += nrows
+            self._pending.clear()
+
+        if len(self._pending_blocks) > 0:
+            start = self._block_dset.shape[0]
+            nblocks = len(self._pending_blocks)
+            self._block_dset.resize((start + nblocks,))
+            self._block_dset[start:] = self._pending_blocks
+            self._pending_blocks = []
+
+    def refresh(self):
+        '''
+        Read the current size of the datasets, for a file that is being
+        written by another process (SWMR mode).
+
+        Output:
+            number of new points
+        '''
+
+        for dim in self._streams:
+            dim.refresh()
+        if self._block_dset is not None:
+            self._block_dset.refresh()
+
+        nold = self._nwritten
+        self._nwritten = self._get_nwritten()
+        return self._nwritten - nold
+
     def loop1d_data(self, *args, **kwargs):
         kwargs['group'] = self
         return loop1d_data(*args, **kwargs)
@@ -172,6 +409,23 @@ class HDF5Data:
 
         kwargs:
             name (string) : default is 'data'
+            filepath (string) : file to create or open
+            mode (string) : mode to open the file with, default 'a'
+            swmr (bool) : default False. Open the file with the latest
+                file format, so that start_swmr() can be used. If mode
+                is 'r', open the file for reading while it is being
+                written.
+            flush_rows (int) : flush after this many points, default is
+                'data_flush_rows' from config, or 0 (disabled)
+            flush_interval (float) : flush if this many seconds passed
+                since the last flush, default is 'data_flush_interval'
+                from config, or 1.0
+            compression (string) : compression filter for datasets that
+                are filled with add_data_point(), e.g. 'gzip' or 'lzf'.
+                Default is 'hdf5_compression' from config, or None.
+            compression_opts : options for the compression filter
+            chunk_rows (int) : chunk size of those datasets, default is
+                'hdf5_chunk_rows' from config, or 1024
         """
 
         # FIXME: the name generation here is a bit nasty
@@ -179,7 +433,22 @@ class HDF5Data:
         name = data.Data._data_list.new_item_name(self, name)
         self._name = name
 
-        filepath = kwargs.get('filepath, None')
+        self._data_groups = []
+        self._flush_policy = FlushPolicy(self.flush,
+                kwargs.get('flush_rows', config.get('data_flush_rows', 0)),
+                kwargs.get('flush_interval',
+                    config.get('data_flush_interval', 1.0)))
+        self._stream_options = {
+            'compression': kwargs.get('compression',
+                config.get('hdf5_compression', None)),
+            'compression_opts': kwargs.get('compression_opts', None),
+            'chunk_rows': kwargs.get('chunk_rows',
+                config.get('hdf5_chunk_rows', 1024)),
+        }
+        self._stream_options['shuffle'] = \
+                self._stream_options['compression'] is not None
+
+        filepath = kwargs.get('filepath', None)
         if filepath:
             self._filepath = filepath
 
@@ -190,10 +459,19 @@ class HDF5Data:
             self._datemark = time.strftime('%Y%m%d', self._localtime)
             self._filepath =  self._filename_generator.new_filename(self)
 
+        mode = kwargs.get('mode', 'a')
+        swmr = kwargs.get('swmr', False)
+
         self._folder, self._filename = os.path.split(self._filepath)
-        if not os.path.isdir(self._folder):
+        if self._folder and not os.path.isdir(self._folder) and mode != 'r':
             os.makedirs(self._folder)
-        self._file = h5py.File(self._filepath, 'a')
+        if not swmr:
+            self._file = h5py.File(self._filepath, mode)
+        elif mode == 'r':
+            self._file = h5py.File(self._filepath, mode, libver='latest',
+                    swmr=True)
+        else:
+            self._file = h5py.File(self._filepath, mode, libver='latest')
         self.flush()
 
     def __getitem__(self, name):
@@ -223,10 +501,74 @@ class HDF5Data:
         '''Create a DataGroup object.'''
         return DataGroup(name, self, **kwargs)
 
+    def _add_data_group(self, group):
+        self._data_groups.append(group)
+
+    def get_stream_options(self):
+        '''
+        Return a dict with the chunk size and compression settings for
+        datasets that are filled with add_data_point().
+        '''
+        return dict(self._stream_options)
+
+    def start_swmr(self):
+        '''
+        Switch to single-writer multiple-reader mode, so that other
+        processes can read the file while points are being added. No
+        groups, datasets or attributes can be created after this, so call
+        it when all data groups and dimensions have been added.
+        '''
+
+        for group in self._data_groups:
+            group._start_streams()
+        self.flush()
+        self._file.swmr_mode = True
+
+    def _rows_added(self, nrows):
+        '''
+        Called by data groups when points were added, flushes according
+        to the flush policy.
+        '''
+        self._flush_policy.add_rows(nrows)
+
     def flush(self):
-        self._file.flush()
+        '''Write points added to data groups and flush the file.'''
+
+        self._flush_policy.flushed()
+        if self._file.mode != 'r':
+            for group in self._data_groups:
+                group._write_pending()
+            self._file.flush()
+
+    def set_flush_policy(self, rows=None, interval=None):
+        '''
+        Set when points added to data groups are written to the file. The
+        file is always flushed at the start of a new block and when it is
+        closed.
+
+        Input:
+            rows (int): flush after this many points, 0 to disable
+            interval (float): flush if this many seconds passed since the
+                last flush, 0 to flush after every point
+        '''
+
+        self._flush_policy.set(rows, interval)
+
+    def get_flush_policy(self):
+        '''Return the flush policy as a (rows, interval) tuple.'''
+        return self._flush_policy.get()
+
+    def refresh(self):
+        '''
+        Update the data groups of a file opened for reading in SWMR mode.
+
+        Output:
+            number of new points
+        '''
+        return sum([group.refresh() for group in self._data_groups])
 
     def close(self):
+        self.flush()
         self._file.close()
 
 def loop1d_data(xs, ynames=('ys', ), name='data', xname='xs', data=None, group=None):
@@ -22,11 +22,24 @@ import qt
 import instrument
 
 class Proxy():
+    '''
+    Proxy for an Instrument, which forwards the public methods of the
+    instrument that is currently registered under a name. After reloading
+    an instrument the proxy refers to the new instrument.
+
+    Methods are looked up when they are first used and then stored in the
+    proxy, so creating a proxy is cheap even for instruments with many
+    parameters.
+    '''
+
+    # Per instrument class, the names from the class dictionaries that may
+    # be forwarded.
+    _class_names = {}
 
     def __init__(self, name, include_do=None):
         self._name = name
+        self._ins = None
         self._proxy_names = []
-        self._setup_done = False
         self._padd_hid = None
         self._prem_hid = None
 
@@ -35,43 +48,83 @@ class Proxy():
         else:
             self._include_do = include_do
 
-        self._setup_proxy()
         qt.instruments.connect('instrument-added', self._ins_added_cb)
         qt.instruments.connect('instrument-removed', self._ins_removed_cb)
 
-    def _setup_proxy(self):
-        if self._setup_done:
-            return
-        self._setup_done = True
-
-        self._ins = qt.instruments.get(self._name, proxy=False)
-        members = inspect.getmembers(self._ins)
-
-        toadd = instrument.Instrument.__dict__.keys()
-        toadd += ['connect', 'disconnect']
-        toadd += self._ins.__class__.__dict__.keys()
-        toadd += self._ins._added_methods
-        toadd += self._ins.get_function_names()
-        for (name, item) in members:
-            if name.startswith('do_') and not self._include_do:
-                continue
-            if callable(item) and not name.startswith('_') and name in toadd:
-                self._proxy_names.append(name)
-                setattr(self, name, item)
-
-        self._padd_hid = self.connect('parameter-added',
-                self._parameter_added_cb)
-        self._prem_hid = self.connect('parameter-removed',
-                self._parameter_removed_cb)
+    def _get_ins(self):
+        '''Return the instrument, None if it does not exist.'''
+
+        if self._ins is None:
+            ins = qt.instruments.get(self._name, proxy=False)
+            if ins is None:
+                return None
+            self._ins = ins
+            self._padd_hid = ins.connect('parameter-added',
+                    self._parameter_added_cb)
+            self._prem_hid = ins.connect('parameter-removed',
+                    self._parameter_removed_cb)
+        return self._ins
+
+    @staticmethod
+    def _get_class_names(cls):
+        names = Proxy._class_names.get(cls)
+        if names is None:
+            names = set(instrument.Instrument.__dict__.keys())
+            names.update(['connect', 'disconnect'])
+            names.update(cls.__dict__.keys())
+            names = frozenset(names)
+            Proxy._class_names[cls] = names
+        return names
+
+    def _is_proxied(self, ins, name):
+        '''Return whether method name of ins should be available.'''
+
+        if name.startswith('_'):
+            return False
+        if name.startswith('do_') and not self._include_do:
+            return False
+        return name in self._get_class_names(ins.__class__) or \
+                name in ins._added_methods or \
+                name in ins.get_function_names()
+
+    def __getattr__(self, name):
+        # Only called if name is not (yet) an attribute of the proxy
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        ins = self._get_ins()
+        if ins is None or not self._is_proxied(ins, name):
+            raise AttributeError(name)
+        item = getattr(ins, name, None)
+        if not callable(item):
+            raise AttributeError(name)
+
+        setattr(self, name, item)
+        self._proxy_names.append(name)
+        return item
+
+    def __dir__(self):
+        ins = self._get_ins()
+        if ins is None:
+            return []
+        ret = []
+        for name in dir(ins):
+            if self._is_proxied(ins, name) and callable(getattr(ins, name, None)):
+                ret.append(name)
+        return ret
+
+    def _forget(self, name):
+        if name in self._proxy_names:
+            self._proxy_names.remove(name)
+            delattr(self, name)
 
     def _remove_functions(self):
         if self._padd_hid is not None:
-            self.disconnect(self._padd_hid)
-            self.disconnect(self._prem_hid)
+            self._ins.disconnect(self._padd_hid)
+            self._ins.disconnect(self._prem_hid)
         self._padd_hid = None
         self._prem_hid = None
 
-        self._setup_done = False
         for name in self._proxy_names:
             delattr(self, name)
         self._proxy_names = []
@@ -79,7 +132,7 @@ class Proxy():
 
     def _ins_added_cb(self, sender, insname):
         if insname == self._name:
-            self._setup_proxy()
+            self._remove_functions()
 
     def _ins_removed_cb(self, sender, insname):
         if insname == self._name:
@@ -87,11 +140,8 @@ class Proxy():
 
     def _parameter_added_cb(self, sender, name):
         for func in ('get_%s' % name, 'set_%s' % name):
-            if hasattr(self._ins, func):
-                setattr(self, func, getattr(self._ins, func))
+            self._forget(func)
 
     def _parameter_removed_cb(self, sender, name):
         for func in ('get_%s' % name, 'set_%s' % name):
-            if hasattr(self, func):
-                delattr(self, func)
-
+            self._forget(func)
@@ -21,6 +21,7 @@ import copy
 import time
 import math
 import inspect
+import threading
 from gettext import gettext as _L
 from lib import calltimer
 from lib.network.object_sharer import SharedGObject, cache_result
@@ -30,6 +31,8 @@ import logging
 import qt
 
 from lib.config import get_config
+from lib import persist
+from lib import probescheduler
 config = get_config()
 
 class Instrument(SharedGObject):
@@ -92,8 +95,11 @@ class Instrument(SharedGObject):
         self._initialized = False
         self._locked = False
 
+        # Changes are queued by reads in worker threads (measurements,
+        # ramps) and emitted in the main loop
         self._changed = {}
         self._changed_hid = None
+        self._changed_lock = threading.Lock()
 
         self._options = kwargs
         if 'tags' not in self._options:
@@ -105,16 +111,20 @@ class Instrument(SharedGObject):
         self._parameter_groups = {}
         self._functions = {}
         self._added_methods = []
-        self._probe_ids = []
 
         self._default_read_var = None
         self._default_write_var = None
 
+        self._batch_ask = None
+        self._batch_separator = ';'
+        self._batch_reply_separator = ';'
+        self._batch_max_queries = 0
+
         self._lock_class = kwargs.get('lockclass', name)
         if self._lock_class in Instrument._lock_classes:
             self._access_lock = Instrument._lock_classes[self._lock_class]
         else:
-            self._access_lock = calltimer.TimedLock(2.0)
+            self._access_lock = calltimer.TimedLock(2.0, self._lock_class)
             self._lock_classes[self._lock_class] = self._access_lock
 
     def __str__(self):
@@ -140,6 +150,27 @@ class Instrument(SharedGObject):
         '''Return instrument options.'''
         return self._options
 
+    def get_lock_class(self):
+        '''
+        Return the lock class of the instrument. Instruments that share a
+        bus (e.g. GPIB) have the same lock class and access lock.
+        '''
+        return self._lock_class
+
+    def get_lock_stats(self):
+        '''
+        Return the statistics of the access lock, which is shared by all
+        instruments with the same lock class: the number of acquisitions,
+        contended acquisitions and timeouts, and the wait and hold times.
+        See calltimer.TimedLock.get_stats().
+        '''
+        stats = self._access_lock.get_stats()
+        stats['lock_class'] = self._lock_class
+        return stats
+
+    def reset_lock_stats(self):
+        self._access_lock.reset_stats()
+
     def get_tags(self):
         '''
         Returns array of tags
@@ -260,6 +291,12 @@ class Instrument(SharedGObject):
                 cache_time: the time during which get_<parameter> will perform
                     a SOFTGET, i.e. returns the value last passed to
                     set_<parameter>. Set to zero to disable.
+                query (string): query that returns the value of this
+                    parameter, e.g. 'SENS1:FREQ:STAR?'. For channels, '%s'
+                    is replaced by the channel. Used to combine the gets
+                    of several parameters in one call, see set_batch_ask().
+                parse (function): convert the reply to query into a value
+                    (before type casting), e.g. to strip or map strings.
 
         Output: None
         '''
@@ -385,15 +422,14 @@ class Instrument(SharedGObject):
 #            property(lambda: self.get(name), lambda x: self.set(name, x)))
 
         if options['flags'] & self.FLAG_PERSIST:
-            val = config.get('persist_%s_%s' % (self._name, name))
+            val = persist.get_store().get(self._name, name)
             options['value'] = val
         else:
             options['value'] = None
 
         if 'probe_interval' in options:
-            interval = int(options['probe_interval'])
-            self._probe_ids.append(gobject.timeout_add(interval,
-                lambda: self.get(name)))
+            probescheduler.get_scheduler().add(self, name,
+                    int(options['probe_interval']), owner='driver')
 
         if 'listen_to' in options:
             insset = set([])
@@ -424,6 +460,7 @@ class Instrument(SharedGObject):
                 if hasattr(self, fname):
                     delattr(self, fname)
         self._parameters = {}
+        probescheduler.get_scheduler().remove_instrument(self._name)
 
     def remove_parameter(self, name):
         if name not in self._parameters:
@@ -433,6 +470,7 @@ class Instrument(SharedGObject):
             if hasattr(self, func):
                 delattr(self, func)
 
+        probescheduler.get_scheduler().remove(self._name, name, owner=None)
         del self._parameters[name]
         self.emit('parameter-removed', name)
 
@@ -463,7 +501,8 @@ class Instrument(SharedGObject):
         '''
         if self._parameters.has_key(name):
             options = dict(self._parameters[name])
-            for i in ('get_func', 'set_func'):
+            # Functions cannot be sent to remote clients
+            for i in ('get_func', 'set_func', 'parse'):
                 if i in options:
                     del options[i]
             if 'type' in options and options['type'] is types.NoneType:
@@ -721,6 +760,14 @@ class Instrument(SharedGObject):
 
         func = p['get_func']
         value = func(**kwargs)
+        return self._store_value(p, value, current_time)
+
+    def _store_value(self, p, value, access_time):
+        '''
+        Cast a value read from the instrument to the parameter type and
+        store it in parameter options p.
+        '''
+
         if 'type' in p and value is not None:
             try:
                 if p['type'] == types.IntType:
@@ -739,12 +786,140 @@ class Instrument(SharedGObject):
                 logging.warning('Unable to cast value "%s" to %s', value, p['type'])
 
         p['value'] = value
-        p['last_physical_access_time'] = current_time
+        p['last_physical_access_time'] = access_time
         return value
 
+    def set_batch_ask(self, ask_func, separator=';', max_queries=0,
+            reply_separator=None):
+        '''
+        Enable combining the queries of several parameters in a single
+        call to ask_func, e.g. the ask() function of the visa instrument.
+        Parameters that are added with a 'query' option are then read in
+        one round trip when they are requested in the same get() call;
+        other parameters are read using their get function as usual.
+
+        In SCPI a command after ';' is relative to the path of the
+        previous one, so queries from different subsystems have to be
+        joined with ';:' while the values in the reply are separated by
+        ';'.
+
+        Input:
+            ask_func (function): send a query string, return the reply
+            separator (string): separator between the queries
+            max_queries (int): maximum number of queries per call, 0 for
+                no limit
+            reply_separator (string): separator between the values in the
+                reply, default is separator
+        '''
+
+        if reply_separator is None:
+            reply_separator = separator
+        self._batch_ask = ask_func
+        self._batch_separator = separator
+        self._batch_reply_separator = reply_separator
+        self._batch_max_queries = max_queries
+
+    def _get_batch_names(self, names, query, kwargs):
+        '''Return the parameters in names that can be read in a batch.'''
+
+        if self._batch_ask is None or not query or len(kwargs) > 0:
+            return []
+
+        ret = []
+        current_time = time.time()
+        for name in names:
+            p = self._parameters.get(name, None)
+            if p is None or 'query' not in p or not p['flags'] & 1 or \
+                    p['flags'] & 8 or name in ret:
+                continue
+            if current_time - p['last_physical_access_time'] < p['cache_time']:
+                continue
+            ret.append(name)
+
+        if len(ret) < 2:
+            return []
+        return ret
+
+    def _get_batch(self, names):
+        '''
+        Read the values of parameters in names with combined queries.
+
+        Output: dictionary of parameter -> value for the parameters that
+            were read successfully.
+        '''
+
+        result = {}
+        nmax = self._batch_max_queries
+        if nmax <= 0:
+            nmax = len(names)
+
+        for start in range(0, len(names), nmax):
+            chunk = names[start:start + nmax]
+            queries = []
+            for name in chunk:
+                p = self._parameters[name]
+                q = p['query']
+                if 'channel' in p:
+                    q = q % p['channel']
+                queries.append(q)
+
+            current_time = time.time()
+            try:
+                reply = self._batch_ask(self._batch_separator.join(queries))
+            except Exception, e:
+                logging.warning('Combined query of %s failed: %s', chunk, e)
+                continue
+
+            values = reply.strip().split(self._batch_reply_separator)
+            if len(values) != len(chunk):
+                logging.warning('Expected %d values in reply to combined query, got %r',
+                        len(chunk), reply)
+                continue
+
+            for name, value in zip(chunk, values):
+                p = self._parameters[name]
+                try:
+                    if 'parse' in p:
+                        value = p['parse'](value)
+                    else:
+                        value = value.strip()
+                except Exception, e:
+                    logging.warning('Unable to parse reply %r for %s: %s',
+                            value, name, e)
+                    continue
+                result[name] = self._store_value(p, value, current_time)
+
+        return result
+
+    def _get_values(self, names, query=True, **kwargs):
+        '''
+        Get the values of several parameters, combining queries where
+        possible (see set_batch_ask()).
+
+        Output: dictionary of parameter -> value, parameters with value
+            None are left out.
+        '''
+
+        batch = self._get_batch_names(names, query, kwargs)
+        values = {}
+        if len(batch) > 0:
+            values = self._get_batch(batch)
+
+        result = {}
+        for key in names:
+            if key in values:
+                val = values[key]
+            else:
+                val = self._get_value(key, query, **kwargs)
+            if val is not None:
+                result[key] = val
+        return result
+
     def get(self, name, query=True, fast=False, **kwargs):
         '''
-        Get one or more Instrument parameter values.
+        Get one or more Instrument parameter values. If several parameters
+        are requested and the driver declared queries for them, they are
+        read with a combined query (see set_batch_ask()).
 
         Input:
             name (string or list/tuple of strings): name of parameter(s)
@@ -764,19 +939,17 @@ class Instrument(SharedGObject):
                 return None
 
         if fast:
-            ret = self._get_value(name, query, **kwargs)
+            if type(name) in (types.ListType, types.TupleType):
+                ret = self._get_values(name, query, **kwargs)
+            else:
+                ret = self._get_value(name, query, **kwargs)
             if Instrument.USE_ACCESS_LOCK:
                 self._access_lock.release()
             return ret
 
         if type(name) in (types.ListType, types.TupleType):
-            changed = {}
-            result = {}
-            for key in name:
-                val = self._get_value(key, query, **kwargs)
-                if val is not None:
-                    result[key] = val
-                    changed[key] = val
+            result = self._get_values(name, query, **kwargs)
+            changed = dict(result)
 
         else:
             result = self._get_value(name, query, **kwargs)
@@ -898,14 +1071,37 @@ class Instrument(SharedGObject):
         Output: Value returned by the _do_set_<name> function,
                 or result of get in FLAG_GET_AFTER_SET specified.
         '''
+
+        p, value = self._prepare_set(name, value, kwargs)
+        if p is None:
+            return None
+
+        func = p['set_func']
+        steps, delay = self._get_ramp_steps(name, value)
+        for i, stepval in enumerate(steps):
+            ret = func(stepval, **kwargs)
+            if i < len(steps) - 1:
+                time.sleep(delay)
+
+        return self._finish_set(name, value, kwargs)
+
+    def _prepare_set(self, name, value, kwargs):
+        '''
+        Check and convert a value to set for parameter name, add the
+        channel to kwargs if necessary.
+
+        Output: (parameter options, converted value), or (None, None) if
+            the value can not be set.
+        '''
+
         if self._parameters.has_key(name):
             p = self._parameters[name]
         else:
-            return None
+            return None, None
 
         if not p['flags'] & Instrument.FLAG_SET:
             logging.warn('(%s) Instrument does not support setting of %s', self.get_name(), name)
-            return None
+            return None, None
 
         if 'channel' in p and 'channel' not in kwargs:
             kwargs['channel'] = p['channel']
@@ -916,7 +1112,7 @@ class Instrument(SharedGObject):
             if newval is None:
                 logging.error('(%s) Value %s is not a valid option for "%s", valid options: %r',
                     self.get_name(), value, name, repr(p['format_map']))
-                return
+                return None, None
             value = newval
 
         # If an option list is available check whether the value is in there
@@ -925,68 +1121,76 @@ class Instrument(SharedGObject):
             if newval is None:
                 logging.error('(%s) Value %s is not a valid option for "%s", valid: %r',
                     self.get_name(), value, name, repr(p['option_list']))
-                return
+                return None, None
             value = newval
 
         if 'type' in p:
             try:
                 value = self._convert_value(value, p['type'])
             except:
-                return None
+                return None, None
 
         if 'minval' in p and value < p['minval']:
             logging.warn('(%s) Trying to set "%s" too small: %s', self.get_name(), name, value)
-            return None
+            return None, None
 
         if 'maxval' in p and value > p['maxval']:
             logging.warn('(%s) Trying to set "%s" too large: %s', self.get_name(), name, value)
-            return None
+            return None, None
 
-        if 'base_name' in p:
-            base_name = p['base_name']
-        else:
-            base_name = name
-
-        func = p['set_func']
-        if 'maxstep' in p and p['maxstep'] is not None:
-            curval = p['value']
-            if curval is None:
-                logging.warning('(%s) Current "%s" value not available, ignoring maxstep', self.get_name(), name)
-                curval = value + 0.01 * p['maxstep']
-
-            delta = curval - value
-            if delta < 0:
-                sign = 1
-            else:
-                sign = -1
+        return p, value
 
-            if 'stepdelay' in p:
-                delay = p['stepdelay']
-            else:
-                delay = 50
+    def _get_ramp_steps(self, name, value):
+        '''
+        Return the values to set in order to change parameter name to
+        value in steps of at most 'maxstep', and the delay between the
+        steps in seconds.
+        '''
 
-            while math.fabs(delta) > 0:
-                if math.fabs(delta) > p['maxstep']:
-                    curval += sign * p['maxstep']
-                    delta += sign * p['maxstep']
-                else:
-                    curval = value
-                    delta = 0
+        p = self._parameters[name]
+        if 'maxstep' not in p or p['maxstep'] is None:
+            return [value], 0
 
-                ret = func(curval, **kwargs)
+        curval = p['value']
+        if curval is None:
+            logging.warning('(%s) Current "%s" value not available, ignoring maxstep', self.get_name(), name)
+            curval = value + 0.01 * p['maxstep']
 
-                if delta != 0:
-                    time.sleep(delay / 1000.0)
+        delta = curval - value
+        if delta < 0:
+            sign = 1
+        else:
+            sign = -1
 
+        if 'stepdelay' in p:
+            delay = p['stepdelay']
         else:
-            ret = func(value, **kwargs)
+            delay = 50
 
+        steps = []
+        while math.fabs(delta) > 0:
+            if math.fabs(delta) > p['maxstep']:
+                curval += sign * p['maxstep']
+                delta += sign * p['maxstep']
+            else:
+                curval = value
+                delta = 0
+            steps.append(curval)
+
+        return steps, delay / 1000.0
+
+    def _finish_set(self, name, value, kwargs):
+        '''
+        Update the stored value of parameter name after setting it to
+        value, return the new value.
+        '''
+
+        p = self._parameters[name]
         if p['flags'] & self.FLAG_GET_AFTER_SET:
             value = self._get_value(name, **kwargs)
 
         if p['flags'] & self.FLAG_PERSIST:
-            config.set('persist_%s_%s' % (self._name, name), value)
-            config.save()
+            persist.get_store().set(self._name, name, value)
 
         p['value'] = value
         p['last_physical_access_time'] = time.time()
@@ -1060,8 +1264,7 @@ class Instrument(SharedGObject):
         p['value'] = value
         
         if p['flags'] & self.FLAG_PERSIST:
-          config.set('persist_%s_%s' % (self._name, name), value)
-          config.save()
+          persist.get_store().set(self._name, name, value)
 
         self._queue_changed({name: value})
 
@@ -1206,15 +1409,24 @@ class Instrument(SharedGObject):
         update_func()
 
     def _do_emit_changed(self):
-        # was this a bug?
-        self.emit('changed', self._changed)
-        self._changed = {}
-        self._changed_hid = None
+        self._changed_lock.acquire()
+        try:
+            changed = self._changed
+            self._changed = {}
+            self._changed_hid = None
+        finally:
+            self._changed_lock.release()
+        self.emit('changed', changed)
+        return False
 
     def _queue_changed(self, changed):
-        self._changed.update(changed)
-        if self._changed_hid is None:
-            self._changed_hid = gobject.idle_add(self._do_emit_changed)
+        self._changed_lock.acquire()
+        try:
+            self._changed.update(changed)
+            if self._changed_hid is None:
+                self._changed_hid = gobject.idle_add(self._do_emit_changed)
+        finally:
+            self._changed_lock.release()
 
 class InvalidInstrument(Instrument):
     '''
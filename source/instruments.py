@@ -25,8 +25,11 @@ import sys
 import instrument
 from lib.config import get_config
 from insproxy import Proxy
-from lib.network.object_sharer import SharedGObject
+from lib.network.object_sharer import SharedGObject, helper
 
+from lib import rampscheduler
+from lib import probescheduler
+import qtflow
 from lib.misc import get_traceback
 TB = get_traceback()()
 
@@ -87,6 +90,85 @@ def _get_driver_module(name, do_reload=False):
 
     return None
 
+class DriverRegistry:
+    '''
+    List of the available instrument drivers in the plugin directories.
+
+    The directories are listed once and listed again only if their
+    modification time changed (i.e. a driver was added or removed) or
+    when refresh() is called. Driver modules are imported when they are
+    first needed.
+    '''
+
+    def __init__(self, dirs):
+        '''
+        Input:
+            dirs (list): plugin directories, in order of precedence
+        '''
+
+        self._dirs = [d for d in dirs if d is not None]
+        self._mtimes = {}
+        self._drivers = None
+
+    def set_dirs(self, dirs):
+        self._dirs = [d for d in dirs if d is not None]
+        self.refresh()
+
+    def refresh(self):
+        '''List the plugin directories again.'''
+        self._drivers = None
+
+    def _get_mtime(self, dir):
+        try:
+            return os.stat(dir).st_mtime
+        except OSError:
+            return None
+
+    def _is_outdated(self):
+        if self._drivers is None:
+            return True
+        for dir in self._dirs:
+            if self._get_mtime(dir) != self._mtimes.get(dir):
+                return True
+        return False
+
+    def _scan(self):
+        drivers = {}
+        for dir in reversed(self._dirs):
+            self._mtimes[dir] = self._get_mtime(dir)
+            try:
+                filelist = os.listdir(dir)
+            except OSError, e:
+                logging.warning('Unable to list instrument directory %s: %s',
+                        dir, e)
+                continue
+            for fn in filelist:
+                name, ext = os.path.splitext(fn)
+                if ext == '.py' and name != "__init__" and name[0] != '_':
+                    drivers[name] = os.path.join(dir, fn)
+        self._drivers = drivers
+
+    def get_drivers(self):
+        '''Return a dictionary of driver name -> file name.'''
+        if self._is_outdated():
+            self._scan()
+        return self._drivers
+
+    def get_types(self):
+        ret = self.get_drivers().keys()
+        ret.sort()
+        return ret
+
+    def exists(self, typename):
+        return typename in self.get_drivers()
+
+    def get_module(self, typename, do_reload=False):
+        '''
+        Return the driver module for typename, importing it if necessary.
+        The module is only reloaded if do_reload is True.
+        '''
+        return _get_driver_module(typename, do_reload=do_reload)
+
 class Instruments(SharedGObject):
 
     __gsignals__ = {
@@ -113,6 +195,9 @@ class Instruments(SharedGObject):
         self._instruments_info = {}
         self._tags = []
 
+        helper.register_event_callback('disconnected',
+                self._client_disconnected_cb)
+
     def __getitem__(self, key):
         return self.get(key)
 
@@ -170,6 +255,119 @@ class Instruments(SharedGObject):
         else:
             return None
 
+    def set_many(self, values, wait=True, **kwargs):
+        '''
+        Set several instrument parameters concurrently. Parameters with a
+        maximum step size are ramped at the same time; instruments with
+        the same lock class (e.g. on one GPIB bus) are accessed by a single
+        thread that interleaves their steps.
+
+        Input:
+            values (dict): (instrument, parameter) or 'instrument.parameter'
+                -> value. The instrument can be given by name or object.
+            wait (bool): wait until all parameters are set. While waiting
+                qt.msleep() is called, so an abort request from the GUI
+                stops the ramps after the current step. If False the
+                ramps continue in the background.
+            kwargs: optional keyword args passed to the set functions.
+
+        Output: dictionary with 'succeeded', 'running', 'results',
+            'rejected' and 'stats', see RampScheduler.get_summary().
+        '''
+
+        return self._set_many(values, wait, **kwargs).get_summary()
+
+    def _set_many(self, values, wait=True, **kwargs):
+        '''
+        Like set_many(), but return the RampScheduler, which can be used
+        to follow or abort the ramps when wait is False. Only for use in
+        the qtlab process; the scheduler can not be sent to clients.
+        '''
+
+        scheduler = rampscheduler.RampScheduler()
+        for key, value in values.iteritems():
+            if type(key) in (types.StringType, types.UnicodeType):
+                insname, param = key.split('.', 1)
+            else:
+                insname, param = key
+            if isinstance(insname, Proxy):
+                insname = insname.get_name()
+            ins = self.get(insname, proxy=False)
+            if ins is None:
+                raise ValueError('Instrument %s does not exist' % (insname, ))
+            if not scheduler.add(ins, param, value, **kwargs):
+                logging.warning('Unable to set %s.%s to %s',
+                        ins.get_name(), param, value)
+
+        scheduler.start()
+        if wait:
+            flow = qtflow.get_flowcontrol()
+            scheduler.wait(flow.measurement_idle)
+            stats = scheduler.get_stats()
+            logging.info('Parameters set in %.3f s, %.3f s sequentially',
+                    stats['total_time'], stats['sequential_time'])
+        return scheduler
+
+    def get_lock_stats(self):
+        '''
+        Return the access lock statistics per lock class, see
+        Instrument.get_lock_stats().
+        '''
+
+        ret = {}
+        for ins in self._instruments.values():
+            ret[ins.get_lock_class()] = ins.get_lock_stats()
+        return ret
+
+    def add_probe(self, insname, param, interval, owner=''):
+        '''
+        Read a parameter periodically. Probes that are due at the same
+        time are read with a single get() per instrument, which emits one
+        'changed' signal for all parameters. See lib/probescheduler.py.
+
+        Input:
+            insname (string): instrument name
+            param (string): parameter name
+            interval (int): interval in ms
+            owner (string): name of the client that requested the probe;
+                remote clients should end it with ':<root id>', so that
+                the probe is removed when the client disconnects
+        '''
+
+        ins = self.get(insname, proxy=False)
+        if ins is None or not ins.has_parameter(param):
+            logging.warning('Unable to probe %s.%s', insname, param)
+            return False
+        probescheduler.get_scheduler().add(ins, param, interval, owner)
+        return True
+
+    def remove_probe(self, insname, param, owner=''):
+        probescheduler.get_scheduler().remove(insname, param, owner)
+
+    def remove_probes(self, owner):
+        '''Remove all probes added by owner.'''
+        probescheduler.get_scheduler().remove_owner(owner)
+
+    def _client_disconnected_cb(self, client):
+        '''Remove the probes of a client that disconnected.'''
+        try:
+            suffix = ':%s' % (client.get_id(), )
+        except Exception, e:
+            logging.warning('Unable to remove probes of client: %s', e)
+            return
+        scheduler = probescheduler.get_scheduler()
+        for owner in scheduler.get_owners():
+            if owner.endswith(suffix):
+                scheduler.remove_owner(owner)
+
+    def set_probes_paused(self, owner, paused):
+        '''Pause or resume the probes added by owner.'''
+        probescheduler.get_scheduler().set_paused(owner, paused)
+
+    def get_probe_stats(self):
+        '''Return probe statistics, see ProbeScheduler.get_stats().'''
+        return probescheduler.get_scheduler().get_stats()
+
     def get_instrument_names(self):
         keys = self._instruments.keys()
         keys.sort()
@@ -185,33 +383,17 @@ class Instruments(SharedGObject):
         '''
         Return list of supported instrument types
         '''
-        ret = []
-        filelist = os.listdir(_insdir)
-        for path_fn in filelist:
-            path, fn = os.path.split(path_fn)
-            name, ext = os.path.splitext(fn)
-            if ext == '.py' and name != "__init__" and name[0] != '_':
-                ret.append(name)
-
-        if _user_insdir is not None:
-            filelist = os.listdir(_user_insdir)
-            for path_fn in filelist:
-                path, fn = os.path.split(path_fn)
-                name, ext = os.path.splitext(fn)
-                if ext == '.py' and name != "__init__" and name[0] != '_' and not ret.count(name) > 0:
-                    ret.append(name)
-
-        ret.sort()
-        return ret
+        return _registry.get_types()
 
     def type_exists(self, typename):
-        driverfn = os.path.join(_insdir, '%s.py' % typename)
-        if os.path.exists(driverfn):
-            return True
-        if _user_insdir is None:
-            return False
-        driverfn = os.path.join(_user_insdir, '%s.py' % typename)
-        return os.path.exists(driverfn)
+        return _registry.exists(typename)
+
+    def refresh_types(self):
+        '''
+        List the instrument plugin directories again. This happens
+        automatically when a driver file is added to or removed from them.
+        '''
+        _registry.refresh()
 
     def get_type_arguments(self, typename):
         '''
@@ -227,7 +409,7 @@ class Instruments(SharedGObject):
             defaults: default values
         '''
 
-        module = _get_driver_module(typename)
+        module = _registry.get_module(typename)
         insclass = getattr(module, typename, None)
         if insclass is None:
             return None
@@ -285,10 +467,9 @@ class Instruments(SharedGObject):
         import qtvisa
         qtvisa.set_visa(visa_driver)
 
-        module = _get_driver_module(instype)
+        module = _registry.get_module(instype)
         if module is None:
             return self._create_invalid_ins(name, instype, **kwargs)
-        reload(module)
         insclass = getattr(module, instype, None)
         if insclass is None:
             logging.error('Driver does not contain instrument class')
@@ -306,7 +487,11 @@ class Instruments(SharedGObject):
         return self.get(name)
 
     def reload_module(self, instype):
-        module = _get_driver_module(instype, do_reload=True)
+        '''
+        Reload the driver module for instype, e.g. after editing it. Note
+        that create() does not reload modules that are already imported.
+        '''
+        module = _registry.get_module(instype, do_reload=True)
         return module is not None
 
     def reload(self, ins):
@@ -349,10 +534,9 @@ class Instruments(SharedGObject):
         driver by implementing a detect_instruments() function.
         '''
 
-        module = _get_driver_module(driver)
+        module = _registry.get_module(driver)
         if module is None:
             return False
-        reload(module)
 
         if not hasattr(module, 'detect_instruments'):
             logging.warning('Driver does not support instrument detection')
@@ -380,6 +564,7 @@ class Instruments(SharedGObject):
             # (self._instruments[name]).remove()
             del self._instruments[name]
             del self._instruments_info[name]
+            probescheduler.get_scheduler().remove_instrument(name)
 
         self.emit('instrument-removed', name)
 
@@ -416,6 +601,7 @@ class Instruments(SharedGObject):
 _config = get_config()
 _insdir = _set_insdir()
 _user_insdir = _set_user_insdir()
+_registry = DriverRegistry([_user_insdir, _insdir])
 
 _instruments = None
 def get_instruments():
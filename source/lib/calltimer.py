@@ -23,6 +23,7 @@ import gtk
 #gtk.gdk.threads_init()
 
 import threading
+import collections
 import time
 from misc import exact_time
 
@@ -48,21 +49,148 @@ class GObjectThread(threading.Thread, ThreadSafeGObject):
 
         self.stop = ThreadVariable(False)
 
+class _LockWaiter():
+    def __init__(self):
+        self.event = threading.Event()
+        self.granted = False
+
 class TimedLock():
-    def __init__(self, delay=1.0):
-        self._lock = threading.Lock()
+    '''
+    Lock with a timeout that is granted to waiting threads in FIFO order.
+
+    Each waiting thread waits on its own event, which release() sets to
+    hand the lock over directly to the first waiter; a waiter that times
+    out removes itself from the queue. Statistics of the wait and hold
+    times and of the contention are kept, see get_stats().
+    '''
+
+    def __init__(self, delay=1.0, name=None):
+        '''
+        Input:
+            delay (float): default timeout in seconds for acquire(), None
+                to wait forever
+            name (string): name used in log messages
+        '''
+
         self._delay = delay
+        self._name = name
+        self._mutex = threading.Lock()
+        self._locked = False
+        self._waiters = collections.deque()
+        self._acquired_at = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self._mutex.acquire()
+        try:
+            self._stats = {
+                'acquired': 0,
+                'contended': 0,
+                'timeouts': 0,
+                'wait_time': 0.0,
+                'max_wait_time': 0.0,
+                'hold_time': 0.0,
+                'max_hold_time': 0.0,
+            }
+        finally:
+            self._mutex.release()
+
+    def acquire(self, timeout=-1):
+        '''
+        Acquire the lock, waiting at most timeout seconds (default: the
+        delay given to the constructor, None to wait forever).
+
+        Output: True if the lock was acquired, False on a timeout.
+        '''
+
+        if timeout == -1:
+            timeout = self._delay
+
+        start = exact_time()
+        self._mutex.acquire()
+        if not self._locked and len(self._waiters) == 0:
+            self._locked = True
+            self._acquired_at = start
+            self._stats['acquired'] += 1
+            self._mutex.release()
+            return True
 
-    def acquire(self):
-        n = int(self._delay / 0.01)
-        for i in range(n):
-            if self._lock.acquire(False):
-                return True
-            time.sleep(0.01)
-        return False
+        waiter = _LockWaiter()
+        self._waiters.append(waiter)
+        self._stats['contended'] += 1
+        self._mutex.release()
+
+        waiter.event.wait(timeout)
+
+        waited = exact_time() - start
+        self._mutex.acquire()
+        try:
+            # release() may have granted the lock after the timeout
+            if not waiter.granted:
+                self._waiters.remove(waiter)
+            self._stats['wait_time'] += waited
+            if waited > self._stats['max_wait_time']:
+                self._stats['max_wait_time'] = waited
+            if waiter.granted:
+                self._stats['acquired'] += 1
+            else:
+                self._stats['timeouts'] += 1
+        finally:
+            self._mutex.release()
+
+        if not waiter.granted:
+            logging.debug('Timeout acquiring lock %s after %.3f s',
+                    self._name, waited)
+        return waiter.granted
 
     def release(self):
-        self._lock.release()
+        '''Release the lock, hand it over to the first waiting thread.'''
+
+        now = exact_time()
+        self._mutex.acquire()
+        try:
+            if not self._locked:
+                raise ValueError('Releasing an unlocked lock')
+
+            held = now - self._acquired_at
+            self._stats['hold_time'] += held
+            if held > self._stats['max_hold_time']:
+                self._stats['max_hold_time'] = held
+
+            if len(self._waiters) > 0:
+                waiter = self._waiters.popleft()
+                waiter.granted = True
+                self._acquired_at = now
+                waiter.event.set()
+            else:
+                self._locked = False
+        finally:
+            self._mutex.release()
+
+    def locked(self):
+        return self._locked
+
+    def get_stats(self):
+        '''
+        Return a dictionary with the number of acquisitions, contended
+        acquisitions and timeouts, the total and maximum wait and hold
+        times (seconds) and the number of threads currently waiting.
+        '''
+
+        self._mutex.acquire()
+        try:
+            stats = dict(self._stats)
+            stats['waiting'] = len(self._waiters)
+            stats['locked'] = self._locked
+        finally:
+            self._mutex.release()
+        if stats['acquired'] > 0:
+            stats['mean_wait_time'] = stats['wait_time'] / stats['acquired']
+            stats['mean_hold_time'] = stats['hold_time'] / stats['acquired']
+        else:
+            stats['mean_wait_time'] = 0.0
+            stats['mean_hold_time'] = 0.0
+        return stats
 
 class ThreadVariable():
     def __init__(self, value=None):
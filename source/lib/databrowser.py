@@ -1,29 +1,135 @@
 import os
 import re
+import time
+import json
+import hashlib
+import logging
+import sqlite3
+
+from lib.file_support import binfile
+
+DATA_EXTENSIONS = ('.dat', binfile.EXTENSION)
+
+def get_index_dir():
+    '''
+    Return the directory for index files in the user cache directory, so
+    that nothing is written into the measurement data folders.
+    '''
+
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME',
+                os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'qtlab', 'databrowser')
+
+def get_index_file(dir):
+    '''Return the default index file for data directory dir.'''
+    dir = os.path.abspath(dir)
+    name = os.path.basename(dir.rstrip(os.sep)) or 'root'
+    digest = hashlib.md5(dir).hexdigest()[:10]
+    return os.path.join(get_index_dir(), '%s_%s.sqlite' % (name, digest))
+
+_TIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+def parse_timestamp(ts):
+    '''
+    Convert a timestamp as written in data files (time.asctime() format)
+    to seconds since the epoch, return None if it can not be parsed.
+    '''
+    try:
+        return time.mktime(time.strptime(ts.strip(), '%a %b %d %H:%M:%S %Y'))
+    except (ValueError, AttributeError):
+        return None
+
+def _to_seconds(t):
+    '''
+    Convert t, which is None, seconds since the epoch, a time tuple or a
+    string formatted as 'YYYY-mm-dd[ HH:MM[:SS]]', to seconds since the
+    epoch.
+    '''
+
+    if t is None or isinstance(t, (int, long, float)):
+        return t
+    if isinstance(t, (tuple, time.struct_time)):
+        return time.mktime(t)
+    for fmt in _TIME_FORMATS:
+        try:
+            return time.mktime(time.strptime(t.strip(), fmt))
+        except ValueError:
+            pass
+    raise ValueError('Unable to parse time %r' % (t, ))
+
+def _to_float(val):
+    try:
+        return float(val)
+    except (ValueError, TypeError):
+        return None
 
 class DataInfo:
+    '''
+    Header information of a data file. The metadata is read when it is
+    first needed, unless it was already provided (e.g. by the index).
+    '''
 
     RE_META = re.compile('\A\s*#\s*(\w+)\s*:\s*([\w\s,.:;]+)')
     RE_META_KEY = re.compile('\A\s*#\s*(\w+)\s*:')
+    RE_COLUMN = re.compile('\A\s*#\s*Column\s+(\d+)\s*:')
+    RE_COLUMN_OPT = re.compile('\A#\t(\w+)\s*:\s*(.*)')
 
-    def __init__(self, fn):
+    def __init__(self, fn, metadata=None):
         self._filename = None
-        self._metadata = {}
-        self.set_filename(fn)
+        self._metadata = None
+        self.set_filename(fn, metadata)
 
-    def set_filename(self, fn):
+    def set_filename(self, fn, metadata=None):
         self._filename = fn
-        self.read_info()
+        self._metadata = metadata
 
     def get_filename(self):
         return self._filename
 
     def get_metadata(self):
+        if self._metadata is None:
+            self.read_info()
         return self._metadata
 
+    def get_columns(self):
+        '''Return a list of column option dicts (name, type, units...).'''
+        return self.get_metadata().get('columns', [])
+
+    def get_settings(self):
+        '''Return the settings as a list of (instrument, parameter, value).'''
+        ret = []
+        ins = None
+        for line in self.get_metadata().get('settings', []):
+            if line.startswith('Instrument:'):
+                ins = line[len('Instrument:'):].strip()
+            elif line.startswith('\t') and ins is not None:
+                parts = line.strip().split(':', 1)
+                if len(parts) == 2:
+                    ret.append((ins, parts[0].strip(), parts[1].strip()))
+        return ret
+
+    def get_timestamp(self):
+        '''Return the time of the measurement in seconds since the epoch.'''
+        ts = parse_timestamp(self.get_metadata().get('Timestamp', ''))
+        if ts is None:
+            ts = os.path.getmtime(self._filename)
+        return ts
+
     def read_info(self):
         self._metadata = {}
+        if binfile.is_binary_file(self._filename):
+            self._read_binary_info()
+        else:
+            self._read_text_info()
+        self._check_settings_file()
+
+    def _read_text_info(self):
         self._metadata['header'] = []
+        self._metadata['columns'] = []
+        col = None
         f = open(self._filename, 'r')
         for line in f:
             line = line.rstrip('\r\n')
@@ -31,6 +137,16 @@ class DataInfo:
                 break
             self._metadata['header'].append(line)
 
+            m = self.RE_COLUMN.search(line)
+            if m is not None:
+                col = {}
+                self._metadata['columns'].append(col)
+                continue
+            m = self.RE_COLUMN_OPT.search(line)
+            if m is not None and col is not None:
+                col[m.group(1)] = m.group(2)
+                continue
+
             m = self.RE_META.search(line)
             if m is not None:
                 g = m.groups()
@@ -39,35 +155,313 @@ class DataInfo:
 
             m = self.RE_META_KEY.search(line)
             if m is not None:
-                self._metadata[g[0]] = {}
+                self._metadata[m.group(1)] = {}
+        f.close()
 
-        self._check_settings_file()
+    def _read_binary_info(self):
+        f = open(self._filename, 'rb')
+        try:
+            info, header_size = binfile.read_header(f)
+        finally:
+            f.close()
+
+        header = [
+            '# Filename: %s' % info.get('filename', ''),
+            '# Timestamp: %s' % info.get('timestamp', ''),
+        ]
+        header += ['# %s' % line for rowno, line in info['comments']]
+        columns = []
+        for i, dim in enumerate(info.get('dimensions', [])):
+            header.append('# Column %d:' % (i + 1))
+            col = {}
+            for key in sorted(dim.keys()):
+                header.append('#\t%s: %s' % (key, dim[key]))
+                col[key] = str(dim[key])
+            columns.append(col)
+
+        self._metadata['header'] = header
+        self._metadata['columns'] = columns
+        self._metadata['Filename'] = info.get('filename', '')
+        self._metadata['Timestamp'] = info.get('timestamp', '')
+
+    def _get_settings_filename(self):
+        return os.path.splitext(self._filename)[0] + '.set'
 
     def _check_settings_file(self):
-        fn = os.path.splitext(self._filename)[0] + '.set'
+        fn = self._get_settings_filename()
         if os.path.exists(fn):
             self._metadata['settings'] = []
             f = open(fn)
             for line in f:
                 line = line.rstrip('\r\n')
                 self._metadata['settings'].append(line)
+            f.close()
+
+class DataIndex:
+    '''
+    Persistent index of the data files in a directory tree, stored in an
+    SQLite database.
+
+    update() only reads the files (and their .set files) that are new or
+    have been modified since the last update, and removes files that no
+    longer exist. Queries by name, time, column name and instrument setting
+    use the indices of the database, so they do not touch the data files.
+    '''
+
+    _VERSION = 1
+
+    _SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS files ('
+            'id INTEGER PRIMARY KEY, path TEXT UNIQUE, name TEXT, '
+            'mtime REAL, size INTEGER, set_mtime REAL, timestamp REAL, '
+            'metadata TEXT)',
+        'CREATE TABLE IF NOT EXISTS columns ('
+            'file_id INTEGER, colnum INTEGER, name TEXT COLLATE NOCASE, '
+            'type TEXT, units TEXT)',
+        'CREATE TABLE IF NOT EXISTS settings ('
+            'file_id INTEGER, instrument TEXT COLLATE NOCASE, '
+            'parameter TEXT COLLATE NOCASE, value TEXT, numvalue REAL)',
+        'CREATE TABLE IF NOT EXISTS tags (file_id INTEGER, tag TEXT)',
+        'CREATE INDEX IF NOT EXISTS files_name ON files (name)',
+        'CREATE INDEX IF NOT EXISTS files_timestamp ON files (timestamp)',
+        'CREATE INDEX IF NOT EXISTS columns_file ON columns (file_id)',
+        'CREATE INDEX IF NOT EXISTS columns_name ON columns (name)',
+        'CREATE INDEX IF NOT EXISTS settings_file ON settings (file_id)',
+        'CREATE INDEX IF NOT EXISTS settings_par ON settings '
+            '(instrument, parameter, numvalue)',
+        'CREATE INDEX IF NOT EXISTS tags_file ON tags (file_id)',
+        'CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag)',
+    )
+
+    def __init__(self, dbfile):
+        '''
+        Open (or create) the index stored in dbfile. If the file can not
+        be opened the index is kept in memory.
+        '''
+
+        self._dbfile = dbfile
+        try:
+            self._db = sqlite3.connect(dbfile)
+            self._create_tables()
+        except sqlite3.Error, e:
+            logging.warning('Unable to open data index %s (%s), keeping it in memory',
+                    dbfile, e)
+            self._db = sqlite3.connect(':memory:')
+            self._create_tables()
+        self._db.text_factory = str
+
+    def _create_tables(self):
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version != self._VERSION:
+            for table in ('files', 'columns', 'settings', 'tags'):
+                self._db.execute('DROP TABLE IF EXISTS %s' % table)
+        for statement in self._SCHEMA:
+            self._db.execute(statement)
+        self._db.execute('PRAGMA user_version = %d' % self._VERSION)
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def update(self, dir):
+        '''
+        Index new and modified data files in dir and its subdirectories and
+        remove deleted files from the index.
+
+        Output:
+            (number of files indexed, number of files removed)
+        '''
+
+        known = {}
+        prefix = os.path.join(dir, '')
+        for row in self._db.execute('SELECT id, path, mtime, size, set_mtime '
+                'FROM files WHERE substr(path, 1, ?) = ?', (len(prefix), prefix)):
+            known[row[1]] = row
+
+        nindexed = 0
+        for root, dirs, files in os.walk(dir):
+            dirs.sort()
+            for name in files:
+                if os.path.splitext(name)[1] not in DATA_EXTENSIONS:
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                setfn = os.path.splitext(path)[0] + '.set'
+                set_mtime = None
+                if os.path.exists(setfn):
+                    set_mtime = os.path.getmtime(setfn)
+
+                row = known.pop(path, None)
+                if row is not None and row[2:] == (st.st_mtime, st.st_size, set_mtime):
+                    continue
+                try:
+                    self._add_file(path, st, set_mtime, row and row[0])
+                    nindexed += 1
+                except Exception, e:
+                    logging.warning('Unable to index %s: %s', path, e)
+
+        for row in known.values():
+            self._remove_file(row[0])
+        self._db.commit()
+        return nindexed, len(known)
+
+    def _remove_file(self, file_id):
+        self._db.execute('DELETE FROM columns WHERE file_id = ?', (file_id, ))
+        self._db.execute('DELETE FROM settings WHERE file_id = ?', (file_id, ))
+        self._db.execute('DELETE FROM tags WHERE file_id = ?', (file_id, ))
+        self._db.execute('DELETE FROM files WHERE id = ?', (file_id, ))
+
+    def _add_file(self, path, st, set_mtime, file_id=None):
+        info = DataInfo(path)
+        meta = info.get_metadata()
+        ts = parse_timestamp(meta.get('Timestamp', ''))
+        if ts is None:
+            ts = st.st_mtime
+
+        if file_id is not None:
+            self._remove_file(file_id)
+        cur = self._db.execute('INSERT INTO files (path, name, mtime, size, '
+                'set_mtime, timestamp, metadata) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (path, os.path.basename(path), st.st_mtime, st.st_size,
+                set_mtime, ts, json.dumps(meta)))
+        file_id = cur.lastrowid
+
+        self._db.executemany('INSERT INTO columns VALUES (?, ?, ?, ?, ?)',
+                [(file_id, i, col.get('name'), col.get('type'), col.get('units'))
+                    for i, col in enumerate(info.get_columns())])
+        self._db.executemany('INSERT INTO settings VALUES (?, ?, ?, ?, ?)',
+                [(file_id, ins, par, val, _to_float(val))
+                    for ins, par, val in info.get_settings()])
+        self._db.executemany('INSERT INTO tags VALUES (?, ?)',
+                [(file_id, tag) for tag in meta.keys()])
+
+    def query(self, match='', starttime=None, endtime=None, after=None,
+            before=None, column=None, settings=None, dir=None):
+        '''
+        Return the sorted paths of the indexed files that satisfy all given
+        conditions.
+
+        Input:
+            match (str): substring of the filename (case sensitive)
+            starttime, endtime (str): range of the 6-digit time at the
+                front of the filename
+            after, before: range of the measurement timestamp, in seconds
+                since the epoch, as a time tuple or as a string
+                'YYYY-mm-dd[ HH:MM[:SS]]'
+            column (str): name of a column in the file
+            settings (dict): instrument settings, keys are
+                'instrument.parameter', values either a value or a
+                (min, max) tuple for a numerical range
+            dir (str): only return files in this directory tree
+        '''
+
+        where = []
+        args = []
+        if match:
+            where.append('instr(name, ?) > 0')
+            args.append(match)
+        if starttime is not None or endtime is not None:
+            where.append('substr(name, 1, 6) BETWEEN ? AND ?')
+            args += [starttime or '000000', endtime or '240000']
+        if after is not None:
+            where.append('timestamp >= ?')
+            args.append(_to_seconds(after))
+        if before is not None:
+            where.append('timestamp <= ?')
+            args.append(_to_seconds(before))
+        if column:
+            where.append('id IN (SELECT file_id FROM columns WHERE name = ?)')
+            args.append(column)
+        if dir is not None:
+            prefix = os.path.join(dir, '')
+            where.append('substr(path, 1, ?) = ?')
+            args += [len(prefix), prefix]
+
+        for key, val in (settings or {}).items():
+            ins, par = key.split('.', 1)
+            cond = 'SELECT file_id FROM settings WHERE instrument = ? AND parameter = ? AND '
+            args += [ins, par]
+            if isinstance(val, tuple):
+                cond += 'numvalue BETWEEN ? AND ?'
+                args += [val[0], val[1]]
+            elif _to_float(val) is not None:
+                cond += 'numvalue = ?'
+                args.append(_to_float(val))
+            else:
+                cond += 'value = ?'
+                args.append(val)
+            where.append('id IN (%s)' % cond)
+
+        sql = 'SELECT path FROM files'
+        if len(where) > 0:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY path'
+        return [row[0] for row in self._db.execute(sql, args)]
+
+    def get_info(self, path):
+        '''Return a DataInfo for path from the index, or None.'''
+        row = self._db.execute('SELECT metadata FROM files WHERE path = ?',
+                (path, )).fetchone()
+        if row is None:
+            return None
+        return DataInfo(path, json.loads(row[0]))
+
+    def get_meta_tags(self):
+        '''Return the metadata keys that occur in the indexed files.'''
+        return set([row[0] for row in self._db.execute(
+                'SELECT DISTINCT tag FROM tags')])
+
+    def get_column_names(self):
+        return [row[0] for row in self._db.execute(
+                'SELECT DISTINCT name FROM columns ORDER BY name')]
 
 class Browser:
 
-    def __init__(self, dir=None):
+    def __init__(self, dir=None, index_file=None):
+        '''
+        Browse the data files in dir and its subdirectories. The files are
+        indexed in index_file, by default a file in the user cache
+        directory (see get_index_file()).
+        '''
+
         self._dir = None
-        self._entries = []
-        self.set_dir(dir)
+        self._index = None
+        self._index_file = index_file
+        if dir is not None:
+            self.set_dir(dir)
 
     def set_dir(self, dir):
         self._dir = dir
-        self._entries = []
-        self._walk_dir(self._dir, recurse=True)
+        if self._index is not None:
+            self._index.close()
+        index_file = self._index_file
+        if index_file is None:
+            index_file = get_index_file(dir)
+            try:
+                if not os.path.isdir(get_index_dir()):
+                    os.makedirs(get_index_dir())
+            except OSError, e:
+                logging.warning('Unable to create index directory: %s', e)
+        self._index = DataIndex(index_file)
+        self.update()
+
+    def get_dir(self):
+        return self._dir
+
+    def update(self):
+        '''Update the index for files that were added, changed or removed.'''
+        start = time.time()
+        nindexed, nremoved = self._index.update(self._dir)
+        logging.debug('Indexed %d files, removed %d in %.3f s',
+                nindexed, nremoved, time.time() - start)
 
     def get_entries(self):
-        return self._entries
+        return [self._index.get_info(fn) for fn in self.get_filenames()]
 
-    def get_filenames(self, match='', starttime=None, endtime=None):
+    def get_filenames(self, match='', starttime=None, endtime=None, **kwargs):
         '''
         Return filenames of entries matching 'match'. If match is an empty
         string it returns all filenames.
@@ -75,45 +469,19 @@ class Browser:
         a specific range of the matched data files, based on the 6-digit
         timestamp at the front of a filename. 'starttime' and 'endtime' must
         be specified as a 6-digit string.
+
+        Other conditions (after, before, column and settings) are passed
+        to DataIndex.query().
         '''
 
-        usetimes = False
-        if starttime is not None or endtime is not None:
-            usetimes = True
-            if starttime is None:
-                starttime = '000000'
-            if endtime is None:
-                endtime = '240000'
-
-        ret = []
-        for info in self._entries:
-            fn = info.get_filename()
-            fnr = os.path.split(fn)[1]
-            if not usetimes and fnr.count(match) > 0:
-                ret.append(fn)
-            elif usetimes and fnr.count(match) > 0 and starttime <= fnr[:6] <= endtime:
-                ret.append(fn)
-        ret.sort()
-        return ret
+        return self._index.query(match, starttime, endtime, dir=self._dir,
+                **kwargs)
 
     def get_entry(self, fn):
-        for i in self._entries:
-            if i.get_filename() == fn:
-                return i
-        return None
-
-    def _walk_dir(self, dir, recurse=False):
-        entries = os.listdir(dir)
-        for i in entries:
-            fullfn = os.path.join(dir, i)
-            if os.path.isdir(fullfn):
-                if recurse:
-                    self._walk_dir(fullfn)
-            else:
-                fn, ext = os.path.splitext(i)
-                if ext == '.dat':
-                    self._add_data_entry(fullfn)
+        return self._index.get_info(fn)
 
-    def _add_data_entry(self, fn):
-        self._entries.append(DataInfo(fn))
+    def get_meta_tags(self):
+        return self._index.get_meta_tags()
 
+    def get_column_names(self):
+        return self._index.get_column_names()
@@ -0,0 +1,211 @@
+# asyncwriter.py, write data files in a background thread
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import sys
+import time
+import logging
+import threading
+import Queue
+
+from lib.file_support.flushpolicy import FlushPolicy
+
+class AsyncWriter(threading.Thread):
+    '''
+    Thread that performs file writes queued by put(), in order.
+
+    The queue is bounded, so put() blocks if the disk can not keep up.
+    If a write fails, the exception is raised by every later call to
+    put(), flush(), drain() or close(); later writes are discarded, so
+    the file does not silently get a gap.
+
+    The file is flushed with flush_func according to the flush policy
+    (see FlushPolicy): after flush_rows rows (if larger than 0), or when
+    flush_interval seconds passed since the last flush.
+    '''
+
+    def __init__(self, flush_func=None, maxsize=1000, flush_rows=0,
+            flush_interval=1.0, name='AsyncWriter'):
+        threading.Thread.__init__(self, name=name)
+        self.setDaemon(True)
+
+        self._queue = Queue.Queue(maxsize)
+        self._flush_func = flush_func
+        # Used in the writer thread, which has no main loop for a timer
+        self._flush_policy = FlushPolicy(self._run_flush, flush_rows,
+                flush_interval, use_timer=False)
+        self._error = None
+        self._closed = False
+
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'items': 0,
+            'rows': 0,
+            'flushes': 0,
+            'max_queue_depth': 0,
+            'write_time': 0.0,
+            'max_write_time': 0.0,
+            'last_write_time': 0.0,
+            'blocked_time': 0.0,
+            'nblocked': 0,
+        }
+
+    def set_flush_policy(self, rows, interval):
+        self._flush_policy.set(rows, interval)
+
+    def put(self, func, args=(), nrows=None):
+        '''
+        Queue func(*args). nrows is the number of data rows written by
+        func; if None, the return value of func is used.
+        '''
+
+        self.check()
+        if self._closed:
+            raise ValueError('Writer %s is closed' % self.getName())
+
+        try:
+            self._queue.put_nowait((func, args, nrows))
+        except Queue.Full:
+            start = time.time()
+            self._queue.put((func, args, nrows))
+            blocked = time.time() - start
+            self._stats_lock.acquire()
+            try:
+                self._stats['blocked_time'] += blocked
+                self._stats['nblocked'] += 1
+                first = self._stats['nblocked'] == 1
+            finally:
+                self._stats_lock.release()
+            if first:
+                logging.warning('%s: queue full, waited %.3f s for the disk',
+                        self.getName(), blocked)
+
+        depth = self._queue.qsize()
+        self._stats_lock.acquire()
+        try:
+            if depth > self._stats['max_queue_depth']:
+                self._stats['max_queue_depth'] = depth
+        finally:
+            self._stats_lock.release()
+
+    def flush(self):
+        '''Queue a flush of the file.'''
+        self.put(self._flush, nrows=0)
+
+    def drain(self):
+        '''Wait until all queued writes are done.'''
+        self._queue.join()
+        self.check()
+
+    def close(self):
+        '''Write everything that is queued, flush and stop the thread.'''
+
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self.join()
+        self.check()
+
+    def check(self):
+        '''Raise the exception of a failed write, if any.'''
+
+        error = self._error
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+    def get_queue_depth(self):
+        return self._queue.qsize()
+
+    def get_stats(self):
+        '''
+        Return a dict with statistics: number of items and rows written,
+        current and maximum queue depth, total, maximum, last and mean
+        time per write (seconds), number of flushes and the number of
+        times and total time put() had to wait for a full queue.
+        '''
+
+        self._stats_lock.acquire()
+        try:
+            stats = dict(self._stats)
+        finally:
+            self._stats_lock.release()
+
+        stats['queue_depth'] = self._queue.qsize()
+        if stats['items'] > 0:
+            stats['mean_write_time'] = stats['write_time'] / stats['items']
+        else:
+            stats['mean_write_time'] = 0.0
+        return stats
+
+    def _flush(self):
+        if self._flush_func is not None:
+            self._flush_func()
+        self._flush_policy.flushed()
+        self._stats_lock.acquire()
+        try:
+            self._stats['flushes'] += 1
+        finally:
+            self._stats_lock.release()
+
+    def run(self):
+        while True:
+            try:
+                item = self._queue.get(True, self._flush_policy.get_timeout())
+            except Queue.Empty:
+                self._run_flush()
+                continue
+
+            if item is None:
+                self._run_flush()
+                self._queue.task_done()
+                break
+
+            if self._error is None:
+                self._run_item(*item)
+            self._queue.task_done()
+
+    def _run_item(self, func, args, nrows):
+        start = time.time()
+        try:
+            ret = func(*args)
+        except Exception, e:
+            logging.exception('%s: write failed', self.getName())
+            self._error = sys.exc_info()
+            return
+        dt = time.time() - start
+
+        if nrows is None:
+            nrows = ret
+        self._stats_lock.acquire()
+        try:
+            self._stats['items'] += 1
+            self._stats['rows'] += nrows
+            self._stats['write_time'] += dt
+            self._stats['last_write_time'] = dt
+            if dt > self._stats['max_write_time']:
+                self._stats['max_write_time'] = dt
+        finally:
+            self._stats_lock.release()
+
+        self._flush_policy.add_rows(nrows)
+
+    def _run_flush(self):
+        if self._error is not None:
+            return
+        try:
+            self._flush()
+        except Exception, e:
+            logging.exception('%s: flush failed', self.getName())
+            self._error = sys.exc_info()
@@ -0,0 +1,248 @@
+# binfile.py, binary data file format for qtlab Data objects
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Binary data files (extension .bin, e.g. 123456_name.dat.bin).
+
+The file starts with a header region of fixed size:
+    magic (8 bytes), version (uint32), header size (uint32) and the
+    length of the header text (uint32), all little-endian, followed by
+    the header as JSON text, padded with spaces.
+The header contains the column metadata (as written to the header of
+.dat files), the file name and the timestamp.
+
+Comments and block ends are appended to an index file next to the data
+file (extension .idx, e.g. 123456_name.dat.bin.idx) while the data is
+written, one JSON list per line:
+    ["comment", row number, text]
+    ["block", number of rows in the block]
+The index can grow without limit and is never rewritten during a
+measurement.
+
+After the header region the rows follow as little-endian float64 values
+in row-major order. The number of rows follows from the file size, so a
+file that is still being written can always be read.
+'''
+
+import os
+import struct
+import json
+import numpy
+
+MAGIC = 'QTLABBIN'
+VERSION = 1
+HEADER_SIZE = 65536
+DTYPE = numpy.dtype('<f8')
+EXTENSION = '.bin'
+INDEX_EXTENSION = '.idx'
+
+_PREFIX = struct.Struct('<8sIII')
+
+def is_binary_file(filepath):
+    return filepath.endswith(EXTENSION)
+
+def get_index_path(filepath):
+    '''Return the path of the index file for binary data file filepath.'''
+    return filepath + INDEX_EXTENSION
+
+def _to_json(val):
+    '''Convert val to something that can be stored as JSON.'''
+    if val is None or isinstance(val, (bool, int, long, float, basestring)):
+        return val
+    elif isinstance(val, numpy.generic):
+        return val.item()
+    elif isinstance(val, (list, tuple)):
+        return [_to_json(v) for v in val]
+    elif isinstance(val, dict):
+        return dict([(str(k), _to_json(v)) for k, v in val.iteritems()])
+    else:
+        return str(val)
+
+def _from_json(val):
+    '''Convert unicode strings in val back to str where possible.'''
+    if isinstance(val, unicode):
+        try:
+            return str(val)
+        except UnicodeEncodeError:
+            return val
+    elif isinstance(val, list):
+        return [_from_json(v) for v in val]
+    elif isinstance(val, dict):
+        return dict([(str(k), _from_json(v)) for k, v in val.iteritems()])
+    else:
+        return val
+
+class BinFileWriter:
+    '''
+    Writer for binary data files. Rows are written with write(), which
+    expects the raw bytes; comments and block ends are added to the index
+    with add_comment() and add_block().
+    '''
+
+    def __init__(self, filepath, ncols, header_size=HEADER_SIZE):
+        self._filepath = filepath
+        self._ncols = ncols
+        self._header_size = header_size
+        self._header_len = 0
+        self._file = open(filepath, 'w+b')
+        self._file.write(' ' * header_size)
+        self._index = open(get_index_path(filepath), 'w')
+
+    def write_header(self, info):
+        '''
+        Write the header. info is a dict with the key 'dimensions', other
+        keys are stored as well.
+        '''
+
+        header = dict(info)
+        header['version'] = VERSION
+        header['ncols'] = self._ncols
+        header['dtype'] = DTYPE.str
+        text = json.dumps(_to_json(header))
+
+        if _PREFIX.size + len(text) > self._header_size:
+            raise ValueError('Header of %s does not fit in %d bytes' % \
+                    (self._filepath, self._header_size))
+
+        pos = self._file.tell()
+        self._file.seek(0)
+        self._file.write(_PREFIX.pack(MAGIC, VERSION, self._header_size,
+                len(text)))
+        self._file.write(text)
+        if len(text) < self._header_len:
+            self._file.write(' ' * (self._header_len - len(text)))
+        self._header_len = len(text)
+        self._file.seek(pos)
+
+    def _write_index_entry(self, entry):
+        self._index.write(json.dumps(_to_json(entry)) + '\n')
+
+    def add_comment(self, rowno, comment):
+        '''Add a comment before row rowno to the index.'''
+        self._write_index_entry(['comment', rowno, comment])
+
+    def add_block(self, size):
+        '''Add the end of a block of size rows to the index.'''
+        self._write_index_entry(['block', size])
+
+    def write_index(self, comments, block_sizes):
+        '''Replace the index by comments [(rowno, text)] and block_sizes.'''
+        self._index.seek(0)
+        self._index.truncate()
+        for rowno, comment in comments:
+            self.add_comment(rowno, comment)
+        for size in block_sizes:
+            self.add_block(size)
+
+    def write(self, data):
+        self._file.write(data)
+
+    def flush(self):
+        self._file.flush()
+        self._index.flush()
+
+    def close(self):
+        self._file.close()
+        self._index.close()
+
+    def get_file(self):
+        return self._file
+
+def read_header(f):
+    '''Read the header from open file f, return (info, header size).'''
+
+    f.seek(0)
+    prefix = f.read(_PREFIX.size)
+    if len(prefix) < _PREFIX.size:
+        raise ValueError('File too short for a binary data file')
+    magic, version, header_size, header_len = _PREFIX.unpack(prefix)
+    if magic != MAGIC:
+        raise ValueError('Not a binary data file')
+    if version != VERSION:
+        raise ValueError('Unsupported binary data file version %d' % version)
+
+    info = _from_json(json.loads(f.read(header_len)))
+    info['comments'] = []
+    info['block_sizes'] = []
+
+    filepath = getattr(f, 'name', None)
+    if filepath is not None:
+        comments, block_sizes = read_index(get_index_path(filepath))
+        info['comments'] = comments
+        info['block_sizes'] = block_sizes
+
+    return info, header_size
+
+def read_index(indexpath):
+    '''
+    Read an index file, return (comments, block sizes). A last line that
+    is still being written is ignored.
+    '''
+
+    comments = []
+    block_sizes = []
+    if not os.path.exists(indexpath):
+        return comments, block_sizes
+
+    f = open(indexpath, 'r')
+    try:
+        for line in f:
+            if not line.endswith('\n'):
+                break
+            try:
+                entry = _from_json(json.loads(line))
+            except ValueError:
+                break
+            if entry[0] == 'comment':
+                comments.append((entry[1], entry[2]))
+            elif entry[0] == 'block':
+                block_sizes.append(entry[1])
+    finally:
+        f.close()
+
+    return comments, block_sizes
+
+def load(filepath, mmap=True):
+    '''
+    Load a binary data file and return (data, info). If mmap is True the
+    data is memory-mapped copy-on-write, so only the parts that are used
+    are read from disk.
+    '''
+
+    f = open(filepath, 'rb')
+    try:
+        info, header_size = read_header(f)
+        ncols = info['ncols']
+        dtype = numpy.dtype(str(info.get('dtype', DTYPE.str)))
+        nbytes = os.fstat(f.fileno()).st_size - header_size
+        if ncols == 0:
+            nrows = 0
+        else:
+            nrows = max(nbytes, 0) / (ncols * dtype.itemsize)
+
+        if nrows == 0:
+            data = numpy.empty((0, ncols), dtype=dtype)
+        elif mmap:
+            data = numpy.memmap(filepath, dtype=dtype, mode='c',
+                    offset=header_size, shape=(nrows, ncols))
+        else:
+            f.seek(header_size)
+            data = numpy.fromfile(f, dtype=dtype, count=nrows * ncols)
+            data = data.reshape((nrows, ncols))
+    finally:
+        f.close()
+
+    return data, info
@@ -0,0 +1,243 @@
+# datcache.py, cache for parsed data files
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import logging
+import hashlib
+import cPickle
+import numpy
+
+# Number of bytes at the start of a data file that are hashed
+HEADER_BYTES = 65536
+
+class DataCache:
+    '''
+    Cache for parsed data files, stored in a directory.
+
+    For every data file the parsed array is stored in a .npy file, which
+    is memory-mapped when it is loaded again, and the other information
+    (comments, block sizes, loop shape, ...) in a pickled .meta file.
+
+    An entry is only used if the size and modification time of the data
+    file, and optionally a hash of its first bytes, did not change. Files
+    that are still being written are therefore parsed again.
+
+    If max_size is larger than 0, the least recently used entries are
+    removed when the total size of the cache exceeds max_size bytes.
+    '''
+
+    VERSION = 1
+
+    def __init__(self, path, max_size=0, check_header=True, mmap=True):
+        '''
+        Input:
+            path (string): cache directory
+            max_size (int): maximum size of the cache in bytes, 0 for
+                no limit
+            check_header (bool): whether to validate entries with a hash
+                of the first bytes of the data file
+            mmap (bool): whether to memory-map cached arrays (copy on
+                write, so the arrays can still be modified)
+        '''
+
+        self._path = path
+        self._max_size = max_size
+        self._check_header = check_header
+        self._mmap = mmap
+
+    def get_path(self):
+        return self._path
+
+    def _get_basename(self, filepath):
+        '''Return the path of the cache entry for filepath, without extension.'''
+        filepath = os.path.abspath(filepath)
+        name = os.path.splitext(os.path.basename(filepath))[0]
+        digest = hashlib.md5(filepath).hexdigest()[:10]
+        return os.path.join(self._path, '%s_%s' % (name, digest))
+
+    def get_key(self, filepath):
+        '''
+        Return the key that identifies the current contents of filepath.
+        Call this before parsing the file, so that an entry stored for a
+        file that changes while it is parsed becomes invalid.
+        '''
+
+        st = os.stat(filepath)
+        key = {
+            'path': os.path.abspath(filepath),
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+        }
+        if self._check_header:
+            f = open(filepath, 'rb')
+            try:
+                key['header'] = hashlib.md5(f.read(HEADER_BYTES)).hexdigest()
+            finally:
+                f.close()
+        return key
+
+    def load(self, filepath, key=None):
+        '''
+        Return a (data, info) tuple for filepath, or None if there is no
+        valid cache entry.
+        '''
+
+        base = self._get_basename(filepath)
+        if not os.path.exists(base + '.meta'):
+            return None
+
+        try:
+            if key is None:
+                key = self.get_key(filepath)
+
+            f = open(base + '.meta', 'rb')
+            try:
+                meta = cPickle.load(f)
+            finally:
+                f.close()
+
+            if meta.get('version') != self.VERSION or meta['key'] != key:
+                logging.debug('Cache entry for %s is out of date', filepath)
+                return None
+
+            if self._mmap:
+                data = numpy.load(base + '.npy', mmap_mode='c')
+            else:
+                data = numpy.load(base + '.npy')
+            if data.shape != meta['shape']:
+                logging.warning('Cache entry %s is incomplete', base)
+                return None
+
+        except Exception, e:
+            logging.warning('Unable to load cache entry %s: %s', base, e)
+            return None
+
+        # Mark as recently used
+        try:
+            os.utime(base + '.meta', None)
+        except OSError:
+            pass
+
+        return data, meta['info']
+
+    def store(self, filepath, data, info, key=None):
+        '''
+        Store data and info (a picklable dict) for filepath. key should
+        be obtained with get_key() before the file was parsed.
+        '''
+
+        base = self._get_basename(filepath)
+        data = numpy.asarray(data)
+        try:
+            if key is None:
+                key = self.get_key(filepath)
+            if not os.path.isdir(self._path):
+                os.makedirs(self._path)
+
+            # Remove the old entry first, so that an incomplete entry is
+            # never used.
+            self._remove_entry(base)
+
+            f = open(base + '.npy.tmp', 'wb')
+            try:
+                numpy.save(f, data)
+            finally:
+                f.close()
+            os.rename(base + '.npy.tmp', base + '.npy')
+
+            meta = {
+                'version': self.VERSION,
+                'key': key,
+                'shape': data.shape,
+                'info': info,
+            }
+            f = open(base + '.meta.tmp', 'wb')
+            try:
+                cPickle.dump(meta, f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(base + '.meta.tmp', base + '.meta')
+
+        except Exception, e:
+            logging.warning('Unable to store cache entry for %s: %s',
+                    filepath, e)
+            self._remove_entry(base)
+            return False
+
+        self._limit_size(keep=base)
+        return True
+
+    def remove(self, filepath):
+        '''Remove the cache entry for filepath.'''
+        self._remove_entry(self._get_basename(filepath))
+
+    def _remove_entry(self, base):
+        for ext in ('.meta', '.meta.tmp', '.npy', '.npy.tmp'):
+            if os.path.exists(base + ext):
+                try:
+                    os.remove(base + ext)
+                except OSError, e:
+                    logging.warning('Unable to remove cache file %s: %s',
+                            base + ext, e)
+
+    def _get_entries(self):
+        '''Return a list of (last used, basename, size) tuples.'''
+
+        entries = []
+        if not os.path.isdir(self._path):
+            return entries
+
+        for fn in os.listdir(self._path):
+            if not fn.endswith('.meta'):
+                continue
+            base = os.path.join(self._path, fn[:-len('.meta')])
+            try:
+                used = os.path.getmtime(base + '.meta')
+                size = os.path.getsize(base + '.meta')
+                if os.path.exists(base + '.npy'):
+                    size += os.path.getsize(base + '.npy')
+            except OSError:
+                continue
+            entries.append((used, base, size))
+
+        return entries
+
+    def get_size(self):
+        '''Return the total size of the cache in bytes.'''
+        return sum([size for used, base, size in self._get_entries()])
+
+    def _limit_size(self, keep=None):
+        '''Remove least recently used entries until the cache fits.'''
+
+        if self._max_size <= 0:
+            return
+
+        entries = self._get_entries()
+        entries.sort()
+        total = sum([size for used, base, size in entries])
+        for used, base, size in entries:
+            if total <= self._max_size:
+                break
+            if base == keep:
+                continue
+            logging.debug('Removing cache entry %s', base)
+            self._remove_entry(base)
+            total -= size
+
+    def clear(self):
+        '''Remove all entries.'''
+        for used, base, size in self._get_entries():
+            self._remove_entry(base)
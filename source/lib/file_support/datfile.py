@@ -0,0 +1,362 @@
+# datfile.py, fast parser for the data part of qtlab .dat files
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import itertools
+import numpy
+
+from lib.growarray import GrowableArray
+
+# Number of bytes read from the file per chunk
+CHUNK_SIZE = 1 << 20
+
+class DatParser:
+    '''
+    Parser for qtlab .dat files.
+
+    Every chunk of lines is handled in two phases. First the chunk is
+    scanned to find blank lines (block separators), comments and data
+    rows. Comment lines are passed to comment_cb(line, line_number), where
+    line_number is the number of data rows preceding the comment. Then
+    all data rows of the chunk are converted at once with
+    numpy.fromstring(). Lines that can not be converted that way are
+    parsed one by one, so errors are reported as before.
+
+    The parser keeps its state between calls to feed(), so a file that is
+    still being written can be parsed incrementally. parse_file() keeps
+    track of the number of bytes of complete lines parsed (offset), so
+    parsing can continue from there when more lines were written.
+
+    If a row_mask is specified, rows for which the mask is False are
+    stored as NaN, and parsing stops after the last row for which the mask
+    is True. Blocks only count rows for which the mask is True.
+    '''
+
+    def __init__(self, comment_cb=None, row_mask=None, size_hint=0):
+        '''
+        Input:
+            comment_cb (function): called for each line containing a '#'
+            row_mask (array of bools): rows to load, all rows if None
+            size_hint (int): approximate file size in bytes, used to
+                estimate the number of rows to reserve space for
+        '''
+
+        self._comment_cb = comment_cb
+        self._size_hint = size_hint
+
+        if row_mask is not None:
+            row_mask = numpy.asarray(row_mask, dtype=bool)
+            kept = row_mask.nonzero()[0]
+            if len(kept) > 0:
+                self._last_row = kept[-1]
+            else:
+                self._last_row = -1
+        self._row_mask = row_mask
+
+        self._rows = None
+
+        # Index of the last data row seen, including masked rows
+        self.row_no = -1
+        # Number of columns in the first data row
+        self.ncols = None
+        # Maximum number of fields on a line
+        self.nfields = 0
+        self.block_sizes = []
+        self.blocksize = 0
+        self.max_blocksize = 0
+        # Whether a (not masked) data row has been seen
+        self.started = False
+        # Whether parsing stopped because no more rows are needed
+        self.finished = False
+        # Number of bytes of complete lines parsed by parse_file()
+        self.offset = 0
+        # Whether an incomplete last line was parsed, or held back
+        self.partial = False
+        self.held_partial = False
+
+    def parse_file(self, f, chunk_size=CHUNK_SIZE, hold_partial=False):
+        '''
+        Parse an open file until the end or until finished. The file
+        should be opened in binary mode and be positioned at offset.
+
+        If hold_partial is True a last line without newline, which might
+        still be being written, is not parsed.
+        '''
+
+        self.held_partial = False
+        while not self.finished:
+            lines = f.readlines(chunk_size)
+            if len(lines) == 0:
+                break
+
+            partial = None
+            if not lines[-1].endswith('\n'):
+                partial = lines.pop()
+
+            if len(lines) > 0:
+                self.feed(lines)
+                self.offset += sum(itertools.imap(len, lines))
+
+            if partial is not None:
+                if not hold_partial:
+                    self.feed([partial])
+                    self.partial = True
+                else:
+                    self.held_partial = True
+                break
+
+    def feed(self, lines):
+        '''
+        Parse a list of lines. Returns False if no more lines are needed.
+        '''
+
+        if self.finished:
+            return False
+
+        text = ''.join(lines)
+        if '\r\n' in text:
+            text = text.replace('\r\n', '\n')
+        if not self._can_scan_text(text):
+            self._scan_lines(lines)
+        else:
+            self._scan_text(text)
+
+        return not self.finished
+
+    def _can_scan_text(self, text):
+        '''
+        Return whether text can be scanned by _scan_text(), which requires
+        that blank lines are empty. Lines starting with white space are
+        left to the line by line scan.
+        '''
+        return '\r' not in text and '\n ' not in text and \
+                '\n\t' not in text and text[:1] not in (' ', '\t')
+
+    def _scan_text(self, text):
+        '''Scan a chunk of text, treating all lines at once.'''
+
+        lines = text.split('\n')
+        if len(lines[-1]) == 0:
+            lines.pop()
+        lengths = numpy.fromiter(itertools.imap(len, lines), dtype=int,
+                count=len(lines))
+        is_data = lengths > 0
+        rejoin = False
+
+        # Find lines with comments and strip the comments
+        comments = []
+        pos = text.find('#')
+        if pos != -1:
+            starts = numpy.cumsum(lengths + 1) - (lengths + 1)
+            while pos != -1:
+                lineno = starts.searchsorted(pos, 'right') - 1
+                line = lines[lineno]
+                commentpos = pos - starts[lineno]
+                comments.append((lineno, commentpos, line.rstrip(' \t')))
+                lines[lineno] = line[:commentpos]
+                is_data[lineno] = len(lines[lineno].split()) > 0
+                pos = text.find('\n', pos)
+                if pos != -1:
+                    pos = text.find('#', pos)
+            rejoin = True
+
+        nrows = int(is_data.sum())
+        first_row = self.row_no + 1
+
+        # Number of data rows preceding each line
+        nrows_before = numpy.cumsum(is_data) - is_data
+
+        # Stop after the last row selected by the mask. A comment on the
+        # first row that is not needed anymore is still reported.
+        if self._row_mask is not None:
+            nleft = self._last_row + 1 - first_row
+            if nrows > nleft:
+                cut = numpy.flatnonzero(is_data)[nleft]
+                comments = [c for c in comments if c[0] <= cut]
+                del lines[cut:]
+                lengths = lengths[:cut]
+                is_data = is_data[:cut]
+                nrows = nleft
+                rejoin = True
+                self.finished = True
+            kept = numpy.zeros(len(lines), dtype=bool)
+            kept[is_data] = self._row_mask[first_row:first_row + nrows]
+        else:
+            kept = is_data
+
+        if self._comment_cb is not None:
+            for lineno, commentpos, line in comments:
+                row_no = self.row_no + int(nrows_before[lineno])
+                if commentpos == 0:
+                    self._comment_cb(line, row_no + 1)
+                else:
+                    self._comment_cb(line, row_no)
+
+        # Count blocks, blank lines before the first data row are ignored.
+        # Only rows selected by the mask count.
+        nkept = int(kept.sum())
+        blanks = numpy.flatnonzero(lengths == 0)
+        ends = (numpy.cumsum(kept) - kept)[blanks]
+        if not self.started:
+            ends = ends[ends > 0]
+        if len(ends) > 0:
+            self.block_sizes.append(self.blocksize + int(ends[0]))
+            self.block_sizes.extend(numpy.diff(ends).tolist())
+            self.max_blocksize = max(self.max_blocksize,
+                    max(self.block_sizes[-len(ends):]))
+            self.blocksize = nkept - int(ends[-1])
+        else:
+            self.blocksize += nkept
+        if nkept > 0:
+            self.started = True
+
+        if nrows == 0:
+            return
+
+        self.row_no += nrows
+        if self.ncols is None:
+            self._init_rows(lines[is_data.argmax()])
+
+        if rejoin:
+            text = '\n'.join(lines)
+        values = numpy.fromstring(text, sep=' ')
+        if len(values) != nrows * self.ncols or \
+                not self._has_ncols_fields(text):
+            datalines = [lines[i] for i in numpy.flatnonzero(is_data)]
+            values = self._convert_slow(datalines)
+        values = values.reshape((nrows, self.ncols))
+
+        if self._row_mask is not None:
+            values[~self._row_mask[first_row:first_row + nrows]] = numpy.nan
+
+        self._rows.append(values)
+
+    def _has_ncols_fields(self, text):
+        '''
+        Return whether every line of text holding data has ncols white
+        space separated fields; the total alone does not show rows with
+        missing or extra values. Lines should not start with white space,
+        so that every ncols-th field has to start a line.
+        '''
+
+        b = numpy.frombuffer(text, dtype=numpy.uint8)
+        is_sep = b <= ord(' ')
+        starts = numpy.flatnonzero(~is_sep[1:] & is_sep[:-1]) + 1
+        line_starts = numpy.flatnonzero(b[:-1] == ord('\n')) + 1
+        line_starts = line_starts[~is_sep[line_starts]]
+        if len(b) > 0 and not is_sep[0]:
+            starts = numpy.concatenate(([0], starts))
+            line_starts = numpy.concatenate(([0], line_starts))
+
+        return len(starts) == len(line_starts) * self.ncols and \
+                numpy.array_equal(starts[::self.ncols], line_starts)
+
+    def _scan_lines(self, lines):
+        '''
+        Scan a chunk line by line, for chunks that _scan_text() can not
+        handle.
+        '''
+
+        datalines = []
+        row_mask = self._row_mask
+        for line in lines:
+            line = line.rstrip(' \n\t\r')
+
+            # Count blocks
+            if len(line) == 0:
+                if self.started:
+                    self.block_sizes.append(self.blocksize)
+                    if self.blocksize > self.max_blocksize:
+                        self.max_blocksize = self.blocksize
+                    self.blocksize = 0
+                continue
+
+            # Strip comment
+            commentpos = line.find('#')
+            if commentpos != -1:
+                if self._comment_cb is not None:
+                    if commentpos == 0:
+                        self._comment_cb(line, self.row_no + 1)
+                    else:
+                        self._comment_cb(line, self.row_no)
+                line = line[:commentpos]
+                if len(line.split()) == 0:
+                    continue
+
+            if row_mask is not None and self.row_no + 1 > self._last_row:
+                self.finished = True
+                break
+
+            if row_mask is None or row_mask[self.row_no + 1]:
+                self.started = True
+                self.blocksize += 1
+
+            self.row_no += 1
+            datalines.append(line.lstrip(' \t'))
+
+        nrows = len(datalines)
+        if nrows == 0:
+            return
+
+        if self.ncols is None:
+            self._init_rows(datalines[0])
+
+        text = '\n'.join(datalines)
+        values = numpy.fromstring(text, sep=' ')
+        if len(values) != nrows * self.ncols or \
+                not self._has_ncols_fields(text):
+            values = self._convert_slow(datalines)
+        values = values.reshape((nrows, self.ncols))
+
+        if row_mask is not None:
+            first = self.row_no + 1 - nrows
+            values[~row_mask[first:first + nrows]] = numpy.nan
+
+        self._rows.append(values)
+
+    def _init_rows(self, line):
+        '''Set up the data buffer, based on the first data line.'''
+
+        self.ncols = len(line.split())
+        self.nfields = max(self.nfields, self.ncols)
+        self._rows = GrowableArray(ncols=self.ncols)
+
+        if self._size_hint > 0:
+            nrows = 1 + self._size_hint / (len(line) + 1)
+            if self._row_mask is not None:
+                nrows = min(nrows, self._last_row + 1)
+            self._rows.reserve(nrows)
+
+    def _convert_slow(self, datalines):
+        values = numpy.empty((len(datalines), self.ncols))
+        for i, line in enumerate(datalines):
+            fields = [float(f) for f in line.split()]
+            if len(fields) > self.nfields:
+                self.nfields = len(fields)
+            if len(fields) != self.ncols:
+                raise ValueError('Data row with %d instead of %d columns: %s' \
+                        % (len(fields), self.ncols, line))
+            values[i] = fields
+        return values
+
+    def get_buffer(self):
+        '''Return the GrowableArray holding the data, or None.'''
+        return self._rows
+
+    def get_data(self):
+        '''Return the data rows parsed so far as a 2D array.'''
+        if self._rows is None:
+            return numpy.empty((0, 0))
+        return self._rows.get_view()
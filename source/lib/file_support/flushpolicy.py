@@ -0,0 +1,87 @@
+# flushpolicy.py, decide when data files are flushed
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import time
+import gobject
+
+class FlushPolicy:
+    '''
+    Flush policy shared by the data file writers (Data, HDF5Data and
+    AsyncWriter): flush after 'rows' rows (if larger than 0), or when
+    'interval' seconds passed since the last flush.
+
+    The owner reports written rows with add_rows(), which calls
+    flush_func() when a flush is due, and calls flushed() whenever it
+    flushed the file. If use_timer is True, a gobject timeout makes sure
+    the data ends up on disk if no more rows arrive; a thread without a
+    main loop can use get_timeout() instead.
+    '''
+
+    def __init__(self, flush_func, rows=0, interval=1.0, use_timer=True):
+        self._flush_func = flush_func
+        self._rows = rows
+        self._interval = interval
+        self._use_timer = use_timer
+        self._unflushed_rows = 0
+        self._last_flush = time.time()
+        self._hid = None
+
+    def set(self, rows=None, interval=None):
+        '''Set the number of rows and/or the interval, None to keep it.'''
+        if rows is not None:
+            self._rows = rows
+        if interval is not None:
+            self._interval = interval
+
+    def get(self):
+        '''Return the policy as a (rows, interval) tuple.'''
+        return (self._rows, self._interval)
+
+    def add_rows(self, nrows):
+        '''Count nrows written rows and flush if needed.'''
+
+        self._unflushed_rows += nrows
+
+        if self._rows > 0 and self._unflushed_rows >= self._rows:
+            self._flush_func()
+        elif time.time() - self._last_flush >= self._interval:
+            self._flush_func()
+        elif self._use_timer and self._hid is None:
+            self._hid = gobject.timeout_add(int(self._interval * 1000),
+                    self._timeout_cb)
+
+    def flushed(self):
+        '''Reset the counters after the file was flushed.'''
+        self.cancel()
+        self._unflushed_rows = 0
+        self._last_flush = time.time()
+
+    def cancel(self):
+        '''Remove the pending timeout, if any.'''
+        if self._hid is not None:
+            gobject.source_remove(self._hid)
+            self._hid = None
+
+    def get_timeout(self):
+        '''Return the time until the next flush, or None if not needed.'''
+        if self._unflushed_rows == 0:
+            return None
+        return max(0, self._last_flush + self._interval - time.time())
+
+    def _timeout_cb(self):
+        self._hid = None
+        self._flush_func()
+        return False
@@ -1,5 +1,8 @@
 import os
 import logging
+import ast
+
+from lib.file_support import snapshot
 
 ##################
 #### settings file
@@ -10,6 +13,10 @@ class SettingsFile():
     This class will read a settingsfile, and make it available as dict.
     For initializing both the <filename>.dat and the <filename>.set are
     allowed.
+
+    The structured snapshot (<filename>.set.json) is used if it exists,
+    otherwise the text file is parsed. Values in the text file are read
+    as python literals; other values are kept as strings.
     '''
 
     def __init__(self, filepath):
@@ -20,6 +27,11 @@ class SettingsFile():
         self._metadata = {}
         self._settings = {}
 
+        snap = snapshot.load(self._filepath)
+        if snap is not None:
+            self._metadata, self._settings = snap
+            return
+
         if not os.path.isfile(self._filepath):
             logging.warning('"%s" does not exist' % self._filepath)
             return
@@ -53,7 +65,7 @@ class SettingsFile():
                 value = line[pos+2:]
 
                 try:
-                    value = eval(value)
+                    value = ast.literal_eval(value)
                 except:
                     pass
 
@@ -0,0 +1,245 @@
+# snapshot.py, write and read instrument settings snapshots
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Settings snapshots of all instruments, stored next to each data file.
+
+For a data file <name>.dat two files are written:
+
+    <name>.set       the text view, as written by earlier versions
+    <name>.set.json  the structured snapshot
+
+The values are captured in the calling thread, everything else (hashing,
+formatting and writing) is done by a background thread.
+
+Snapshots are identified by the SHA-1 hash of their content. If a
+snapshot is identical to one written earlier in this session, e.g. for
+every trace of a 2D sweep that creates a new Data object, the .set.json
+file only contains a reference ('same_as') to the first file with that
+content, relative to its own directory. The text view is still written
+in full, but it is only formatted once.
+
+Snapshots are read with load(), which does not evaluate any values.
+'''
+
+import os
+import logging
+import hashlib
+
+try:
+    import json
+except:
+    import simplejson as json
+
+from lib.file_support.asyncwriter import AsyncWriter
+
+EXTENSION = '.set.json'
+MAX_KNOWN = 1000
+
+def _to_json(obj):
+    '''Convert values that json cannot serialize: numpy types and others.'''
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    return repr(obj)
+
+def get_snapshot_path(settings_path):
+    '''Return the path of the structured snapshot for a .set file.'''
+    return os.path.splitext(settings_path)[0] + EXTENSION
+
+def capture(instruments):
+    '''
+    Return the stored values of all parameters of the instruments, as a
+    dictionary of instrument name -> {parameter -> value}. The instruments
+    are not queried.
+    '''
+
+    ret = {}
+    for iname, ins in instruments.iteritems():
+        params = ins.get_parameters().keys()
+        values = ins.get(params, query=False, fast=True)
+        if values is None:
+            values = {}
+        for param in params:
+            values.setdefault(param, None)
+        ret[iname] = values
+    return ret
+
+class SnapshotWriter:
+
+    def __init__(self, background=True):
+        self._background = background
+        self._writer = None
+        self._known = {}
+        self._last_hash = None
+        self._last_text = None
+        self._nsnapshots = 0
+        self._nduplicates = 0
+
+    def write(self, settings_path, filename, timestamp, settings):
+        '''
+        Write snapshot 'settings' (see capture()) for data file 'filename'
+        to settings_path (.set) and the corresponding .set.json file.
+        '''
+
+        args = (settings_path, filename, timestamp, settings)
+        if not self._background:
+            self._write(*args)
+            return
+
+        if self._writer is None:
+            self._writer = AsyncWriter(name='Settings writer')
+            self._writer.start()
+        try:
+            self._writer.put(self._write, args, 0)
+        except Exception, e:
+            logging.warning('Settings writer failed, writing directly: %s', e)
+            self._writer = None
+            self._write(*args)
+
+    def drain(self):
+        '''Wait until all snapshots are written.'''
+        if self._writer is not None:
+            self._writer.drain()
+
+    def _format_text(self, settings):
+        lines = []
+        for iname in sorted(settings.keys()):
+            lines.append('Instrument: %s\n' % iname)
+            values = settings[iname]
+            for param in sorted(values.keys()):
+                lines.append('\t%s: %s\n' % (param, values[param]))
+        return ''.join(lines)
+
+    def _write(self, settings_path, filename, timestamp, settings):
+        content = json.dumps(settings, sort_keys=True, separators=(',', ':'),
+                default=_to_json)
+        digest = hashlib.sha1(content).hexdigest()
+        self._nsnapshots += 1
+
+        if digest != self._last_hash:
+            self._last_text = self._format_text(settings)
+            self._last_hash = digest
+
+        f = open(settings_path, 'w+')
+        try:
+            f.write('Filename: %s\n' % filename)
+            f.write('Timestamp: %s\n\n' % timestamp)
+            f.write(self._last_text)
+        finally:
+            f.close()
+
+        json_path = get_snapshot_path(settings_path)
+        header = '{"filename":%s,"timestamp":%s,"hash":"%s",' % \
+                (json.dumps(filename), json.dumps(timestamp), digest)
+
+        first = self._known.get(digest, None)
+        if first is not None and os.path.exists(first):
+            self._nduplicates += 1
+            try:
+                ref = os.path.relpath(first, os.path.dirname(json_path))
+            except ValueError:
+                ref = first
+            body = '"same_as":%s}' % json.dumps(ref)
+        else:
+            if len(self._known) >= MAX_KNOWN:
+                self._known = {}
+            self._known[digest] = os.path.abspath(json_path)
+            body = '"settings":%s}' % content
+
+        f = open(json_path, 'w+')
+        try:
+            f.write(header)
+            f.write(body)
+        finally:
+            f.close()
+
+    def get_stats(self):
+        '''Return the number of snapshots and of duplicate snapshots.'''
+        ret = {
+            'snapshots': self._nsnapshots,
+            'duplicates': self._nduplicates,
+        }
+        if self._writer is not None:
+            ret['writer'] = self._writer.get_stats()
+        return ret
+
+_cache = {}
+
+def _read_json(path):
+    '''Read a .set.json file, cached by modification time.'''
+
+    path = os.path.abspath(path)
+    mtime = os.path.getmtime(path)
+    if path in _cache and _cache[path][0] == mtime:
+        return _cache[path][1]
+
+    f = open(path, 'r')
+    try:
+        info = json.load(f)
+    finally:
+        f.close()
+
+    if len(_cache) >= MAX_KNOWN:
+        _cache.clear()
+    _cache[path] = (mtime, info)
+    return info
+
+def load(path):
+    '''
+    Load the structured snapshot for a settings (.set) file.
+
+    Output: (metadata, settings), where metadata contains 'filename',
+        'timestamp' and 'hash'; None if there is no (valid) snapshot.
+    '''
+
+    drain()
+    if not path.endswith(EXTENSION):
+        path = get_snapshot_path(path)
+    if not os.path.exists(path):
+        return None
+
+    try:
+        info = _read_json(path)
+        settings = info.get('settings', None)
+        if settings is None:
+            ref = os.path.join(os.path.dirname(path), info['same_as'])
+            settings = _read_json(ref)['settings']
+    except Exception, e:
+        logging.warning('Unable to load settings snapshot %s: %s', path, e)
+        return None
+
+    metadata = {
+        'filename': info.get('filename'),
+        'timestamp': info.get('timestamp'),
+        'hash': info.get('hash'),
+    }
+    return metadata, settings
+
+_writer = None
+
+def get_writer():
+    '''Return the snapshot writer, create it on first use.'''
+    global _writer
+    if _writer is None:
+        from lib.config import get_config
+        config = get_config()
+        _writer = SnapshotWriter(config.get('settings_async_write', True))
+    return _writer
+
+def drain():
+    '''Wait until all snapshots are written, if the writer is used.'''
+    if _writer is not None:
+        _writer.drain()
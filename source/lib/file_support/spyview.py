@@ -1,6 +1,103 @@
 import os
 import logging
 
+_LOOP_NAMES = ('inner loop', 'outer loop', 'outermost loop')
+_UNUSED_LOOP = (1, 0, 1, 'Nothing')
+
+def format_meta(loops, values):
+    '''
+    Return the contents of a spyview .meta.txt file.
+
+    Input:
+        loops (list): up to three (size, start, end, label) tuples, from
+            the inner to the outermost loop
+        values (list): (column number, label) tuples, column numbers
+            start at 1
+    '''
+
+    lines = []
+    for i, name in enumerate(_LOOP_NAMES):
+        if i < len(loops):
+            lines.append('#%s' % name)
+            loop = loops[i]
+        else:
+            lines.append('#%s (unused)' % name)
+            loop = _UNUSED_LOOP
+        lines.extend(['%s' % item for item in loop])
+
+    lines.append('#for each of the values')
+    for colnr, label in values:
+        lines.append('%d' % colnr)
+        lines.append('%s' % label)
+
+    return '\n'.join(lines) + '\n'
+
+def write_meta(filepath, loops, values):
+    '''
+    Write a spyview .meta.txt file, see format_meta(). The file is
+    written to a temporary file first and then renamed, so spyview never
+    reads a partially written file.
+    '''
+
+    tmppath = filepath + '.tmp'
+    f = open(tmppath, 'w')
+    try:
+        f.write(format_meta(loops, values))
+    finally:
+        f.close()
+
+    try:
+        os.rename(tmppath, filepath)
+    except OSError:
+        # Renaming to an existing file is not possible on Windows
+        os.remove(filepath)
+        os.rename(tmppath, filepath)
+
+class MetaFile:
+    '''
+    Spyview .meta.txt file for a data file that is being written.
+
+    The file is written once when all loops are known. During the
+    measurement only the size and end value of the loop that is in
+    progress (the outermost one) change; the file is rewritten only
+    when one of them changes.
+    '''
+
+    def __init__(self, filepath, loops, values):
+        '''
+        Input:
+            filepath (string): path of the .meta.txt file
+            loops (list): [size, start, end, label] lists, from the inner
+                to the outermost loop; see format_meta()
+            values (list): (column number, label) tuples
+        '''
+
+        self._filepath = filepath
+        self._loops = [list(loop) for loop in loops]
+        self._values = list(values)
+        self._written = None
+
+    def get_filepath(self):
+        return self._filepath
+
+    def get_loops(self):
+        return [list(loop) for loop in self._loops]
+
+    def set_loop(self, index, size, start, end):
+        '''Set the size, start and end of loop index and write the file.'''
+        self._loops[index][:3] = [size, start, end]
+        self.write()
+
+    def write(self):
+        '''Write the file if it changed since it was last written.'''
+
+        loops = [tuple(loop) for loop in self._loops]
+        if loops == self._written:
+            return False
+        write_meta(self._filepath, loops, self._values)
+        self._written = loops
+        return True
+
 class SpyView():
 
     def __init__(self, dataobject):
@@ -15,7 +112,7 @@ class SpyView():
 
         ncoords = self._data.get_ncoordinates()
         if ncoords not in (2,3):
-            loggin.error('this function currently only supports data files \
+            logging.error('this function currently only supports data files \
                     with 2 or 3 coordinate dimensions. The data provided has \
                     %d coordinate dimensions', ncoords)
 
@@ -70,26 +167,14 @@ class SpyView():
         datafilename = self._data.get_filepath()
         name, ext = os.path.splitext(datafilename)
         metafilename = name + '.meta.txt'
-        f = file(metafilename, 'w')
-
-        KEYLIST = [ ('xsize',   '%d'),
-                    ('xstart',  '%e'),
-                    ('xend',    '%e'),
-                    ('xlabel',  '%s'),
-                    ('ysize',   '%d'),
-                    ('ystart',  '%e'),
-                    ('yend',    '%e'),
-                    ('ylabel',  '%s'),
-                    ('zsize',   '%d'),
-                    ('zstart',  '%e'),
-                    ('zend',    '%e'),
-                    ('zlabel',  '%s') ]
-
-        for key, fmt in KEYLIST:
-            f.write( (fmt + '\n') % self._meta_info[key])
-
-        for i in range(self._meta_info['nvals']):
-            f.write('%d\n' % self._meta_info['val%d_colnr' % i])
-            f.write('%s\n' % self._meta_info['val%d_label' % i])
 
-        f.close()
+        info = self._meta_info
+        loops = []
+        for axis in ('x', 'y', 'z'):
+            loops.append((info[axis + 'size'], info[axis + 'start'],
+                info[axis + 'end'], info[axis + 'label']))
+        values = []
+        for i in range(info['nvals']):
+            values.append((info['val%d_colnr' % i], info['val%d_label' % i]))
+
+        write_meta(metafilename, loops, values)
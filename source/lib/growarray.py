@@ -0,0 +1,147 @@
+# growarray.py, 2D array that can be grown row by row efficiently
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import numpy
+
+class GrowableArray:
+    '''
+    A 2D array to which rows can be appended in amortized constant time.
+
+    Rows are stored in a larger backing buffer whose capacity is doubled
+    when it is full. get_view() returns a contiguous ndarray view on the
+    rows added so far, so the result can be used as a normal array.
+
+    Note that a view returned earlier does not see rows appended after the
+    buffer had to be reallocated; call get_view() again to get the
+    current data.
+    '''
+
+    MIN_CAPACITY = 1024
+
+    def __init__(self, data=None, ncols=None, dtype=numpy.float64,
+            capacity=0):
+        '''
+        Create a GrowableArray.
+
+        Input:
+            data (ndarray): optional initial rows (copied)
+            ncols (int): number of columns, determined from the first
+                rows added if not specified
+            dtype: data type of the buffer if no initial data is given
+            capacity (int): number of rows to reserve
+        '''
+
+        self._buf = None
+        self._view = None
+        self._n = 0
+        self._ncols = ncols
+        self._dtype = numpy.dtype(dtype)
+
+        if data is not None and len(data) > 0:
+            data = numpy.asarray(data)
+            if data.ndim == 1:
+                data = data.reshape((len(data), -1))
+            self._ncols = data.shape[1]
+            self._dtype = data.dtype
+            self.reserve(max(capacity, len(data)))
+            self._buf[:len(data)] = data
+            self._n = len(data)
+        elif capacity > 0 and ncols is not None:
+            self.reserve(capacity)
+
+    def __len__(self):
+        return self._n
+
+    def get_capacity(self):
+        '''Return the number of rows that fit without reallocating.'''
+        if self._buf is None:
+            return 0
+        return len(self._buf)
+
+    def get_ncols(self):
+        return self._ncols
+
+    def get_dtype(self):
+        return self._dtype
+
+    def reserve(self, nrows):
+        '''Make sure the buffer can hold at least nrows rows.'''
+
+        if self._ncols is None:
+            raise ValueError('Number of columns not known yet')
+        if self._buf is not None and len(self._buf) >= nrows:
+            return
+
+        newcap = max(nrows, self.MIN_CAPACITY)
+        if self._buf is not None:
+            newcap = max(newcap, 2 * len(self._buf))
+
+        newbuf = numpy.empty((newcap, self._ncols), dtype=self._dtype)
+        if self._n > 0:
+            newbuf[:self._n] = self._buf[:self._n]
+        self._buf = newbuf
+        self._view = None
+
+    def append(self, rows):
+        '''
+        Append rows, which can be a single row (1D) or several rows (2D).
+        If the data type of the new rows can not be stored in the current
+        buffer without loss, the buffer is converted to a suitable type.
+        '''
+
+        rows = numpy.asarray(rows)
+        if rows.ndim < 2:
+            rows = rows.reshape((1, -1))
+        nrows = len(rows)
+        if nrows == 0:
+            return
+
+        if self._ncols is None:
+            self._ncols = rows.shape[1]
+            self._dtype = rows.dtype
+        elif rows.shape[1] != self._ncols:
+            raise ValueError('Expected %d columns, got %d' % \
+                    (self._ncols, rows.shape[1]))
+
+        if not numpy.can_cast(rows.dtype, self._dtype):
+            self._dtype = numpy.result_type(self._dtype, rows.dtype)
+            if self._buf is not None:
+                self._buf = self._buf.astype(self._dtype)
+
+        self.reserve(self._n + nrows)
+        self._buf[self._n:self._n + nrows] = rows
+        self._n += nrows
+        self._view = None
+
+    def get_view(self):
+        '''Return the rows added so far as an ndarray view.'''
+
+        if self._view is None:
+            if self._buf is None:
+                self._view = numpy.empty((0, self._ncols or 0),
+                        dtype=self._dtype)
+            else:
+                self._view = self._buf[:self._n]
+        return self._view
+
+    def is_view(self, arr):
+        '''Return whether arr is the current view returned by get_view().'''
+        return self._view is not None and arr is self._view
+
+    def clear(self):
+        '''Remove all rows, but keep the allocated buffer.'''
+        self._n = 0
+        self._view = None
@@ -0,0 +1,177 @@
+# loopdetect.py, detect the loop structure of measurement data
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Functions to find the loops in measurement data, without stepping through
+the rows in python.
+
+detect_loops() finds the nested loops of the coordinate columns of a data
+set (as used by Data to determine the dimension sizes and the shape of the
+data), find_sweeps() divides a single column into sweeps.
+'''
+
+import numpy
+
+# Number of rows compared at once when searching for the end of a loop
+_SEARCH_CHUNK = 1024
+
+class LoopStructure:
+    '''
+    Result of detect_loops().
+
+    Attributes:
+        nrows (int): number of rows in the data
+        loopdims (list): coordinate columns that are looped over, from
+            the inner to the outer loop
+        loopshape (list): number of steps of each loop in loopdims
+        starts, ends (list): first and last value of each loop
+        complete (bool): whether the number of rows equals the product of
+            the loop sizes
+    '''
+
+    def __init__(self, nrows):
+        self.nrows = nrows
+        self.loopdims = []
+        self.loopshape = []
+        self.starts = []
+        self.ends = []
+        self.complete = False
+
+    def get_block_size(self):
+        '''Return the size of the inner loop, or None if there are no loops.'''
+        if len(self.loopshape) == 0:
+            return None
+        return self.loopshape[0]
+
+    def get_block_sizes(self):
+        '''
+        Return the sizes of the blocks (inner loops), the last block might
+        be incomplete.
+        '''
+
+        bs = self.get_block_size()
+        if bs is None or bs == 0:
+            return None
+        nblocks, last = divmod(self.nrows, bs)
+        if last > 0:
+            nblocks += 1
+        return [bs] * nblocks
+
+    def get_npoints_last_block(self):
+        '''Return the number of rows in the last (possibly ragged) block.'''
+        bs = self.get_block_size()
+        if bs is None or bs == 0 or self.nrows == 0:
+            return self.nrows
+        last = self.nrows % bs
+        if last == 0:
+            return bs
+        return last
+
+def _find_first(col, value):
+    '''
+    Return the index of the first element of col that equals value, or
+    len(col) if there is none. The column is compared in chunks of
+    increasing size, so a loop that ends early is found quickly.
+    '''
+
+    start = 0
+    chunk = _SEARCH_CHUNK
+    while start < len(col):
+        idx = numpy.flatnonzero(col[start:start + chunk] == value)
+        if len(idx) > 0:
+            return start + int(idx[0])
+        start += chunk
+        chunk *= 4
+    return len(col)
+
+def detect_loops(data, ncoords):
+    '''
+    Detect the nested loops in the first ncoords columns of data (a 2d
+    array with one row per point).
+
+    The inner loop is the first column whose value changes between the
+    first and the second row; it ends when the first value occurs again.
+    The next loop is the first column that changes after a complete inner
+    loop, and so on.
+
+    Output:
+        a LoopStructure
+    '''
+
+    nrows = len(data)
+    result = LoopStructure(nrows)
+    if nrows < 2 or ncoords == 0:
+        return result
+
+    mulsize = 1
+    for iter in range(ncoords):
+        if mulsize >= nrows:
+            break
+
+        changed = numpy.flatnonzero(data[0,:ncoords] != data[mulsize,:ncoords])
+        if len(changed) == 0:
+            break
+        loopdim = int(changed[0])
+        loopstart = data[0, loopdim]
+
+        # The loop ends when loopstart occurs again
+        size = 1 + _find_first(data[mulsize::mulsize, loopdim], loopstart)
+
+        result.loopdims.append(loopdim)
+        result.loopshape.append(size)
+        result.starts.append(loopstart)
+        result.ends.append(data[mulsize * (size - 1), loopdim])
+
+        mulsize *= size
+
+    result.complete = nrows == mulsize
+    return result
+
+def find_sweeps(values, use_sweep_direction):
+    '''
+    Divide a column into sweeps, either at the points where the direction
+    of the sweep changes (use_sweep_direction=True) or where the value
+    changes (use_sweep_direction=False).
+
+    Output:
+        an array of (start, stop) row indices
+    '''
+
+    values = numpy.asarray(values)
+    nrows = len(values)
+    dx = numpy.sign(values[1:] - values[:-1])
+
+    if use_sweep_direction:
+        # A repeated end point gets the direction of the next step, to
+        # detect changes in direction.
+        zeros = numpy.flatnonzero(dx[1:-1] == 0) + 1
+        dx[zeros] = dx[zeros + 1]
+        changes = numpy.flatnonzero(dx[1:] * dx[:-1] < 0) + 2
+
+        # The direction changing twice in a row means that sweeps are
+        # being done repeatedly in the same direction.
+        if len(changes) > 1:
+            keep = numpy.concatenate(([True], numpy.diff(changes) != 1))
+            changes = changes[keep]
+    else:
+        changes = numpy.flatnonzero(dx != 0) + 1
+
+    if len(changes) == 0:
+        return numpy.array([[0, nrows]])
+
+    starts = numpy.concatenate(([0], changes))
+    stops = numpy.concatenate((changes, [nrows]))
+    return numpy.concatenate((starts, stops)).reshape((2, -1)).T
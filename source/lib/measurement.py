@@ -15,12 +15,84 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+import sys
 import time
+import math
 import gtk
 import gobject
 import logging
+import threading
+import Queue
 import qt
 from data import Data
+from lib.misc import exact_time
+
+class _LatencyStats:
+    '''Latency statistics of the reads from one instrument.'''
+
+    def __init__(self):
+        self.n = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+
+    def add(self, dt):
+        self.n += 1
+        self.total += dt
+        if self.min is None or dt < self.min:
+            self.min = dt
+        if dt > self.max:
+            self.max = dt
+
+    def get(self):
+        if self.n == 0:
+            mean = 0.0
+        else:
+            mean = self.total / self.n
+        return {'n': self.n, 'total': self.total, 'mean': mean,
+                'min': self.min or 0.0, 'max': self.max}
+
+class _ReadWorker(threading.Thread):
+    '''
+    Thread that reads the measurements of instruments with one lock class,
+    one after the other.
+    '''
+
+    def __init__(self, lock_class):
+        threading.Thread.__init__(self, name='Measure %s' % lock_class)
+        self.setDaemon(True)
+        self._jobs = Queue.Queue()
+        self._done = Queue.Queue()
+
+    def submit(self, reads):
+        '''Queue reads, a list of (column index, instrument, variable).'''
+        self._jobs.put(reads)
+
+    def get_result(self):
+        '''
+        Wait for the results of the last submit(): a list of (column index,
+        value, instrument name, latency), or an exc_info tuple.
+        '''
+        return self._done.get()
+
+    def stop(self):
+        self._jobs.put(None)
+
+    def run(self):
+        while True:
+            reads = self._jobs.get()
+            if reads is None:
+                break
+
+            ret = []
+            try:
+                for index, ins, var in reads:
+                    start = exact_time()
+                    val = ins.get(var)
+                    ret.append((index, val, ins.get_name(), exact_time() - start))
+            except Exception, e:
+                ret = sys.exc_info()
+            self._done.put(ret)
 
 class Measurement(gobject.GObject):
 
@@ -36,6 +108,19 @@ class Measurement(gobject.GObject):
     _PROGRESS_STEPS = 1
 
     def __init__(self, name, **kwargs):
+        '''
+        Create a measurement.
+
+        Input:
+            name (string): name of the measurement and the data file
+            kwargs: options:
+                delay (float): delay between points in ms
+                concurrent (bool): read instruments with different lock
+                    classes at the same time. Reads from instruments with
+                    the same lock class stay in order. Default is
+                    'measurement_concurrent' from config, or False.
+        '''
+
         gobject.GObject.__init__(self)
 
         self._name = name
@@ -44,8 +129,13 @@ class Measurement(gobject.GObject):
         self._coords = []
         self._measurements = []
 
+        self._concurrent = kwargs.get('concurrent',
+                qt.config.get('measurement_concurrent', False))
+        self._workers = {}
+        self._latency = {}
+
         if name in qt.data:
-            self._data = qt.data['name']
+            self._data = qt.data[name]
         else:
             self._data = Data()
 
@@ -65,7 +155,7 @@ class Measurement(gobject.GObject):
                 logging.warning('Unable to add coordinate with 0 stepsize')
                 return False
 
-            if start < end:
+            if coord['start'] < coord['end']:
                 coord['stepsize'] = kwargs['stepsize']
             else:
                 coord['stepsize'] = -kwargs['stepsize']
@@ -156,7 +246,7 @@ class Measurement(gobject.GObject):
 
     def add_measurement_func(self, func, **kwargs):
         meas = {'func': func}
-        for key, val in kwargs.iter_items():
+        for key, val in kwargs.iteritems():
             meas[key] = val
         self._measurements.append(meas)
 
@@ -219,18 +309,95 @@ class Measurement(gobject.GObject):
 
         return extra_delay
 
-    def _do_measurements(self):
-        data = []
+    def _add_latency(self, name, dt):
+        if name not in self._latency:
+            self._latency[name] = _LatencyStats()
+        self._latency[name].add(dt)
+
+    def get_latency_stats(self):
+        '''
+        Return the read latency statistics of the last measurement, as a
+        dictionary of instrument (or function) name -> dictionary with the
+        number of reads and the total, mean, minimum and maximum time (s).
+        '''
+
+        ret = {}
+        for name, stats in self._latency.iteritems():
+            ret[name] = stats.get()
+        return ret
+
+    def _report_latency_stats(self):
+        for name, stats in sorted(self.get_latency_stats().items()):
+            logging.info('%s: %d reads, mean %.1f ms, min %.1f ms, max %.1f ms',
+                    name, stats['n'], stats['mean'] * 1e3,
+                    stats['min'] * 1e3, stats['max'] * 1e3)
+
+    def _start_workers(self):
+        '''Start a read thread for each lock class used by the measurements.'''
+
+        self._workers = {}
         for m in self._measurements:
+            if 'ins' not in m:
+                continue
+            lock_class = m['ins'].get_lock_class()
+            if lock_class not in self._workers:
+                self._workers[lock_class] = _ReadWorker(lock_class)
+                self._workers[lock_class].start()
+
+    def _stop_workers(self):
+        for worker in self._workers.values():
+            worker.stop()
+        for worker in self._workers.values():
+            worker.join()
+        self._workers = {}
+
+    def _do_measurements(self):
+        '''
+        Read all measurements and return the values in the order in which
+        they were added. In concurrent mode instruments with a different
+        lock class are read at the same time, functions are called from
+        this thread meanwhile.
+        '''
+
+        data = [None] * len(self._measurements)
+        reads = {}
+        for i, m in enumerate(self._measurements):
+            if 'ins' in m and len(self._workers) > 0:
+                lock_class = m['ins'].get_lock_class()
+                reads.setdefault(lock_class, []).append((i, m['ins'], m['var']))
+
+        for lock_class, items in reads.iteritems():
+            self._workers[lock_class].submit(items)
+
+        for i, m in enumerate(self._measurements):
+            start = exact_time()
             if 'ins' in m:
+                if len(self._workers) > 0:
+                    continue
                 ins = m['ins']
-                data.append(ins.get(m['var']))
+                data[i] = ins.get(m['var'])
+                self._add_latency(ins.get_name(), exact_time() - start)
             elif 'func' in m:
                 func = m['func']
-                data.append(func())
+                data[i] = func()
+                self._add_latency(getattr(func, '__name__', str(func)),
+                        exact_time() - start)
             else:
                 logging.warning('Measurement action undefined')
 
+        error = None
+        for lock_class in reads:
+            ret = self._workers[lock_class].get_result()
+            if type(ret) is tuple:
+                error = ret
+                continue
+            for index, val, insname, dt in ret:
+                data[index] = val
+                self._add_latency(insname, dt)
+
+        if error is not None:
+            raise error[0], error[1], error[2]
+
         return data
 
     def _measure(self, iter):
@@ -298,14 +465,24 @@ class Measurement(gobject.GObject):
         self._do_set_values(-1)
         time.sleep(self._delay / 1000.0)
 
-        for i in range(self._ntotal):
-            self._measure()
-            try:
-                qt.msleep(self._delay / 1000.0)
-            except:
-                self.emit('finished', 'Interrupted')
+        self._latency = {}
+        if self._concurrent:
+            self._start_workers()
 
-        self.emit('finished', 'Ok')
+        status = 'Ok'
+        try:
+            for i in range(self._ntotal):
+                self._measure(i)
+                try:
+                    qt.msleep(self._delay / 1000.0)
+                except:
+                    status = 'Interrupted'
+                    break
+        finally:
+            self._stop_workers()
+            self._report_latency_stats()
+
+        self.emit('finished', status)
 
     def _finished_cb(self, sender, msg):
         logging.debug('Measurement finished: %s', msg)
@@ -25,15 +25,403 @@ import copy
 import random
 import inspect
 import time
-import gobject
 import types
+import struct
+import cStringIO
+import errno
+import select
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Not needed by headless processes using the share_select transport
+try:
+    import gobject
+except ImportError:
+    gobject = None
 
 PORT = 12002
 BUFSIZE = 8192
 
+# Maximum number of bytes to read at once, to keep the main loop responsive
+# while large packets arrive
+RECV_MAX = 1 << 20
+
+# Protocol version 2 uses the highest common pickle protocol and sends
+# numpy arrays as raw buffers after the pickled packet. The version is
+# announced in the root object info, see ObjectSharer.add_client().
+PROTOCOL_VERSION = 2
+
+# Arrays smaller than this (in bytes) are pickled with the packet
+OOB_MIN_SIZE = 4096
+
+def _frame(data):
+    '''Return a version 1 packet: magic 'QT', length and pickled data.'''
+    return 'QT' + struct.pack('>I', len(data)) + data
+
+class _PacketReader():
+    '''
+    Split the data received on a connection into packets.
+
+    Version 1 packets ('QT') contain the pickled packet. Version 2 packets
+    ('QB') contain a list of array descriptors (dtype, shape), the pickled
+    packet and the raw data of the arrays.
+
+    The reader always knows how many bytes it needs next: the header, a
+    payload of the length given in the header, or the data of an array.
+    This target is allocated once at its final size, so receiving a
+    packet takes linear time. recv() reads large targets directly from
+    the socket with recv_into(); small packets are read through a
+    staging buffer to avoid a system call for every header.
+    '''
+
+    RECV_SIZE = 65536
+
+    def __init__(self):
+        self._head = bytearray(10)
+        self._staging = bytearray(self.RECV_SIZE)
+        self._packets = []
+        self._payload = None
+        self._metalen = 0
+        self._packet = None
+        self._arrays = None
+        self._flat = None
+        self._index = 0
+        self._start_packet()
+
+    def _start_packet(self):
+        self._step = 'head'
+        self._set_target(memoryview(self._head)[:6])
+
+    def _set_target(self, target):
+        self._target = target
+        self._pos = 0
+
+    def _next_target(self):
+        '''If the current target is complete, process it and move on.'''
+
+        while self._pos == len(self._target):
+            if self._step == 'head':
+                magic = str(self._head[:2])
+                if magic == 'QT':
+                    datalen = struct.unpack('>I', str(self._head[2:6]))[0]
+                    self._payload = bytearray(datalen)
+                    self._step = 'payload'
+                    self._set_target(memoryview(self._payload))
+                elif magic == 'QB':
+                    self._step = 'head2'
+                    self._set_target(memoryview(self._head)[6:10])
+                else:
+                    self._start_packet()
+                    raise ValueError('Packet magic missing')
+
+            elif self._step == 'head2':
+                metalen, datalen = struct.unpack('>II', str(self._head[2:10]))
+                self._metalen = metalen
+                self._payload = bytearray(metalen + datalen)
+                self._step = 'meta'
+                self._set_target(memoryview(self._payload))
+
+            elif self._step == 'meta':
+                meta = pickle.loads(str(self._payload[:self._metalen]))
+                self._packet = str(self._payload[self._metalen:])
+                self._payload = None
+                self._allocate(meta)
+                self._step = 'array'
+                self._next_array()
+
+            elif self._step == 'array':
+                self._next_array()
+
+            elif self._step == 'payload':
+                self._packets.append((str(self._payload), None))
+                self._payload = None
+                self._start_packet()
+
+    def _allocate(self, meta):
+        self._arrays = []
+        self._flat = []
+        for dtype, shape in meta:
+            arr = numpy.empty(shape, dtype=numpy.dtype(dtype))
+            self._arrays.append(arr)
+            self._flat.append(arr.reshape(-1).view(numpy.uint8))
+        self._index = -1
+
+    def _next_array(self):
+        self._index += 1
+        while self._index < len(self._flat) and len(self._flat[self._index]) == 0:
+            self._index += 1
+
+        if self._index < len(self._flat):
+            self._set_target(memoryview(self._flat[self._index]))
+        else:
+            self._packets.append((self._packet, self._arrays))
+            self._packet = None
+            self._arrays = None
+            self._flat = None
+            self._start_packet()
+
+    def feed(self, data):
+        '''Add received data (a string or buffer).'''
+
+        data = memoryview(data)
+        pos = 0
+        while pos < len(data):
+            n = min(len(self._target) - self._pos, len(data) - pos)
+            self._target[self._pos:self._pos+n] = data[pos:pos+n]
+            self._pos += n
+            pos += n
+            self._next_target()
+
+    def recv(self, sock, maxbytes):
+        '''
+        Read up to maxbytes from sock, or until no more data is available
+        if sock is non-blocking.
+
+        Output: (number of bytes read, whether the connection was closed)
+        '''
+
+        total = 0
+        while total < maxbytes:
+            space = len(self._target) - self._pos
+            try:
+                if space >= self.RECV_SIZE:
+                    n = sock.recv_into(self._target[self._pos:],
+                            min(space, maxbytes - total))
+                    self._pos += n
+                    self._next_target()
+                else:
+                    n = sock.recv_into(self._staging, self.RECV_SIZE)
+                    self.feed(memoryview(self._staging)[:n])
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, 10035):
+                    break
+                raise
+
+            if n == 0:
+                return total, True
+            total += n
+
+            # Only read once from a blocking socket
+            if sock.gettimeout() != 0.0:
+                break
+
+        return total, False
+
+    def get_packets(self):
+        '''
+        Return the complete packets as (pickled packet, arrays) tuples;
+        arrays is None for version 1 packets.
+        '''
+        packets = self._packets
+        self._packets = []
+        return packets
+
 class RemoteException(Exception):
     pass
 
+class CallFuture():
+    '''
+    The pending result of a remote call, see ObjectSharer.call_async().
+    '''
+
+    def __init__(self, callid, conn, name):
+        self.callid = callid
+        self.conn = conn
+        self.name = name
+        self.start_time = time.time()
+        self.end_time = None
+
+        self._event = threading.Event()
+        self._value = None
+        self._error = None
+        self._callbacks = []
+
+    def done(self):
+        return self._event.isSet()
+
+    def add_done_callback(self, func):
+        '''
+        Call func(future) when the reply arrives, or immediately if it
+        already arrived.
+        '''
+        if self.done():
+            func(self)
+        else:
+            self._callbacks.append(func)
+
+    def get_value(self):
+        '''Return the value received, which can be an exception object.'''
+        return self._value
+
+    def get_latency(self):
+        if self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    def result(self, timeout=None):
+        '''
+        Wait for the reply at most timeout seconds and return the value.
+        Raises an exception if the remote function raised one, if the
+        call timed out or if the connection was closed.
+        '''
+
+        if not self.done():
+            if timeout is None:
+                timeout = helper.TIMEOUT
+            helper.wait_call(self, timeout)
+        if self._error is not None:
+            raise Exception(self._error)
+        if isinstance(self._value, Exception):
+            raise Exception('Remote error: %s' % str(self._value))
+        return self._value
+
+    def wait(self, timeout):
+        '''Wait for the reply without reading from the connection.'''
+        self._event.wait(timeout)
+
+    def _set_result(self, value):
+        self.end_time = time.time()
+        self._value = value
+        self._finish()
+
+    def _set_error(self, msg):
+        self.end_time = time.time()
+        self._error = msg
+        self._finish()
+
+    def _finish(self):
+        self._event.set()
+        callbacks = self._callbacks
+        self._callbacks = []
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception, e:
+                logging.warning('Callback for call %d failed: %s',
+                        self.callid, e)
+
+class _CallStats():
+    '''Latency histogram of the calls to one remote function.'''
+
+    # Upper bin edges in seconds
+    BINS = [0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05,
+            0.1, 0.2, 0.5, 1, 2, 5]
+
+    def __init__(self):
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.ntimeouts = 0
+        self.counts = [0] * (len(self.BINS) + 1)
+
+    def add(self, dt):
+        self.n += 1
+        self.total += dt
+        if dt > self.max:
+            self.max = dt
+        i = 0
+        while i < len(self.BINS) and dt > self.BINS[i]:
+            i += 1
+        self.counts[i] += 1
+
+    def get(self):
+        if self.n == 0:
+            mean = 0.0
+        else:
+            mean = self.total / self.n
+        hist = []
+        for i, count in enumerate(self.counts):
+            if i < len(self.BINS):
+                hist.append((self.BINS[i], count))
+            else:
+                hist.append((None, count))
+        return {'n': self.n, 'mean': mean, 'max': self.max,
+                'timeouts': self.ntimeouts, 'histogram': hist}
+
+class _Subscription():
+    '''
+    A signal that a client subscribed to. If min_interval is larger than
+    0, the signal is sent at most once per min_interval seconds; signals
+    emitted in between are coalesced. With coalesce='latest' the last
+    arguments are sent, with coalesce='merge' dictionary arguments (e.g.
+    the changes of an Instrument 'changed' signal) are merged.
+    '''
+
+    def __init__(self, objname, signame, min_interval=0, coalesce='latest'):
+        self.objname = objname
+        self.signame = signame
+        self.min_interval = min_interval
+        self.coalesce = coalesce
+
+        self._client = None
+        self._pending = None
+        self._last_time = 0
+        self._hid = None
+        self.nsent = 0
+        self.ncoalesced = 0
+
+    def send(self, client, args, kwargs):
+        self._client = client
+        if self.min_interval <= 0:
+            self._send(args, kwargs)
+            return
+
+        now = time.time()
+        if self._pending is None and \
+                now - self._last_time >= self.min_interval:
+            self._send(args, kwargs)
+            return
+
+        if helper._timeout_add is None:
+            self._send(args, kwargs)
+            return
+
+        self._coalesce(args, kwargs)
+        if self._hid is None:
+            delay = max(0, self._last_time + self.min_interval - now)
+            self._hid = helper._timeout_add(int(delay * 1000), self._flush)
+
+    def _coalesce(self, args, kwargs):
+        if self._pending is not None:
+            self.ncoalesced += 1
+        if self._pending is None or self.coalesce != 'merge':
+            self._pending = (args, kwargs)
+            return
+
+        prev_args = self._pending[0]
+        args = list(args)
+        for i, arg in enumerate(args):
+            if i < len(prev_args) and type(arg) is types.DictType and \
+                    type(prev_args[i]) is types.DictType:
+                merged = dict(prev_args[i])
+                merged.update(arg)
+                args[i] = merged
+        self._pending = (tuple(args), kwargs)
+
+    def _flush(self):
+        self._hid = None
+        if self._pending is not None:
+            args, kwargs = self._pending
+            self._pending = None
+            self._send(args, kwargs)
+        return False
+
+    def _send(self, args, kwargs):
+        self._last_time = time.time()
+        self.nsent += 1
+        self._client.receive_signal(self.objname, self.signame,
+                *args, **kwargs)
+
+    def cancel(self):
+        if self._hid is not None:
+            helper._source_remove(self._hid)
+            self._hid = None
+        self._pending = None
+
 class ObjectSharer():
     '''
     The object sharer containing both client and server functions.
@@ -52,8 +440,13 @@ class ObjectSharer():
 
         self._last_hid = 0
         self._last_call_id = 0
-        self._return_cbs = {}
-        self._return_vals = {}
+        self._calls = {}
+        self._call_stats = {}
+
+        # Held while reading from a connection, so that a thread waiting
+        # for a reply and the main loop do not read at the same time
+        self._recv_lock = threading.RLock()
+        self._main_thread = threading.currentThread()
 
         self._client_timeout = 60
 
@@ -62,9 +455,36 @@ class ObjectSharer():
         self._callbacks_name = {}
         self._event_callbacks = {}
 
-        # Buffers to store partly received packets
-        self._buffers = {}
+        # Signals of remote objects we subscribed to: (conn, objname,
+        # signame) -> {hid: options}
+        self._subscribed = {}
+
+        # Signals of local objects that clients subscribed to:
+        # conn -> {(objname, signame): _Subscription}
+        self._subscriptions = {}
+        self._signal_stats = {'emitted': 0, 'sent': 0, 'skipped': 0,
+                'dropped': 0}
+
+        # Readers to store partly received packets
+        self._readers = {}
         self._send_queue = {}
+        self._send_queue_size = {}
+        self._send_queue_limit = None
+        self._send_hids = {}
+        self._send_lock = threading.RLock()
+
+        # Connections served by a transport other than the glib main loop,
+        # see register_transport()
+        self._transports = {}
+
+        # Timers used to coalesce subscribed signals
+        if gobject is not None:
+            self.set_timer_functions(gobject.timeout_add, gobject.source_remove)
+        else:
+            self.set_timer_functions(None, None)
+
+        # Negotiated (pickle protocol, out of band arrays) per connection
+        self._protocols = {}
 
     def set_client_timeout(self, timeout):
         '''
@@ -72,6 +492,51 @@ class ObjectSharer():
         '''
         self._client_timeout = timeout
 
+    def set_timer_functions(self, timeout_add, source_remove):
+        '''
+        Set the functions used to schedule a call after a delay, with the
+        signature of gobject.timeout_add() and gobject.source_remove().
+        Without them, rate limited signals are sent immediately.
+        '''
+        self._timeout_add = timeout_add
+        self._source_remove = source_remove
+
+    def register_transport(self, conn, transport):
+        '''
+        Let 'transport' serve connection 'conn' instead of the glib main
+        loop. The transport should provide:
+
+        - wakeup(): called when data is queued for conn that could not be
+          sent immediately; the transport should then call
+          _process_conn_send_queue(conn) when conn is writable.
+        - in_other_thread(): whether the transport reads conn in another
+          thread than the caller. Blocking calls then wait for the
+          transport to receive the reply instead of reading conn
+          themselves.
+        - timeout_add(ms, func, *args) and source_remove(id): timers, as
+          in gobject, running in the transport thread.
+        - connection_lost(conn): called when the object sharer removes
+          conn, e.g. after a send error.
+        '''
+        self._transports[conn] = transport
+
+    def set_send_queue_limit(self, nbytes):
+        '''
+        Do not send signals to clients that have more than nbytes queued,
+        e.g. because they do not read fast enough. None for no limit.
+        '''
+        self._send_queue_limit = nbytes
+
+    def get_send_queue_size(self, conn):
+        '''Return the number of bytes queued for connection 'conn'.'''
+        return self._send_queue_size.get(conn, 0)
+
+    def is_congested(self, conn):
+        '''Return whether the send queue for conn is above the limit.'''
+        if self._send_queue_limit is None:
+            return False
+        return self._send_queue_size.get(conn, 0) > self._send_queue_limit
+
     def add_client(self, conn, handler):
         '''
         Add a client through connection 'conn'.
@@ -81,6 +546,7 @@ class ObjectSharer():
         if info is None:
             logging.warning('Unable to get client root object')
             return None
+        self._negotiate_protocol(conn, info)
         client = ObjectProxy(conn, info)
         self._clients.append(client)
         name = client.get_instance_name()
@@ -88,6 +554,75 @@ class ObjectSharer():
         self._do_event_callbacks('connect', client)
         return client
 
+    def add_client_async(self, conn, dispatch=None, callback=None):
+        '''
+        Add a client through connection 'conn' without blocking. The
+        client is added when the replies to the object info and id
+        requests arrive; callback(client) is then called, with client None
+        on failure. As for add_client(), the id of the client is cached and
+        can be used in the 'disconnected' event callbacks.
+
+        If dispatch is given, e.g. gobject.idle_add, the client is added
+        through dispatch(func, *args) instead of directly.
+        '''
+
+        def info_cb(future):
+            info = future.get_value()
+            if future._error is not None or not isinstance(info, dict):
+                logging.warning('Unable to get client root object')
+                done_cb(None)
+                return
+            self._negotiate_protocol(conn, info)
+            client = ObjectProxy(conn, info)
+            client.get_id.call_async().add_done_callback(
+                    lambda f: done_cb(client))
+
+        def done_cb(client):
+            if dispatch is not None:
+                dispatch(finish, client)
+            else:
+                finish(client)
+
+        def finish(client):
+            if client is not None:
+                self._clients.append(client)
+                logging.info('Added client on %r', conn)
+                self._do_event_callbacks('connect', client)
+            if callback is not None:
+                callback(client)
+            return False
+
+        future = self.call_async(conn, 'root', 'get_object_info', 'root')
+        future.add_done_callback(info_cb)
+        return future
+
+    def _negotiate_protocol(self, conn, info):
+        '''
+        Use protocol version 2 if the peer announced it in its root object
+        info. Peers running an older version do not send the 'protocol'
+        item and keep receiving version 1 packets.
+        '''
+
+        if PROTOCOL_VERSION < 2 or info.get('protocol', 1) < 2:
+            logging.debug('Using protocol version 1')
+            return
+
+        proto = min(pickle.HIGHEST_PROTOCOL, info.get('pickle_protocol', 0))
+        oob = numpy is not None and info.get('oob_arrays', False)
+        self._protocols[conn] = (proto, oob)
+        logging.debug('Using protocol version 2, pickle protocol %d, out of band arrays: %s',
+                proto, oob)
+
+    def get_protocol(self, conn):
+        '''
+        Return the protocol version, pickle protocol and whether arrays
+        are sent out of band for a connection.
+        '''
+        if conn not in self._protocols:
+            return (1, 0, False)
+        proto, oob = self._protocols[conn]
+        return (2, proto, oob)
+
     def get_client_for_socket(self, conn):
         for c in self.clients:
             if c.get_proxy_socket() == conn:
@@ -104,7 +639,7 @@ class ObjectSharer():
         '''
         Register callback cb for event. Event is one of:
         - connect: client connected
-        - disconnect: client disconnected
+        - disconnected: client disconnected
         '''
 
         if event in self._event_callbacks:
@@ -125,8 +660,32 @@ class ObjectSharer():
                 self.remove_client(client)
                 break
 
-        if conn in self._send_queue:
-            del self._send_queue[conn]
+        self._send_lock.acquire()
+        try:
+            if conn in self._send_queue:
+                del self._send_queue[conn]
+            if conn in self._send_queue_size:
+                del self._send_queue_size[conn]
+            if conn in self._send_hids:
+                gobject.source_remove(self._send_hids.pop(conn))
+        finally:
+            self._send_lock.release()
+        transport = self._transports.pop(conn, None)
+        if transport is not None:
+            transport.connection_lost(conn)
+        if conn in self._readers:
+            del self._readers[conn]
+        if conn in self._protocols:
+            del self._protocols[conn]
+        for sub in self._subscriptions.pop(conn, {}).values():
+            sub.cancel()
+        for key in self._subscribed.keys():
+            if key[0] == conn:
+                del self._subscribed[key]
+        for callid, future in self._calls.items():
+            if future.conn == conn:
+                del self._calls[callid]
+                future._set_error('Connection closed')
 
     def get_clients(self):
         return self._clients
@@ -262,9 +821,74 @@ class ObjectSharer():
             retdata = pickle.dumps((info, msg))
         return retdata
 
-    def _unpickle_packet(self, data):
+    def _pickle_packet_oob(self, info, data, proto, oob):
+        '''
+        Pickle a packet using pickle protocol proto. If oob is True, numpy
+        arrays are not pickled but returned separately.
+
+        Output: (pickled packet, list of arrays)
+        '''
+
+        arrays = []
+        def persistent_id(obj):
+            if type(obj) is not numpy.ndarray or obj.dtype.hasobject or \
+                    obj.nbytes < OOB_MIN_SIZE:
+                return None
+            arrays.append(numpy.ascontiguousarray(obj))
+            return str(len(arrays) - 1)
+
+        f = cStringIO.StringIO()
+        try:
+            p = pickle.Pickler(f, proto)
+            if oob:
+                # cPickle only calls inst_persistent_id for objects that
+                # are not of a built-in type, which is much faster.
+                if hasattr(p, 'inst_persistent_id'):
+                    p.inst_persistent_id = persistent_id
+                else:
+                    p.persistent_id = persistent_id
+            p.dump((info, data))
+        except Exception, e:
+            msg = 'Unable to encode object: %s' % str(e)
+            return pickle.dumps((info, msg), proto), []
+        return f.getvalue(), arrays
+
+    def _encode_packet(self, conn, info, data):
+        '''
+        Return a packet for connection conn as a list of strings and
+        buffers, using the protocol version negotiated for conn.
+
+        Large arrays are not copied, the buffers refer to the arrays
+        themselves. _queue_send() copies the part that can not be sent
+        right away.
+        '''
+
+        if conn not in self._protocols:
+            return [_frame(self._pickle_packet(info, data))]
+
+        proto, oob = self._protocols[conn]
+        pdata, arrays = self._pickle_packet_oob(info, data, proto, oob)
+        meta = []
+        for arr in arrays:
+            if arr.dtype.fields:
+                meta.append((arr.dtype.descr, arr.shape))
+            else:
+                meta.append((arr.dtype.str, arr.shape))
+        meta = pickle.dumps(meta, proto)
+
+        ret = ['QB' + struct.pack('>II', len(meta), len(pdata)) + meta + pdata]
+        for arr in arrays:
+            if arr.nbytes > 0:
+                ret.append(buffer(arr))
+        return ret
+
+    def _unpickle_packet(self, data, arrays=None):
         try:
-            return pickle.loads(data)
+            if arrays is None:
+                return pickle.loads(data)
+            u = pickle.Unpickler(cStringIO.StringIO(data))
+            u.persistent_load = lambda pid: arrays[int(pid)]
+            return u.load()
         except Exception, e:
             logging.warning('Unable to decode object: %s [%r]', str(e), data)
             raise e
@@ -272,8 +896,7 @@ class ObjectSharer():
     def _send_return(self, conn, callid, retval):
         logging.debug('Returning for call %d: %r', callid, retval)
         retinfo = ('return', callid)
-        retdata = self._pickle_packet(retinfo, retval)
-        self.send_packet(conn, retdata)
+        self._queue_send(conn, self._encode_packet(conn, retinfo, retval))
 
     def handle_data(self, conn, data):
         '''
@@ -282,35 +905,77 @@ class ObjectSharer():
         immediately.
         '''
 
-        if conn not in self._buffers:
-            self._buffers[conn] = ''
+        self._recv_lock.acquire()
+        try:
+            reader = self._get_reader(conn)
+            try:
+                reader.feed(data)
+            except ValueError, e:
+                logging.warning('Packet magic missing, dumping data')
+            packets = reader.get_packets()
+        finally:
+            self._recv_lock.release()
 
-        self._buffers[conn] = self._buffers[conn] + data
+        self._handle_packets(conn, packets)
 
-        # Decode complete packets
-        while len(self._buffers[conn]) >= 6:
-            b = self._buffers[conn]
+    def receive(self, conn, maxbytes=RECV_MAX, dispatch=None):
+        '''
+        Read the data available on connection 'conn', up to maxbytes, and
+        handle complete packets. Returns False if the connection was
+        closed.
+
+        If dispatch is given, e.g. gobject.idle_add, incoming calls and
+        signals are handled through dispatch(func, *args), so a transport
+        thread can let another thread run them. Replies to calls are
+        always handled directly, so a thread waiting for one is woken up.
+        '''
 
-            if b[0] != 'Q' or b[1] != 'T':
-                self._buffers[conn] = ''
+        self._recv_lock.acquire()
+        try:
+            reader = self._get_reader(conn)
+            closed = False
+            try:
+                nread, closed = reader.recv(conn, maxbytes)
+            except ValueError, e:
                 logging.warning('Packet magic missing, dumping data')
-                return None
+            except socket.error, e:
+                logging.warning('Receive exception (%s), assuming client disconnected', e)
+                closed = True
+            packets = reader.get_packets()
+        finally:
+            self._recv_lock.release()
+
+        self._handle_packets(conn, packets, dispatch)
+        if closed:
+            if dispatch is not None:
+                dispatch(self._client_disconnected, conn)
+            else:
+                self._client_disconnected(conn)
+        return not closed
 
-            datalen = (ord(b[2]) << 24) + (ord(b[3]) << 16) + (ord(b[4]) << 8)  + ord(b[5])
-            if len(b) < datalen + 6:
-                logging.debug('Incomplete packet received')
-                return None
+    def _get_reader(self, conn):
+        if conn not in self._readers:
+            self._readers[conn] = _PacketReader()
+        return self._readers[conn]
 
-            packet = b[6:6+datalen]
-            self._buffers[conn] = b[6+datalen:]
+    def _handle_packets(self, conn, packets, dispatch=None):
+        '''Decode and process complete packets.'''
 
+        for packet, arrays in packets:
             try:
-                packet = self._unpickle_packet(packet)
+                packet = self._unpickle_packet(packet, arrays)
             except Exception, e:
                 logging.warning('Unable to unpickle packet')
-                return
+                continue
+
+            if dispatch is not None and packet[0][0] != 'return':
+                dispatch(self._handle_dispatched, conn, packet)
+            else:
+                self.handle_packet(conn, packet)
 
-            self.handle_packet(conn, packet)
+    def _handle_dispatched(self, conn, packet):
+        self.handle_packet(conn, packet)
+        return False
 
     def handle_packet(self, conn, packet):
         '''
@@ -323,19 +988,22 @@ class ObjectSharer():
         if info[0] == 'return':
             # (a)synchronous function reply
             callid = info[1]
-            if callid not in self._return_cbs:
-                logging.warning('Return received for unknown call %d', callid)
+            future = self._calls.pop(callid, None)
+            if future is None:
+                logging.warning('Return received for unknown or timed out call %d', callid)
                 return
 
-            func = self._return_cbs[callid]
-            del self._return_cbs[callid]
-
             if type(callinfo) == types.StringType and callinfo.startswith('sharedname:'):
                 sn = callinfo[11:]
                 logging.debug('Received shared object reference, finding %s', sn)
                 callinfo = helper.find_object(sn)
 
-            func(callinfo)
+            future._set_result(callinfo)
+            self._get_call_stats(future.name).add(future.get_latency())
+            return
+
+        elif info[0] in ('subscribe', 'unsubscribe'):
+            self._handle_subscription(conn, info[0], callinfo)
             return
 
         elif info[0] not in ('call', 'signal'):
@@ -375,7 +1043,7 @@ class ObjectSharer():
         try:
             ret = conn.send(data)
         except socket.error, e:
-            if e.errno not in (10035, ):
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, 10035):
                 logging.warning('Send exception (%s), assuming client disconnected', e)
                 self._client_disconnected(conn)
                 return -1
@@ -389,116 +1057,234 @@ class ObjectSharer():
         '''
 
         for conn in self._send_queue.keys():
-            datalist = self._send_queue[conn]
+            self._process_conn_send_queue(conn)
+        return True
+
+    def _process_conn_send_queue(self, conn):
+        '''
+        Send as much of the queue for conn as possible, return whether
+        data is left.
+        '''
+
+        self._send_lock.acquire()
+        try:
+            datalist = self._send_queue.get(conn, [])
             while len(datalist) > 0:
                 nsent = self._do_send_raw(conn, datalist[0])
 
-                # Ok
-                if nsent == len(datalist[0]):
-                    del datalist[0]
-
                 # Failed, signals disconnection so remove send queue
-                elif nsent == -1:
+                if nsent == -1:
                     if conn in self._send_queue:
                         del self._send_queue[conn]
-                    break
+                    return False
+
+                if conn in self._send_queue_size:
+                    self._send_queue_size[conn] -= nsent
+
+                # Ok
+                if nsent == len(datalist[0]):
+                    del datalist[0]
 
-                # Partially sent
+                # Partially sent; buffer() avoids copying large arrays
                 else:
-                    datalist[0] = datalist[0][nsent:]
+                    datalist[0] = buffer(datalist[0], nsent)
                     break
 
-        return True
+            if len(datalist) == 0:
+                return False
+            if conn in self._transports:
+                self._transports[conn].wakeup()
+            elif conn not in self._send_hids:
+                self._send_hids[conn] = gobject.io_add_watch(conn,
+                        gobject.IO_OUT, self._send_ready_cb)
+            return True
+        finally:
+            self._send_lock.release()
+
+    def _send_ready_cb(self, conn, condition):
+        if self._process_conn_send_queue(conn):
+            return True
+        if conn in self._send_hids:
+            del self._send_hids[conn]
+        return False
+
+    def _queue_send(self, conn, pieces):
+        for piece in pieces:
+            if len(piece) > 0xffffffffL:
+                logging.error('Trying to send too long packet: %d', len(piece))
+                return -1
+
+        self._send_lock.acquire()
+        try:
+            if conn not in self._send_queue:
+                self._send_queue[conn] = []
+            self._send_queue[conn].extend(pieces)
+            self._send_queue_size[conn] = self._send_queue_size.get(conn, 0) + \
+                    sum([len(piece) for piece in pieces])
+            self._process_conn_send_queue(conn)
+
+            # The pieces of this packet that are still queued are at the
+            # end. Copy the array buffers, so that changes made to the
+            # arrays after they were returned or emitted are not sent.
+            datalist = self._send_queue.get(conn, [])
+            for i in range(max(0, len(datalist) - len(pieces)), len(datalist)):
+                if isinstance(datalist[i], buffer):
+                    datalist[i] = str(datalist[i])
+        finally:
+            self._send_lock.release()
 
     def send_packet(self, conn, data):
-        dlen = len(data)
-        if dlen > 0xffffffffL:
-            logging.error('Trying to send too long packet: %d', dlen)
-            return -1
-
-        tosend = 'QT%c%c%c%c' % ((dlen&0xff000000)>>24, \
-            (dlen&0x00ff0000)>>16, (dlen&0x0000ff00)>>8, (dlen&0x000000ff))
-        tosend += data
-
-        if conn not in self._send_queue:
-            self._send_queue[conn] = []
-        self._send_queue[conn].append(tosend)
-        self._process_send_queue()
-
-    def _call_cb(self, callid, val):
-        if callid in self._return_vals:
-            logging.warning('Received late reply for call %d', callid)
-            del self._return_vals[callid]
-        else:
-            self._return_vals[callid] = val
+        '''Send a pickled packet as a version 1 packet.'''
+        return self._queue_send(conn, [_frame(data)])
 
-    def call(self, conn, objname, funcname, *args, **kwargs):
+    def _get_call_stats(self, name):
+        if name not in self._call_stats:
+            self._call_stats[name] = _CallStats()
+        return self._call_stats[name]
+
+    def get_call_stats(self):
         '''
-        Call a function through connection 'conn'
+        Return the latency statistics of remote calls per function
+        ('object.function'): the number of replies, mean and maximum
+        latency, number of timeouts and a histogram as a list of
+        (upper bin edge in seconds, count); the last edge is None.
         '''
 
-        cb = kwargs.pop('callback', None)
-        is_signal = kwargs.pop('signal', False)
-        timeout = kwargs.pop('timeout', self.TIMEOUT)
-        blocking = (cb is None and not is_signal)
+        ret = {}
+        for name, stats in self._call_stats.iteritems():
+            ret[name] = stats.get()
+        return ret
 
-        if not is_signal:
+    def call_async(self, conn, objname, funcname, *args, **kwargs):
+        '''
+        Call a function through connection 'conn' without waiting for the
+        reply. Several calls can be outstanding on one connection; replies
+        are matched by call id, in any order.
+
+        Output: CallFuture
+        '''
+
+        self._send_lock.acquire()
+        try:
             self._last_call_id += 1
             callid = self._last_call_id
-            if cb is not None:
-                self._return_cbs[callid] = cb
-            else:
-                self._return_cbs[callid] = lambda val: self._call_cb(callid, val)
-
-            info = ('call', callid)
-        else:
-            cb = None
-            info = ('signal', )
+        finally:
+            self._send_lock.release()
+        future = CallFuture(callid, conn, '%s.%s' % (objname, funcname))
+        self._calls[callid] = future
 
-        logging.debug('Calling %s.%s(%r, %r), info=%r, blocking=%r', objname, funcname, args, kwargs, info, blocking)
+        logging.debug('Calling %s.%s(%r, %r), callid=%d', objname, funcname, args, kwargs, callid)
 
         callinfo = (objname, funcname, args, kwargs)
-        cmd = self._pickle_packet(info, callinfo)
-        start_time = time.time()
-        self.send_packet(conn, cmd)
+        cmd = self._encode_packet(conn, ('call', callid), callinfo)
+        self._queue_send(conn, cmd)
+        return future
 
-        if not blocking:
-            return
+    def wait_call(self, future, timeout):
+        '''
+        Wait until the reply for future arrives or timeout seconds passed.
+
+        In the main thread the connection is read directly, select() is
+        woken up as soon as data arrives. Other threads read the
+        connection as well unless another thread is reading it, in which
+        case they wait until that thread receives the reply for them.
+        The same holds for connections served by a transport running in
+        another thread, see register_transport().
+        '''
 
-        # Wait for return
-        while time.time() - start_time < timeout:
-            if callid in self._return_vals:
+        conn = future.conn
+        deadline = time.time() + timeout
+        in_main = threading.currentThread() is self._main_thread
+        while not future.done():
+            remaining = deadline - time.time()
+            if remaining <= 0:
                 break
 
-            # Don't depend on a main loop to receive data while blocking
-            import select
-            lists = select.select([conn], [], [], 0.1)
-            if len(lists[0]) > 0:
-                try:
-                    data = conn.recv(BUFSIZE)
-                except:
-                    # Cope with strange windows errors?
-                    time.sleep(0.002)
-                    continue
+            transport = self._transports.get(conn, None)
+            if transport is not None and transport.in_other_thread():
+                # Waiting without a timeout does not poll, so let the
+                # transport end the wait at the deadline
+                tid = transport.timeout_add(int(remaining * 1000) + 1,
+                        self._timeout_call, future)
+                future.wait(None)
+                transport.source_remove(tid)
+                continue
 
-                if len(data) == 0:
+            if not self._recv_lock.acquire(False):
+                future.wait(min(remaining, 0.05))
+                continue
+
+            try:
+                if future.done():
+                    break
+                if not in_main:
+                    remaining = min(remaining, 0.05)
+                if len(self._send_queue.get(conn, [])) > 0:
+                    wlist = [conn]
+                else:
+                    wlist = []
+                try:
+                    lists = select.select([conn], wlist, [], remaining)
+                except (select.error, socket.error), e:
+                    future._set_error('Connection error: %s' % (e, ))
                     self._client_disconnected(conn)
-                    return
-                self.handle_data(conn, data)
-            else:
-                time.sleep(0.002)
-
-        if callid in self._return_vals:
-            ret = self._return_vals[callid]
-            del self._return_vals[callid]
-            if isinstance(ret, Exception):
-                raise Exception('Remote error: %s' % str(ret))
-            return ret
-        else:
-            logging.warning('Blocking call %d timed out', callid)
-            self._return_vals[callid] = None    # Mark as timed out
+                    break
+                if len(lists[1]) > 0:
+                    self._process_conn_send_queue(conn)
+                if len(lists[0]) > 0 and not self.receive(conn):
+                    break
+            finally:
+                self._recv_lock.release()
 
-        return None
+        self._timeout_call(future)
+
+    def _timeout_call(self, future):
+        '''Fail future if the reply did not arrive yet.'''
+        if not future.done() and future.callid in self._calls:
+            del self._calls[future.callid]
+            self._get_call_stats(future.name).ntimeouts += 1
+            future._set_error('Call %d (%s) timed out' % \
+                    (future.callid, future.name))
+        return False
+
+    def call(self, conn, objname, funcname, *args, **kwargs):
+        '''
+        Call a function through connection 'conn'.
+
+        By default the call blocks until the reply arrives, at most
+        'timeout' seconds, and returns the value (None on timeout).
+        With callback=func the call returns immediately and func(value)
+        is called when the reply arrives. With signal=True no reply is
+        sent.
+        '''
+
+        cb = kwargs.pop('callback', None)
+        is_signal = kwargs.pop('signal', False)
+        timeout = kwargs.pop('timeout', self.TIMEOUT)
+
+        if is_signal:
+            logging.debug('Calling %s.%s(%r, %r) as signal', objname, funcname, args, kwargs)
+            callinfo = (objname, funcname, args, kwargs)
+            self._queue_send(conn, self._encode_packet(conn, ('signal', ), callinfo))
+            return
+
+        future = self.call_async(conn, objname, funcname, *args, **kwargs)
+        if cb is not None:
+            def done_cb(future):
+                if future._error is None:
+                    cb(future.get_value())
+            future.add_done_callback(done_cb)
+            return
+
+        self.wait_call(future, timeout)
+        if future._error is not None:
+            logging.warning('Blocking call failed: %s', future._error)
+            return None
+
+        ret = future.get_value()
+        if isinstance(ret, Exception):
+            raise Exception('Remote error: %s' % str(ret))
+        return ret
 
     def connect(self, objname, signame, callback, *args, **kwargs):
         '''
@@ -533,13 +1319,119 @@ class ObjectSharer():
                     del self._callbacks_name[name][index]
                     break
 
+        for key, hids in self._subscribed.items():
+            if hid in hids:
+                del hids[hid]
+                self._send_subscription(key)
+
+    def subscribe(self, conn, objname, signame, hid, min_interval=0,
+            coalesce='latest'):
+        '''
+        Ask the peer on connection 'conn' to send signal 'signame' of
+        object 'objname', for the callback with handle 'hid'. Called by
+        ObjectProxy.connect().
+
+        Peers using protocol version 2 only send signals that were
+        subscribed to; older peers send all signals.
+
+        If min_interval is larger than 0, the peer sends the signal at
+        most once per min_interval seconds; see _Subscription for the
+        meaning of coalesce. If there are several callbacks for a signal,
+        the smallest interval is used.
+        '''
+
+        key = (conn, objname, signame)
+        if key not in self._subscribed:
+            self._subscribed[key] = {}
+        self._subscribed[key][hid] = (min_interval, coalesce)
+        self._send_subscription(key)
+
+    def _send_subscription(self, key):
+        '''Send the (changed) subscription for key to the peer.'''
+
+        conn, objname, signame = key
+        hids = self._subscribed.get(key, {})
+        if len(hids) == 0:
+            if key in self._subscribed:
+                del self._subscribed[key]
+            info = ('unsubscribe', )
+            options = None
+        else:
+            info = ('subscribe', )
+            options = {
+                'min_interval': min([o[0] for o in hids.values()]),
+                'coalesce': 'latest',
+            }
+            if 'merge' in [o[1] for o in hids.values()]:
+                options['coalesce'] = 'merge'
+
+        if conn in self._protocols:
+            packet = self._encode_packet(conn, info, (objname, signame, options))
+            self._queue_send(conn, packet)
+
+    def _handle_subscription(self, conn, request, callinfo):
+        objname, signame, options = callinfo
+        subs = self._subscriptions.setdefault(conn, {})
+        key = (objname, signame)
+        if key in subs:
+            subs[key].cancel()
+            del subs[key]
+
+        if request == 'subscribe':
+            logging.debug('Subscribing %r to %s.%s, %r', conn, objname,
+                    signame, options)
+            subs[key] = _Subscription(objname, signame, **options)
+
+    def get_signal_stats(self):
+        '''
+        Return the number of signals emitted, sent to clients, not sent
+        because no client subscribed and dropped because the send queue
+        of a client was full (see set_send_queue_limit()), and for each
+        subscription of each client the options and the number of signals
+        sent and coalesced.
+        '''
+
+        ret = dict(self._signal_stats)
+        clients = {}
+        for client in self._clients:
+            subs = self._subscriptions.get(client.get_connection(), {})
+            info = {}
+            for (objname, signame), sub in subs.iteritems():
+                info['%s.%s' % (objname, signame)] = {
+                    'min_interval': sub.min_interval,
+                    'coalesce': sub.coalesce,
+                    'sent': sub.nsent,
+                    'coalesced': sub.ncoalesced,
+                }
+            clients[client.get_instance_name()] = info
+        ret['clients'] = clients
+        return ret
+
     def emit_signal(self, objname, signame, *args, **kwargs):
         logging.debug('Emitting %s(%r, %r) for %s to %d clients',
                 signame, args, kwargs, objname, len(self._clients))
 
         kwargs['signal'] = True
+        key = (objname, signame)
+        self._signal_stats['emitted'] += 1
         for client in self._clients:
-            client.receive_signal(objname, signame, *args, **kwargs)
+            conn = client.get_connection()
+            if self.is_congested(conn):
+                self._signal_stats['dropped'] += 1
+                continue
+
+            # Older peers do not subscribe, send them everything
+            if conn not in self._protocols:
+                client.receive_signal(objname, signame, *args, **kwargs)
+                self._signal_stats['sent'] += 1
+                continue
+
+            sub = self._subscriptions.get(conn, {}).get(key, None)
+            if sub is None:
+                self._signal_stats['skipped'] += 1
+                continue
+            sub.send(client, args, kwargs)
+            self._signal_stats['sent'] += 1
 
     def receive_signal(self, objname, signame, *args, **kwargs):
         logging.debug('Received signal %s(%r, %r) from %s',
@@ -659,42 +1551,44 @@ def create_shared_object(name, obj):
     '''
     return SharedObject(name, wrapobj=obj)
 
-class SharedGObject(gobject.GObject, SharedObject):
+if gobject is not None:
 
-    def __init__(self, name, replace=False, idle_emit=False):
-        logging.debug('Creating shared Gobject: %r', name)
-        self.__hid_map = {}
-        self._do_idle_emit = idle_emit
-        gobject.GObject.__init__(self)
-        SharedObject.__init__(self, name, replace=replace)
+    class SharedGObject(gobject.GObject, SharedObject):
 
-    def connect(self, signal, *args, **kwargs):
-        hid = SharedObject.connect(self, signal, *args, **kwargs)
-        ghid = gobject.GObject.connect(self, signal, *args, **kwargs)
-        self.__hid_map[ghid] = hid
-        return ghid
+        def __init__(self, name, replace=False, idle_emit=False):
+            logging.debug('Creating shared Gobject: %r', name)
+            self.__hid_map = {}
+            self._do_idle_emit = idle_emit
+            gobject.GObject.__init__(self)
+            SharedObject.__init__(self, name, replace=replace)
 
-    def _idle_emit(self, signal, *args, **kwargs):
-        try:
-            gobject.GObject.emit(self, signal, *args, **kwargs)
-        except Exception, e:
-            print 'Error: %s' % e
+        def connect(self, signal, *args, **kwargs):
+            hid = SharedObject.connect(self, signal, *args, **kwargs)
+            ghid = gobject.GObject.connect(self, signal, *args, **kwargs)
+            self.__hid_map[ghid] = hid
+            return ghid
 
-    def emit(self, signal, *args, **kwargs):
-        # The 'None' here is the 'sender'
-        SharedObject.emit(self, signal, None, *args, **kwargs)
-        if self._do_idle_emit:
-            gobject.idle_add(self._idle_emit, signal, *args, **kwargs)
-        else:
-            return gobject.GObject.emit(self, signal, *args, **kwargs)
+        def _idle_emit(self, signal, *args, **kwargs):
+            try:
+                gobject.GObject.emit(self, signal, *args, **kwargs)
+            except Exception, e:
+                print 'Error: %s' % e
 
-    def disconnect(self, ghid):
-        if ghid not in self.__hid_map:
-            return
-        hid = self.__hid_map[ghid]
-        SharedObject.disconnect(self, hid)
-        del self.__hid_map[ghid]
-        return gobject.GObject.disconnect(self, ghid)
+        def emit(self, signal, *args, **kwargs):
+            # The 'None' here is the 'sender'
+            SharedObject.emit(self, signal, None, *args, **kwargs)
+            if self._do_idle_emit:
+                gobject.idle_add(self._idle_emit, signal, *args, **kwargs)
+            else:
+                return gobject.GObject.emit(self, signal, *args, **kwargs)
+
+        def disconnect(self, ghid):
+            if ghid not in self.__hid_map:
+                return
+            hid = self.__hid_map[ghid]
+            SharedObject.disconnect(self, hid)
+            del self.__hid_map[ghid]
+            return gobject.GObject.disconnect(self, ghid)
 
 class _FunctionCall():
 
@@ -720,6 +1614,22 @@ class _FunctionCall():
             self._cached_result = ret
         return ret
 
+    def call_async(self, *args, **kwargs):
+        '''
+        Call the remote function without waiting, return a CallFuture.
+        The result is cached when the reply arrives, as for a blocking call.
+        '''
+        future = helper.call_async(self._conn, self._objname,
+                self._funcname, *args, **kwargs)
+        if self._share_options.get('cache_result', False):
+            future.add_done_callback(self._cache_cb)
+        return future
+
+    def _cache_cb(self, future):
+        ret = future.get_value()
+        if future._error is None and not isinstance(ret, Exception):
+            self._cached_result = ret
+
 class ObjectProxy():
     '''
     Client side object proxy.
@@ -743,8 +1653,16 @@ class ObjectProxy():
     def get_connection(self):
         return self.__conn
 
-    def connect(self, signame, func):
-        return helper.connect(self.__name, signame, func)
+    def connect(self, signame, func, min_interval=0, coalesce='latest'):
+        '''
+        Connect func to signal signame of the remote object. The remote
+        side is asked to send this signal (see ObjectSharer.subscribe());
+        min_interval and coalesce can be used to limit the rate.
+        '''
+        hid = helper.connect(self.__name, signame, func)
+        helper.subscribe(self.__conn, self.__name, signame, hid,
+                min_interval, coalesce)
+        return hid
 
     def disconnect(self, hid):
         return helper.disconnect(hid)
@@ -790,6 +1708,9 @@ class RootObject(SharedObject):
             'name': objname,
             'properties': props,
             'functions': funcs,
+            'protocol': PROTOCOL_VERSION,
+            'pickle_protocol': pickle.HIGHEST_PROTOCOL,
+            'oob_arrays': numpy is not None,
         }
         return info
 
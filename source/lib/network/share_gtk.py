@@ -17,6 +17,13 @@ class Handler(tcpservergtk.GlibTCPHandler):
             data = objsh.helper.handle_data(self.socket, data)
         return True
 
+    def _handle_recv(self, sock, condition):
+        '''Let the object sharer read directly into its packet buffers.'''
+        if objsh.helper.receive(self.socket):
+            return True
+        self._handle_hup()
+        return False
+
 _flush_queue_hid = None
 
 def setup_glib_flush_queue():
@@ -0,0 +1,452 @@
+# share_select.py, object sharing transport without a glib main loop
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Object sharing server and client based on a select() loop, speaking the
+same protocol as share_gtk. It can be used without gobject, e.g. by
+analysis processes or dashboards, and next to a glib main loop.
+
+The Reactor serves all connections in one thread:
+
+- Replies and signals are written as soon as the socket is writable; a
+  thread that queues data wakes the reactor up, nothing waits for a
+  periodic flush.
+- A client whose send queue grows above max_send_queue bytes, because it
+  does not read fast enough, is not read from until the queue is below
+  half of that, and signals to it are dropped in the mean time.
+- New connections are accepted without waiting for the client, with a
+  listen backlog of 'backlog' connections.
+
+By default incoming calls and signals are handled in the reactor thread.
+Inside QTLab pass dispatch=gobject.idle_add to handle them in the main
+loop instead. Blocking calls made from other threads wait for the reactor
+to receive the reply.
+
+Use run_server() for a headless server that runs the reactor in the
+calling thread; its timers are then used to rate limit signals.
+'''
+
+import socket
+import select
+import errno
+import heapq
+import threading
+import logging
+import time
+import re
+
+import object_sharer as objsh
+
+_WOULDBLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, 10035)
+
+def _socketpair():
+    '''Return a connected pair of sockets, also on Windows.'''
+
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        a = socket.create_connection(listener.getsockname())
+        b, addr = listener.accept()
+    finally:
+        listener.close()
+    return a, b
+
+class Listener():
+    '''A listening socket served by a Reactor.'''
+
+    def __init__(self, reactor, host, port, backlog, allowed_ip=None):
+        self._reactor = reactor
+        self._allowed_ips = []
+        if allowed_ip:
+            self.add_allowed_ip(allowed_ip)
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.setblocking(0)
+        self.socket.listen(backlog)
+
+    def add_allowed_ip(self, ip_regexp):
+        self._allowed_ips.append(re.compile(ip_regexp))
+
+    def allow_client(self, ip):
+        for regexp in self._allowed_ips:
+            if regexp.match(ip):
+                return True
+        return False
+
+    def close(self):
+        self._reactor.remove_listener(self)
+
+class Reactor():
+
+    def __init__(self, backlog=16, max_send_queue=64 << 20, dispatch=None):
+        '''
+        Input:
+            backlog (int): number of connections the OS queues before they
+                are accepted
+            max_send_queue (int): send queue size in bytes above which a
+                client is not read from and signals to it are dropped
+            dispatch (function): function(func, *args) used to handle
+                incoming calls and signals, e.g. gobject.idle_add; None to
+                handle them in the reactor thread
+        '''
+
+        self._backlog = backlog
+        self._max_send_queue = max_send_queue
+        self._dispatch = dispatch
+
+        self._listeners = {}
+        self._conns = {}
+        self._paused = set()
+        self._lost = []
+
+        self._timers = []
+        self._timer_ids = {}
+        self._last_timer_id = 0
+        self._timer_lock = threading.Lock()
+
+        self._wake_r, self._wake_w = _socketpair()
+        self._wake_r.setblocking(0)
+        self._wake_w.setblocking(0)
+
+        self._thread = None
+        self._running = False
+
+        objsh.helper.set_send_queue_limit(max_send_queue)
+
+    def listen(self, host='', port=objsh.PORT, allowed_ip='127.0.0.1'):
+        '''Start accepting connections on (host, port), return a Listener.'''
+        listener = Listener(self, host, port, self._backlog, allowed_ip)
+        self._listeners[listener.socket] = listener
+        self.wakeup()
+        return listener
+
+    def remove_listener(self, listener):
+        if listener.socket in self._listeners:
+            del self._listeners[listener.socket]
+        listener.socket.close()
+        self.wakeup()
+
+    def connect(self, host, port=objsh.PORT, timeout=None):
+        '''
+        Connect to a sharing server and return the client, or None if the
+        server did not respond.
+        '''
+
+        if timeout is None:
+            timeout = objsh.helper._client_timeout
+        sock = socket.create_connection((host, port), timeout)
+        sock.setblocking(0)
+        self.add_connection(sock)
+        client = objsh.helper.add_client(sock, None)
+        if client is None:
+            self.remove_connection(sock)
+        return client
+
+    def add_connection(self, conn):
+        '''Serve the non-blocking socket conn.'''
+        self._conns[conn] = True
+        objsh.helper.register_transport(conn, self)
+        self.wakeup()
+
+    def remove_connection(self, conn):
+        if conn in self._conns:
+            del self._conns[conn]
+        self._paused.discard(conn)
+        try:
+            conn.close()
+        except socket.error:
+            pass
+
+    def connection_lost(self, conn):
+        '''Stop serving conn; called by the object sharer.'''
+        self._lost.append(conn)
+        self.wakeup()
+
+    def wakeup(self):
+        '''Make the reactor recompute what to wait for.'''
+        if threading.currentThread() is self._thread:
+            return
+        try:
+            self._wake_w.send('x')
+        except socket.error, e:
+            if e.args[0] not in _WOULDBLOCK:
+                raise
+
+    def in_other_thread(self):
+        '''Return whether the reactor runs in a thread other than the caller.'''
+        thread = self._thread
+        return thread is not None and thread is not threading.currentThread()
+
+    def timeout_add(self, delay, func, *args):
+        '''
+        Call func(*args) after delay ms in the reactor thread; it is
+        called again after the same delay as long as it returns True.
+        Returns an id for source_remove().
+        '''
+
+        self._timer_lock.acquire()
+        try:
+            self._last_timer_id += 1
+            tid = self._last_timer_id
+            timer = [time.time() + delay / 1000.0, tid, delay, func, args]
+            self._timer_ids[tid] = timer
+            heapq.heappush(self._timers, timer)
+        finally:
+            self._timer_lock.release()
+        self.wakeup()
+        return tid
+
+    def source_remove(self, tid):
+        self._timer_lock.acquire()
+        try:
+            timer = self._timer_ids.pop(tid, None)
+            if timer is not None:
+                timer[3] = None
+        finally:
+            self._timer_lock.release()
+
+    def _run_timers(self):
+        '''Run due timers, return the time until the next one or None.'''
+
+        while True:
+            self._timer_lock.acquire()
+            try:
+                while len(self._timers) > 0 and self._timers[0][3] is None:
+                    heapq.heappop(self._timers)
+                if len(self._timers) == 0:
+                    return None
+                delay = self._timers[0][0] - time.time()
+                if delay > 0:
+                    return delay
+                timer = heapq.heappop(self._timers)
+            finally:
+                self._timer_lock.release()
+
+            when, tid, interval, func, args = timer
+            try:
+                again = func(*args)
+            except Exception, e:
+                logging.warning('Timer callback %s failed: %s', func, e)
+                again = False
+
+            self._timer_lock.acquire()
+            try:
+                if again and timer[3] is not None:
+                    timer[0] = time.time() + interval / 1000.0
+                    heapq.heappush(self._timers, timer)
+                elif tid in self._timer_ids:
+                    del self._timer_ids[tid]
+            finally:
+                self._timer_lock.release()
+
+    def _accept(self, listener):
+        while True:
+            try:
+                sock, addr = listener.socket.accept()
+            except socket.error, e:
+                if e.args[0] not in _WOULDBLOCK:
+                    logging.warning('Accept failed: %s', e)
+                return
+
+            if not listener.allow_client(addr[0]):
+                logging.warning('Not allowing connection from %s', addr)
+                sock.close()
+                continue
+            logging.info('Allowing connection from %s', addr)
+
+            sock.setblocking(0)
+            self.add_connection(sock)
+            objsh.helper.add_client_async(sock, dispatch=self._dispatch)
+
+    def _update_paused(self, conn):
+        '''Stop or resume reading from conn depending on its send queue.'''
+
+        size = objsh.helper.get_send_queue_size(conn)
+        if conn in self._paused:
+            if size < self._max_send_queue / 2:
+                logging.info('Resuming reading from %r', conn)
+                self._paused.discard(conn)
+        elif size > self._max_send_queue:
+            logging.info('Client %r does not read fast enough, %d bytes queued; pausing',
+                    conn, size)
+            self._paused.add(conn)
+
+    def _drop_closed(self):
+        '''Remove connections that were closed elsewhere.'''
+        for conn in self._conns.keys():
+            try:
+                conn.fileno()
+                select.select([conn], [], [], 0)
+            except (select.error, socket.error, ValueError):
+                logging.warning('Connection %r closed, removing', conn)
+                objsh.helper._client_disconnected(conn)
+                self.remove_connection(conn)
+
+    def iterate(self, timeout=None):
+        '''Wait for and handle events, at most timeout seconds.'''
+
+        while len(self._lost) > 0:
+            self.remove_connection(self._lost.pop())
+
+        delay = self._run_timers()
+        if delay is not None and (timeout is None or delay < timeout):
+            timeout = delay
+
+        rlist = [self._wake_r] + self._listeners.keys()
+        wlist = []
+        for conn in self._conns.keys():
+            self._update_paused(conn)
+            if conn not in self._paused:
+                rlist.append(conn)
+            if objsh.helper.get_send_queue_size(conn) > 0:
+                wlist.append(conn)
+
+        try:
+            readable, writable, errors = select.select(rlist, wlist, [],
+                    timeout)
+        except (select.error, socket.error), e:
+            if e.args[0] == errno.EINTR:
+                return
+            self._drop_closed()
+            return
+
+        for conn in writable:
+            if conn in self._conns:
+                objsh.helper._process_conn_send_queue(conn)
+
+        for sock in readable:
+            if sock is self._wake_r:
+                try:
+                    self._wake_r.recv(4096)
+                except socket.error:
+                    pass
+            elif sock in self._listeners:
+                self._accept(self._listeners[sock])
+            elif sock in self._conns:
+                if not objsh.helper.receive(sock, dispatch=self._dispatch):
+                    self.remove_connection(sock)
+
+    def run(self):
+        '''Run the reactor in the calling thread until stop() is called.'''
+
+        self._thread = threading.currentThread()
+        self._running = True
+        try:
+            while self._running:
+                self.iterate()
+        finally:
+            self._thread = None
+
+    def start(self):
+        '''Run the reactor in a background thread.'''
+
+        if self._thread is not None:
+            return
+        thread = threading.Thread(target=self.run, name='Object sharer')
+        thread.setDaemon(True)
+        self._thread = thread
+        thread.start()
+
+    def stop(self):
+        self._running = False
+        self.wakeup()
+
+    def get_stats(self):
+        '''Return the number of connections, paused ones and queued bytes.'''
+        queued = 0
+        for conn in self._conns:
+            queued += objsh.helper.get_send_queue_size(conn)
+        return {
+            'listeners': len(self._listeners),
+            'connections': len(self._conns),
+            'paused': len(self._paused),
+            'queued': queued,
+        }
+
+_reactor = None
+
+def get_reactor(**kwargs):
+    '''
+    Return the reactor, create it on first use with arguments kwargs (see
+    Reactor.__init__()).
+    '''
+    global _reactor
+    if _reactor is None:
+        _reactor = Reactor(**kwargs)
+    return _reactor
+
+def _use_timers(reactor, force=False):
+    '''
+    Let the object sharer use the reactor timers, if forced or if there
+    is no glib main loop to provide them.
+    '''
+    if force or objsh.gobject is None:
+        objsh.helper.set_timer_functions(reactor.timeout_add,
+                reactor.source_remove)
+
+def start_server(host='', port=objsh.PORT, **kwargs):
+    '''
+    Start a sharing server with the reactor running in a background
+    thread. kwargs are passed to Reactor.__init__().
+    '''
+    try:
+        reactor = get_reactor(**kwargs)
+        objsh.SharedObject.server = reactor.listen(host, port)
+        _use_timers(reactor)
+        reactor.start()
+        return True
+    except Exception, e:
+        logging.warning('Failed to start sharing server: %s', str(e))
+        return False
+
+def run_server(host='', port=objsh.PORT, **kwargs):
+    '''
+    Run a headless sharing server in the calling thread; returns when
+    get_reactor().stop() is called.
+    '''
+    reactor = get_reactor(**kwargs)
+    objsh.SharedObject.server = reactor.listen(host, port)
+    _use_timers(reactor, force=True)
+    reactor.run()
+
+def start_client(host, port=objsh.PORT, nretry=1, **kwargs):
+    '''
+    Connect to a sharing server, with the reactor running in a background
+    thread; signal callbacks are called in that thread unless a dispatch
+    function is given. Returns the client or False.
+    '''
+
+    reactor = get_reactor(**kwargs)
+    _use_timers(reactor)
+    reactor.start()
+    while nretry > 0:
+        nretry -= 1
+        try:
+            client = reactor.connect(host, port)
+            if client is not None:
+                return client
+        except Exception, e:
+            logging.warning('Failed to start sharing client: %s', str(e))
+        if nretry > 0:
+            logging.info('Retrying in 2 seconds...')
+            time.sleep(2)
+    return False
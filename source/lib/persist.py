@@ -0,0 +1,241 @@
+# persist.py, store for values of FLAG_PERSIST instrument parameters
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Persistent values of instrument parameters (Instrument.FLAG_PERSIST).
+
+Changes are kept in memory and written to a JSON file by a background
+thread at most 'write_delay' seconds later, so setting a persistent
+parameter in a sweep does not write to disk for every point. The file is
+written to a temporary file first and then renamed, so an interrupted
+write never leaves a truncated file. flush() writes pending changes
+immediately; it is called when QTLab exits.
+
+Values stored in the config file by earlier versions ('persist_<ins>_<par>')
+are used if the store does not contain a value yet.
+'''
+
+import os
+import time
+import logging
+import threading
+
+try:
+    import json
+except:
+    import simplejson as json
+
+from lib.config import get_config, get_execdir
+
+def _to_json(obj):
+    '''Convert numpy scalars and arrays, which json cannot serialize.'''
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    raise TypeError('%r is not JSON serializable' % (obj, ))
+
+def _to_string(obj):
+    '''Like _to_json(), but store other objects as their repr().'''
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    return repr(obj)
+
+def _dumps(values):
+    '''
+    Return values as JSON and whether all values could be converted.
+    Values that can not be converted, e.g. complex numbers, are stored as
+    strings so that the other values are still saved.
+    '''
+
+    try:
+        data = json.dumps(values, indent=4, sort_keys=True, default=_to_json)
+        return data, True
+    except (TypeError, ValueError), e:
+        logging.warning('Storing unsupported persistent values as strings: %s',
+                e)
+    data = json.dumps(values, indent=4, sort_keys=True, default=_to_string)
+    return data, False
+
+class ParameterStore:
+
+    def __init__(self, filename, write_delay=1.0):
+        '''
+        Input:
+            filename (string): JSON file to store the values in
+            write_delay (float): maximum time in seconds between a change
+                and writing it to disk
+        '''
+
+        self._filename = filename
+        self._write_delay = write_delay
+        self._values = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._nchanges = 0
+        self._nwrites = 0
+        self._write_time = 0.0
+
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self._filename):
+            return
+        try:
+            f = open(self._filename, 'r')
+            try:
+                values = json.load(f)
+            finally:
+                f.close()
+        except Exception, e:
+            logging.warning('Unable to load persistent values from %s: %s',
+                    self._filename, e)
+            return
+
+        self._lock.acquire()
+        try:
+            self._values = values
+        finally:
+            self._lock.release()
+
+    def get(self, insname, param):
+        '''Return the stored value of parameter param of insname, or None.'''
+
+        self._lock.acquire()
+        try:
+            insvals = self._values.get(insname, {})
+            if param in insvals:
+                return insvals[param]
+        finally:
+            self._lock.release()
+
+        return get_config().get('persist_%s_%s' % (insname, param))
+
+    def set(self, insname, param, value):
+        '''Store a value, it is written to disk in the background.'''
+
+        self._lock.acquire()
+        try:
+            self._values.setdefault(insname, {})[param] = value
+            self._dirty = True
+            self._nchanges += 1
+        finally:
+            self._lock.release()
+
+        self._start_writer()
+        self._wakeup.set()
+
+    def _start_writer(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run,
+                name='Persistent parameter writer')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            # Collect the changes made in the next write_delay seconds
+            time.sleep(self._write_delay)
+            try:
+                self.flush()
+            except Exception, e:
+                # Keep the thread running, later changes are written again
+                logging.exception('Unable to save persistent values')
+
+    def flush(self):
+        '''Write pending changes to disk now.'''
+
+        self._write_lock.acquire()
+        try:
+            self._lock.acquire()
+            try:
+                if not self._dirty:
+                    return
+                try:
+                    data, exact = _dumps(self._values)
+                except Exception, e:
+                    logging.error('Unable to convert persistent values: %s',
+                            e)
+                    return
+                if not exact:
+                    # Keep the values as they will be loaded next time
+                    self._values = json.loads(data)
+                self._dirty = False
+            finally:
+                self._lock.release()
+
+            start = time.time()
+            try:
+                self._write(data)
+            except Exception, e:
+                logging.warning('Unable to save persistent values to %s: %s',
+                        self._filename, e)
+                self._lock.acquire()
+                self._dirty = True
+                self._lock.release()
+                return
+            self._nwrites += 1
+            self._write_time += time.time() - start
+        finally:
+            self._write_lock.release()
+
+    def _write(self, data):
+        tmppath = self._filename + '.tmp'
+        f = open(tmppath, 'w')
+        try:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+
+        try:
+            os.rename(tmppath, self._filename)
+        except OSError:
+            # Renaming over an existing file fails on Windows
+            os.remove(self._filename)
+            os.rename(tmppath, self._filename)
+
+    def get_stats(self):
+        '''Return the number of changes and writes and the total write time.'''
+        return {
+            'changes': self._nchanges,
+            'writes': self._nwrites,
+            'write_time': self._write_time,
+            'pending': self._dirty,
+        }
+
+_store = None
+
+def get_store():
+    '''Return the parameter store, create it on first use.'''
+    global _store
+    if _store is None:
+        config = get_config()
+        filename = config.get('persist_file',
+                os.path.join(get_execdir(), 'persist.json'))
+        _store = ParameterStore(filename,
+                config.get('persist_write_delay', 1.0))
+    return _store
+
+def flush():
+    '''Write pending changes of the parameter store, if it is used.'''
+    if _store is not None:
+        _store.flush()
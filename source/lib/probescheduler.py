@@ -0,0 +1,248 @@
+# probescheduler.py, periodically read instrument parameters
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Central scheduler for periodic reads ('probes') of instrument parameters,
+used for the 'probe_interval' parameter option and by the watch window.
+
+A single gobject timeout runs when the next probe is due. The probes that
+are due at that time are grouped per instrument and read with one
+Instrument.get() call, which combines the queries where the driver
+supports it and emits a single 'changed' signal with all values.
+
+Probes of an instrument whose access lock is held, e.g. by a running
+measurement, are skipped. If the instrument is busy or a read takes a
+large fraction of the interval, the interval is doubled (up to
+'max_backoff' times the requested interval); it returns to the requested
+interval when the reads are fast again.
+'''
+
+import logging
+import gobject
+
+from lib.misc import exact_time
+from lib.config import get_config
+
+class Probe:
+    '''A periodically read parameter; the interval is in seconds.'''
+
+    def __init__(self, ins, name):
+        self.ins = ins
+        self.name = name
+        self.owners = {}
+        self.interval = 0
+        self.next_time = 0
+        self.nreads = 0
+        self.nskipped = 0
+
+    def get_base_interval(self):
+        '''Return the shortest interval requested by the owners.'''
+        return min(self.owners.values())
+
+class ProbeScheduler:
+
+    def __init__(self, max_load=0.25, max_backoff=16, min_interval=0.05):
+        '''
+        Input:
+            max_load (float): if a read takes longer than this fraction of
+                the interval, the interval is increased
+            max_backoff (int): maximum factor by which an interval is
+                increased
+            min_interval (float): minimum interval in seconds
+        '''
+
+        self._probes = {}
+        self._paused = set()
+        self._hid = None
+        self._hid_time = None
+        self._max_load = max_load
+        self._max_backoff = max_backoff
+        self._min_interval = min_interval
+
+        self._nruns = 0
+        self._run_time = 0.0
+
+    def add(self, ins, name, interval, owner=''):
+        '''
+        Read parameter 'name' of Instrument 'ins' every 'interval' ms.
+        Different owners (e.g. the driver and the watch window) can probe
+        the same parameter; the shortest interval is used.
+        '''
+
+        key = (ins.get_name(), name)
+        if key not in self._probes:
+            self._probes[key] = Probe(ins, name)
+        probe = self._probes[key]
+        probe.ins = ins
+        probe.owners[owner] = max(interval / 1000.0, self._min_interval)
+        probe.interval = probe.get_base_interval()
+        probe.next_time = exact_time() + probe.interval
+        self._reschedule()
+
+    def remove(self, insname, name, owner=''):
+        '''
+        Stop probing parameter 'name' of instrument insname for owner, or
+        for all owners if owner is None.
+        '''
+
+        probe = self._probes.get((insname, name), None)
+        if probe is None:
+            return
+        if owner is None:
+            probe.owners = {}
+        elif owner in probe.owners:
+            del probe.owners[owner]
+        if len(probe.owners) == 0:
+            del self._probes[(insname, name)]
+        else:
+            probe.interval = probe.get_base_interval()
+
+    def remove_owner(self, owner):
+        '''Stop all probes of owner.'''
+        for insname, name in self._probes.keys():
+            self.remove(insname, name, owner)
+        self._paused.discard(owner)
+
+    def get_owners(self):
+        '''Return the owners that have probes or are paused.'''
+        owners = set(self._paused)
+        for probe in self._probes.values():
+            owners.update(probe.owners.keys())
+        return list(owners)
+
+    def remove_instrument(self, insname):
+        '''Remove all probes of instrument insname.'''
+        for key in self._probes.keys():
+            if key[0] == insname:
+                del self._probes[key]
+
+    def set_paused(self, owner, paused):
+        '''
+        Pause or resume the probes of owner. A parameter is still probed
+        if another owner that is not paused probes it too.
+        '''
+        if paused:
+            self._paused.add(owner)
+        else:
+            self._paused.discard(owner)
+            self._reschedule()
+
+    def _is_active(self, probe):
+        for owner in probe.owners:
+            if owner not in self._paused:
+                return True
+        return False
+
+    def _reschedule(self):
+        '''Make sure the timeout runs when the next probe is due.'''
+
+        times = [p.next_time for p in self._probes.values()
+                if self._is_active(p)]
+        if len(times) == 0:
+            return
+        due = min(times)
+        if self._hid is not None:
+            if self._hid_time <= due:
+                return
+            gobject.source_remove(self._hid)
+
+        delay = max(0, int((due - exact_time()) * 1000))
+        self._hid_time = due
+        self._hid = gobject.timeout_add(delay, self._run)
+
+    def _run(self):
+        self._hid = None
+        start = exact_time()
+
+        groups = {}
+        for probe in self._probes.values():
+            if probe.next_time <= start and self._is_active(probe):
+                groups.setdefault(probe.ins.get_name(), []).append(probe)
+
+        for insname, probes in groups.iteritems():
+            self._read(probes)
+
+        self._nruns += 1
+        self._run_time += exact_time() - start
+        self._reschedule()
+        return False
+
+    def _read(self, probes):
+        '''Read the probes of one instrument and update their intervals.'''
+
+        ins = probes[0].ins
+        start = exact_time()
+        if ins._access_lock.locked():
+            busy = True
+            for probe in probes:
+                probe.nskipped += 1
+        else:
+            try:
+                ins.get([p.name for p in probes])
+            except Exception, e:
+                logging.warning('Probing %s of %s failed: %s',
+                        [p.name for p in probes], ins.get_name(), e)
+            end = exact_time()
+            busy = False
+            for probe in probes:
+                probe.nreads += 1
+                if end - start > self._max_load * probe.interval:
+                    busy = True
+
+        now = exact_time()
+        for probe in probes:
+            base = probe.get_base_interval()
+            if busy:
+                probe.interval = min(probe.interval * 2,
+                        base * self._max_backoff)
+            else:
+                probe.interval = max(probe.interval / 2, base)
+            probe.next_time = now + probe.interval
+
+    def get_stats(self):
+        '''
+        Return the number of timeout runs and their total time, and per
+        probe ('instrument.parameter') the requested and current interval
+        (ms) and the number of reads and skipped reads.
+        '''
+
+        probes = {}
+        for (insname, name), p in self._probes.iteritems():
+            probes['%s.%s' % (insname, name)] = {
+                'interval': p.get_base_interval() * 1000,
+                'current_interval': p.interval * 1000,
+                'reads': p.nreads,
+                'skipped': p.nskipped,
+                'owners': p.owners.keys(),
+            }
+
+        return {
+            'runs': self._nruns,
+            'run_time': self._run_time,
+            'probes': probes,
+        }
+
+_scheduler = None
+
+def get_scheduler():
+    '''Return the probe scheduler, create it on first use.'''
+    global _scheduler
+    if _scheduler is None:
+        config = get_config()
+        _scheduler = ProbeScheduler(
+                max_load=config.get('probe_max_load', 0.25),
+                max_backoff=config.get('probe_max_backoff', 16))
+    return _scheduler
@@ -0,0 +1,290 @@
+# rampscheduler.py, set several (ramped) instrument parameters concurrently
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Set several instrument parameters at the same time.
+
+Parameters with a 'maxstep' are ramped in steps with 'stepdelay' in
+between, as Instrument.set() does. The RampScheduler starts one worker
+thread per instrument lock class; instruments that share a bus therefore
+never receive commands at the same time, but the steps of their ramps
+are interleaved. Ramps on different buses run in parallel, so the total
+time is that of the slowest ramp instead of the sum of all ramps.
+'''
+
+import sys
+import time
+import logging
+import threading
+
+from lib.misc import exact_time
+
+class Ramp:
+    '''The steps to set one parameter to a new value.'''
+
+    def __init__(self, ins, name, value, steps, delay, kwargs):
+        self.ins = ins
+        self.name = name
+        self.value = value
+        self.steps = steps
+        self.delay = delay
+        self.kwargs = kwargs
+
+        self.nsteps_done = 0
+        self.next_time = 0
+        self.start_time = None
+        self.end_time = None
+        self.result = None
+        self.error = None
+
+    def is_done(self):
+        return self.end_time is not None
+
+    def get_label(self):
+        return '%s.%s' % (self.ins.get_name(), self.name)
+
+    def do_step(self):
+        '''Perform the next step, finish the ramp after the last one.'''
+
+        now = exact_time()
+        if self.start_time is None:
+            self.start_time = now
+
+        p = self.ins.get_parameter_options(self.name)
+        if self.nsteps_done < len(self.steps):
+            stepval = self.steps[self.nsteps_done]
+            p['set_func'](stepval, **self.kwargs)
+            p['value'] = stepval
+            self.nsteps_done += 1
+
+        if self.nsteps_done < len(self.steps):
+            self.next_time = now + self.delay
+        else:
+            self.result = self.ins._finish_set(self.name, self.value,
+                    self.kwargs)
+            self.end_time = exact_time()
+            # _queue_changed() can be called from this worker thread, the
+            # signal is emitted in the main loop
+            if self.result is not None:
+                self.ins._queue_changed({self.name: self.result})
+
+    def get_duration(self):
+        if self.start_time is None:
+            return 0
+        if self.end_time is None:
+            return exact_time() - self.start_time
+        return self.end_time - self.start_time
+
+class RampWorker(threading.Thread):
+    '''
+    Thread that performs the ramps for instruments with the same lock
+    class, interleaving the steps of the different ramps.
+    '''
+
+    def __init__(self, lock_class, lock, ramps, abort_event):
+        threading.Thread.__init__(self, name='Ramp %s' % lock_class)
+        self.setDaemon(True)
+        self._lock = lock
+        self._ramps = ramps
+        self._abort = abort_event
+
+    def run(self):
+        pending = list(self._ramps)
+        while len(pending) > 0 and not self._abort.isSet():
+            ramp = min(pending, key=lambda r: r.next_time)
+            wait = ramp.next_time - exact_time()
+            if wait > 0:
+                self._abort.wait(wait)
+                continue
+
+            if not self._lock.acquire():
+                logging.warning('Unable to acquire lock for %s, retrying',
+                        ramp.get_label())
+                continue
+            try:
+                ramp.do_step()
+            except Exception, e:
+                logging.exception('Setting %s failed', ramp.get_label())
+                ramp.error = sys.exc_info()[1]
+                ramp.end_time = exact_time()
+            finally:
+                self._lock.release()
+
+            if ramp.is_done():
+                pending.remove(ramp)
+
+class RampScheduler:
+    '''
+    Set a number of parameters concurrently, see Instruments.set_many().
+    '''
+
+    def __init__(self):
+        self._ramps = []
+        self._rejected = []
+        self._workers = []
+        self._abort = threading.Event()
+        self._start_time = None
+        self._end_time = None
+
+    def add(self, ins, name, value, **kwargs):
+        '''
+        Add parameter name of Instrument ins, to be set to value. Returns
+        False if the value is invalid (see Instrument.set()).
+        '''
+
+        if ins._locked:
+            logging.warning('Trying to set "%s" of locked instrument (%s)',
+                    name, ins.get_name())
+            self._rejected.append((ins.get_name(), name))
+            return False
+
+        p, value = ins._prepare_set(name, value, kwargs)
+        if p is None:
+            self._rejected.append((ins.get_name(), name))
+            return False
+        steps, delay = ins._get_ramp_steps(name, value)
+        self._ramps.append(Ramp(ins, name, value, steps, delay, kwargs))
+        return True
+
+    def start(self):
+        '''Start a worker thread for each lock class.'''
+
+        groups = {}
+        for ramp in self._ramps:
+            key = ramp.ins.get_lock_class()
+            if key not in groups:
+                groups[key] = (ramp.ins._access_lock, [])
+            groups[key][1].append(ramp)
+
+        self._start_time = exact_time()
+        for key, (lock, ramps) in groups.iteritems():
+            worker = RampWorker(key, lock, ramps, self._abort)
+            self._workers.append(worker)
+            worker.start()
+
+    def is_running(self):
+        for worker in self._workers:
+            if worker.isAlive():
+                return True
+        if self._end_time is None and self._start_time is not None:
+            self._end_time = exact_time()
+        return False
+
+    def wait(self, idle_func=None, interval=0.05):
+        '''
+        Wait until all parameters are set. idle_func(interval) is called
+        while waiting, e.g. qt.msleep to keep the GUI responsive and to
+        check for an abort request. If it raises an exception the ramps
+        are aborted and the exception is raised again.
+        '''
+
+        try:
+            while self.is_running():
+                if idle_func is not None:
+                    idle_func(interval)
+                else:
+                    time.sleep(interval)
+        except:
+            self.abort()
+            raise
+
+    def abort(self):
+        '''Stop all ramps after the current step and wait for the workers.'''
+        self._abort.set()
+        for worker in self._workers:
+            worker.join()
+        self.is_running()
+
+    def get_results(self):
+        '''
+        Return a dictionary of (instrument name, parameter) -> value for
+        parameters that were set completely.
+        '''
+
+        ret = {}
+        for ramp in self._ramps:
+            if ramp.result is not None:
+                ret[(ramp.ins.get_name(), ramp.name)] = ramp.result
+        return ret
+
+    def succeeded(self):
+        '''Return whether all parameters were set without errors.'''
+        if len(self._rejected) > 0:
+            return False
+        for ramp in self._ramps:
+            if ramp.error is not None or ramp.result is None:
+                return False
+        return True
+
+    def get_progress(self):
+        '''Return the fraction of steps done.'''
+        total = sum([max(1, len(r.steps)) for r in self._ramps])
+        done = sum([r.is_done() and max(1, len(r.steps)) or r.nsteps_done
+                for r in self._ramps])
+        if total == 0:
+            return 1.0
+        return float(done) / total
+
+    def get_stats(self):
+        '''
+        Return timing statistics: the total time, the duration and number
+        of steps of each ramp, the time of the slowest ramp and the time
+        it would have taken to set the parameters one after another.
+        '''
+
+        ramps = {}
+        for r in self._ramps:
+            ramps[r.get_label()] = {
+                'duration': r.get_duration(),
+                'nsteps': r.nsteps_done,
+                'error': r.error,
+            }
+
+        durations = [r['duration'] for r in ramps.values()]
+        if self._start_time is None:
+            total = 0
+        elif self._end_time is None:
+            total = exact_time() - self._start_time
+        else:
+            total = self._end_time - self._start_time
+
+        return {
+            'total_time': total,
+            'slowest_ramp': max(durations + [0]),
+            'sequential_time': sum(durations),
+            'nworkers': len(self._workers),
+            'ramps': ramps,
+        }
+
+    def get_summary(self):
+        '''
+        Return whether all parameters were set, the results and the
+        statistics in a dictionary that can be sent to remote clients.
+        Errors are converted to strings.
+        '''
+
+        stats = self.get_stats()
+        for info in stats['ramps'].values():
+            if info['error'] is not None:
+                info['error'] = str(info['error'])
+
+        return {
+            'succeeded': self.succeeded(),
+            'running': self.is_running(),
+            'results': self.get_results(),
+            'rejected': list(self._rejected),
+            'stats': stats,
+        }
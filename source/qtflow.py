@@ -322,6 +322,11 @@ def qtlab_exit():
     print "Closing QTlab..."
     close_all_instruments()
 
+    from lib import persist
+    persist.flush()
+    from lib.file_support import snapshot
+    snapshot.drain()
+
     import qt
     qt.flow.exit_request()
 